@@ -0,0 +1,374 @@
+"""
+Price alerts, e.g. "notify when BTC price is below 20000" or "when ETH P/L
+is above 25%".
+
+A rule watches one metric of one ticker: its price, or the profit/loss
+percentage of the holding, worked out the same way as the portfolio view.
+A rule fires when the metric crosses its threshold and is then disarmed
+until the metric moves back past the threshold by the rule's hysteresis,
+so a price hovering around a threshold doesn't fire again on every tick. A
+rule that re-arms and crosses again within its cooldown is disarmed without
+notifying.
+
+Rules are kept per ticker and metric in lists sorted by threshold and by
+re-arm level. On each tick only the part of a list between the previous
+value and the new one is looked at, found with bisect, so the cost of a tick
+depends on how many rules were crossed rather than how many rules there are.
+
+Rules and whether they are armed are kept in a local SQLite file, so they
+survive a restart. Alerts are passed to sinks, functions that take an
+Alert, such as log_sink or a popup in the GUI.
+"""
+
+import bisect
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from engine import base_currency, currency_sign
+
+
+METRICS = {"price": "price", "pnl_percent": "P/L %"}
+DIRECTIONS = ("above", "below")
+
+Alert = namedtuple("Alert", ["rule", "value", "fired_at"])
+
+
+class AlertRule:
+
+    """
+    One rule. armed is False from when it fires until it re-arms.
+    """
+
+    __slots__ = ("rule_id", "symbol", "metric", "direction", "threshold", "hysteresis", "cooldown", "armed", "last_fired_at")
+
+    def __init__(self, rule_id, symbol, metric, direction, threshold, hysteresis=0.0, cooldown=0.0, armed=True, last_fired_at=None):
+        self.rule_id = rule_id
+        self.symbol = symbol
+        self.metric = metric
+        self.direction = direction
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.armed = armed
+        self.last_fired_at = last_fired_at
+
+    @property
+    def rearm_level(self):
+
+        """
+        The value the metric has to get back to before the rule can fire again
+        """
+
+        if self.direction == "above":
+            return self.threshold - self.hysteresis
+        return self.threshold + self.hysteresis
+
+    def format(self, value, currency_sign):
+        if self.metric == "price":
+            return f"{currency_sign}{value:,.2f}"
+        return f"{value:,.2f}%"
+
+    def describe(self, currency_sign):
+        return f"{self.symbol} {METRICS[self.metric]} {self.direction} {self.format(self.threshold, currency_sign)}"
+
+
+def validate_rule(symbol, metric, direction, threshold, hysteresis=0.0, cooldown=0.0):
+
+    """
+    Checks a rule entered by the user and returns it with the numbers
+    converted, or raises ValueError saying what is wrong
+    """
+
+    symbol = str(symbol).strip().upper()
+    if not symbol.isalpha():
+        raise ValueError("Ticker symbol must be alphabetic")
+    if metric not in METRICS:
+        raise ValueError(f"Metric must be one of {', '.join(METRICS)}")
+    if direction not in DIRECTIONS:
+        raise ValueError("Direction must be above or below")
+    try:
+        threshold = float(threshold)
+        hysteresis = float(hysteresis or 0)
+        cooldown = float(cooldown or 0)
+    except (TypeError, ValueError):
+        raise ValueError("Threshold, hysteresis and cooldown must be numbers")
+    if not math.isfinite(threshold):
+        raise ValueError("Threshold must be a number")
+    if hysteresis < 0 or cooldown < 0:
+        raise ValueError("Hysteresis and cooldown can't be negative")
+    return symbol, metric, direction, threshold, hysteresis, cooldown
+
+
+class ThresholdIndex:
+
+    """
+    The rules for one ticker and metric, as four lists of (level, rule_id)
+    sorted by level: firing thresholds and re-arm levels, for above and
+    below rules. Remembers the last value it was given.
+    """
+
+    def __init__(self):
+        self.levels = {("above", "fire"): [], ("above", "rearm"): [], ("below", "fire"): [], ("below", "rearm"): []}
+        self.last_value = None
+
+    def add(self, rule):
+        bisect.insort(self.levels[(rule.direction, "fire")], (rule.threshold, rule.rule_id))
+        bisect.insort(self.levels[(rule.direction, "rearm")], (rule.rearm_level, rule.rule_id))
+
+    def remove(self, rule):
+        for kind, level in (("fire", rule.threshold), ("rearm", rule.rearm_level)):
+            levels = self.levels[(rule.direction, kind)]
+            index = bisect.bisect_left(levels, (level, rule.rule_id))
+            if index < len(levels) and levels[index] == (level, rule.rule_id):
+                del levels[index]
+
+    def __len__(self):
+        return len(self.levels[("above", "fire")]) + len(self.levels[("below", "fire")])
+
+    @staticmethod
+    def _rising(levels, previous, value):
+        # Levels in (previous, value]
+        low = 0 if previous is None else bisect.bisect_right(levels, (previous, math.inf))
+        return levels[low:bisect.bisect_right(levels, (value, math.inf))]
+
+    @staticmethod
+    def _falling(levels, previous, value):
+        # Levels in [value, previous)
+        high = len(levels) if previous is None else bisect.bisect_left(levels, (previous, -math.inf))
+        return levels[bisect.bisect_left(levels, (value, -math.inf)):high]
+
+    def crossed(self, value):
+
+        """
+        Moves to value and returns (fire, rearm), the ids of the rules whose
+        threshold or re-arm level lies between the last value and this one.
+        On the first value every rule already past its level is included.
+        """
+
+        previous, self.last_value = self.last_value, value
+        if previous is not None and value == previous:
+            return [], []
+        fire = []
+        rearm = []
+        if previous is None or value > previous:
+            fire += self._rising(self.levels[("above", "fire")], previous, value)
+            rearm += self._rising(self.levels[("below", "rearm")], previous, value)
+        if previous is None or value < previous:
+            fire += self._falling(self.levels[("below", "fire")], previous, value)
+            rearm += self._falling(self.levels[("above", "rearm")], previous, value)
+        return [rule_id for _, rule_id in fire], [rule_id for _, rule_id in rearm]
+
+
+class AlertStore:
+
+    """
+    Keeps the rules and their armed state in a local SQLite file
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._lock:
+            connection = sqlite3.connect(self.path)
+            try:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS rules (
+                        rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        symbol TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        direction TEXT NOT NULL CHECK (direction IN ('above', 'below')),
+                        threshold REAL NOT NULL,
+                        hysteresis REAL NOT NULL DEFAULT 0,
+                        cooldown REAL NOT NULL DEFAULT 0,
+                        armed INTEGER NOT NULL DEFAULT 1,
+                        last_fired_at REAL NULL
+                    )
+                """)
+                connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _execute(self, statement, parameters=(), many=False):
+        with self._lock:
+            connection = sqlite3.connect(self.path)
+            try:
+                cursor = connection.executemany(statement, parameters) if many else connection.execute(statement, parameters)
+                rows = cursor.fetchall()
+                connection.commit()
+                return cursor.lastrowid, rows
+            finally:
+                connection.close()
+
+    def load(self):
+        _, rows = self._execute(
+            "SELECT rule_id, symbol, metric, direction, threshold, hysteresis, cooldown, armed, last_fired_at FROM rules ORDER BY rule_id")
+        return [AlertRule(*row[:7], armed=bool(row[7]), last_fired_at=row[8]) for row in rows]
+
+    def insert(self, symbol, metric, direction, threshold, hysteresis, cooldown):
+        rule_id, _ = self._execute(
+            "INSERT INTO rules (symbol, metric, direction, threshold, hysteresis, cooldown) VALUES (?, ?, ?, ?, ?, ?)",
+            (symbol, metric, direction, threshold, hysteresis, cooldown))
+        return rule_id
+
+    def delete(self, rule_id):
+        self._execute("DELETE FROM rules WHERE rule_id = ?", (rule_id,))
+
+    def save_states(self, rules):
+        self._execute("UPDATE rules SET armed = ?, last_fired_at = ? WHERE rule_id = ?",
+                      [(int(rule.armed), rule.last_fired_at, rule.rule_id) for rule in rules], many=True)
+
+
+def log_sink(alert):
+    # Thresholds and values are in the base currency, like the quotes
+    sign = currency_sign(base_currency())
+    logging.warning(f"Alert: {alert.rule.describe(sign)} (now {alert.rule.format(alert.value, sign)})")
+
+
+class AlertBook:
+
+    """
+    All the alert rules, indexed by ticker and metric. check() is called
+    with the coins and price books on every price update, and passes the
+    alerts that fired to each sink.
+
+    With a store, rules are loaded from it and every change is written back.
+    Without one, rules only last as long as the book, e.g. in benchmarks.
+    """
+
+    def __init__(self, store=None, sinks=(), currency=None):
+        # currency is the quote currency of the price books, i.e. the base currency
+        self.store = store
+        self.sinks = list(sinks)
+        self.currency = currency or base_currency()
+        self._rules = {}
+        self._indexes = {}
+        # Rules added since the last tick, checked against the value as it
+        # stands rather than for a crossing
+        self._added = []
+        self._next_id = 1
+        for rule in store.load() if store is not None else ():
+            self._index(rule)
+
+    def _index(self, rule):
+        self._rules[rule.rule_id] = rule
+        self._indexes.setdefault((rule.symbol, rule.metric), ThresholdIndex()).add(rule)
+        self._next_id = max(self._next_id, rule.rule_id + 1)
+
+    def add(self, symbol, metric, direction, threshold, hysteresis=0.0, cooldown=0.0):
+
+        """
+        Validates and adds a rule, returns it. Raises ValueError if the rule
+        isn't valid.
+        """
+
+        fields = validate_rule(symbol, metric, direction, threshold, hysteresis, cooldown)
+        rule_id = self.store.insert(*fields) if self.store is not None else self._next_id
+        rule = AlertRule(rule_id, *fields)
+        self._index(rule)
+        self._added.append(rule)
+        return rule
+
+    def remove(self, rule_id):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return
+        key = (rule.symbol, rule.metric)
+        self._indexes[key].remove(rule)
+        if not len(self._indexes[key]):
+            del self._indexes[key]
+        if self.store is not None:
+            self.store.delete(rule_id)
+
+    def rules(self):
+        return list(self._rules.values())
+
+    def __len__(self):
+        return len(self._rules)
+
+    def values(self, coins, *price_books):
+
+        """
+        Works out the current value of every watched ticker and metric.
+        Prices come from the first price book that lists the ticker. P/L is
+        only known for held coins with a cost.
+        """
+
+        held = {coin.symbol: coin for coin in coins}
+        values = {}
+        for symbol, metric in self._indexes:
+            listing = next((book.get(symbol) for book in price_books if symbol in book), None)
+            if listing is None:
+                continue
+            price = listing["quote"][self.currency]["price"]
+            if metric == "price":
+                values[(symbol, metric)] = price
+            else:
+                coin = held.get(symbol)
+                if coin is not None and coin.unit_cost:
+                    values[(symbol, metric)] = (price / coin.unit_cost - 1) * 100
+        return values
+
+    def evaluate(self, values, now=None):
+
+        """
+        Moves each watched ticker and metric to its new value and returns
+        the alerts that fired. Rules that changed state are saved.
+        """
+
+        now = time.time() if now is None else now
+        alerts = []
+        changed = []
+        added, self._added = self._added, []
+        for rule in added:
+            value = values.get((rule.symbol, rule.metric))
+            if rule.rule_id in self._rules and value is not None and self._indexes[(rule.symbol, rule.metric)].last_value is not None:
+                past = value >= rule.threshold if rule.direction == "above" else value <= rule.threshold
+                if past:
+                    rule.armed = False
+                    rule.last_fired_at = now
+                    changed.append(rule)
+                    alerts.append(Alert(rule, value, now))
+
+        for key, value in values.items():
+            index = self._indexes.get(key)
+            if index is None:
+                continue
+            fire, rearm = index.crossed(value)
+            for rule_id in rearm:
+                rule = self._rules[rule_id]
+                if not rule.armed:
+                    rule.armed = True
+                    changed.append(rule)
+            for rule_id in fire:
+                rule = self._rules[rule_id]
+                if not rule.armed:
+                    continue
+                rule.armed = False
+                changed.append(rule)
+                if rule.last_fired_at is None or now - rule.last_fired_at >= rule.cooldown:
+                    rule.last_fired_at = now
+                    alerts.append(Alert(rule, value, now))
+
+        if changed and self.store is not None:
+            self.store.save_states(changed)
+        return alerts
+
+    def check(self, coins, *price_books, now=None):
+
+        """
+        Evaluates the rules against the latest prices and passes every alert
+        to the sinks. Returns the alerts.
+        """
+
+        alerts = self.evaluate(self.values(coins, *price_books), now)
+        for alert in alerts:
+            for sink in self.sinks:
+                sink(alert)
+        return alerts
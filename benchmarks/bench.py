@@ -0,0 +1,269 @@
+"""
+Benchmarks for the Folio hot paths, run against the embedded SQLite storage
+backend and a local stand-in for CoinMarketCap (a local HTTP server).
+
+Run from the repository root:
+
+    python -m benchmarks.bench                   full run: 10 / 1k / 100k holdings, 200 / 5k listings
+    python -m benchmarks.bench --quick           smaller sizes and fewer runs
+    python -m benchmarks.bench --compare OLD.json
+                                                 also compares p50 against an earlier run
+
+Every run is saved to benchmarks/results/<time>-<commit>.json so results
+from different commits can be compared.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import engine
+from alerts import AlertBook, DIRECTIONS
+from storage import SQLiteStorage
+from benchmarks.standins import FakeCoinMarketCap, fill_holdings, load_or_make_listings, ticker, write_trade_file
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Cases that can't run here, with the reason
+SKIPPED = {}
+
+
+def measure(function, repeat):
+
+    """
+    Runs function once to warm up and then repeat times. Returns the latency
+    percentiles in milliseconds and the peak memory allocated during one more
+    run, which is traced separately so tracing doesn't skew the timings.
+    """
+
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    if len(timings) > 1:
+        cuts = statistics.quantiles(timings, n=100, method="inclusive")
+        p90, p99 = cuts[89], cuts[98]
+    else:
+        p90 = p99 = timings[0]
+    return {
+        "runs": repeat,
+        "p50_ms": statistics.median(timings),
+        "p90_ms": p90,
+        "p99_ms": p99,
+        "mean_ms": statistics.fmean(timings),
+        "peak_kib": peak / 1024,
+    }
+
+
+def repeats_for(size, quick):
+    runs = 50 if size <= 1000 else 10 if size <= 10000 else 3
+    return max(3, runs // 5) if quick else runs
+
+
+def run(holdings_sizes, listing_sizes, quick, recorded_path):
+    results = {}
+
+    def record(name, function, size):
+        result = measure(function, repeats_for(size, quick))
+        results[name] = result
+        print(f"{name:<48} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  peak {result['peak_kib']:10.1f} KiB")
+
+    payloads = {count: load_or_make_listings(count, recorded_path) for count in listing_sizes}
+
+    for count, payload in payloads.items():
+        with FakeCoinMarketCap(payload) as fake:
+            previous = engine.set_api_client(engine.CoinMarketCapClient("benchmark", base_url=fake.url, retries=0))
+            record(f"fetch_api_data[listings={count}]", lambda: engine.fetch_api_data("benchmark"), count)
+            record(f"fetch_all_listings[listings={count},page=1000]",
+                   lambda: engine.fetch_all_listings("benchmark", page_size=1000), count)
+            for held in (15, 500):
+                symbols = [listing["symbol"] for listing in payload["data"][-held:]]
+                record(f"fetch_quotes[held={held},listings={count}]", lambda: engine.fetch_quotes("benchmark", symbols), held)
+            engine.set_api_client(previous).close()
+        record(f"PriceBook[listings={count}]", lambda: engine.PriceBook(payload), count)
+        record(f"SearchIndex build[listings={count}]", lambda: engine.SearchIndex(payload["data"]), count)
+        search_index = engine.SearchIndex(payload["data"])
+        for query in ("b", "coin", "bitcon"):
+            record(f"SearchIndex.search[listings={count},query={query}]", lambda: search_index.search(query), 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for holdings in holdings_sizes:
+            storage = SQLiteStorage(os.path.join(directory, f"folio-{holdings}.db"))
+            fill_holdings(storage, holdings)
+            previous = engine.set_storage(storage)
+            try:
+                record(f"fetch_coins[holdings={holdings}]", engine.fetch_coins, holdings)
+                # Streamed and dropped row by row, so the peak is one fetch batch
+                record(f"iter_coins[holdings={holdings}]", lambda: collections.deque(engine.iter_coins(), maxlen=0), holdings)
+                coins = engine.fetch_coins()
+                write_cases(record, holdings)
+            finally:
+                engine.set_storage(previous)
+                storage.pool.close_all()
+
+            for count, payload in payloads.items():
+                price_book = engine.PriceBook(payload)
+                record(f"value_portfolio[holdings={holdings},listings={count}]",
+                       lambda: engine.value_portfolio(coins, price_book), max(holdings, count))
+
+    # Thousands of rules on a few tickers, with each tick moving the price a little
+    for rules in (1000, 100000):
+        alert_book = alert_rules(rules)
+        ticks = itertools.cycle([{(ticker(number % 10), "price"): 500 + offset for number in range(10)} for offset in (-2, 1, 3, -1)])
+        record(f"AlertBook.evaluate[rules={rules},tickers=10]", lambda: alert_book.evaluate(next(ticks)), 1)
+
+    record("validate_trade", lambda: engine.validate_trade("1", "2.5", "100", "250", "1", "btc", "Bitcoin", 1), 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SQLiteStorage(os.path.join(directory, "folio-import.db"))
+        previous = engine.set_storage(storage)
+        try:
+            rows = 2000 if quick else 20000
+            path = os.path.join(directory, "trades.csv")
+            write_trade_file(path, rows)
+            record(f"import_trades[rows={rows}]", lambda: engine.import_trades(path), rows)
+        finally:
+            engine.set_storage(previous)
+            storage.pool.close_all()
+
+    for name, reason in SKIPPED.items():
+        print(f"{name:<48} skipped: {reason}")
+
+    return results
+
+
+def write_cases(record, holdings):
+
+    """
+    Trades as add_data makes them, against the storage that is set: buying
+    more of a held coin, buying a new coin, and selling part of a holding
+    """
+
+    symbol = engine.fetch_coins()[0].symbol
+    new_ids = itertools.count()
+
+    def buy_new_coin():
+        number = next(new_ids)
+        crypto_id = 10_000_000 + number
+        engine.add_coin(crypto_id, "NEW" + ticker(number), "Newcoin")
+        engine.transaction_data(crypto_id, 1, 1.0, 10.0, 10.0)
+
+    record(f"symbol_exists[holdings={holdings}]", lambda: engine.symbol_exists(symbol), holdings)
+    record(f"buy_transaction[holdings={holdings}]", lambda: engine.buy_transaction(symbol, 1.0, 100.0), holdings)
+    record(f"add_coin+transaction_data[holdings={holdings}]", buy_new_coin, holdings)
+    record(f"sell_transaction[holdings={holdings}]", lambda: engine.sell_transaction(symbol, 0.001, 1.0), holdings)
+
+    def apply_batch():
+        trade = {"side": "B", "crypto_id": None, "transaction_id": None, "symbol": symbol, "name": "", "quantity": 1.0, "price": 100.0, "cost": 100.0}
+        engine.apply_trades([(uuid.uuid4().hex, trade) for _ in range(100)])
+
+    record(f"apply_trades[holdings={holdings},batch=100]", apply_batch, holdings)
+
+
+def alert_rules(count, seed=1):
+
+    """
+    An AlertBook with count price rules spread over ten tickers, thresholds
+    either side of 500
+    """
+
+    rng = random.Random(seed)
+    alert_book = AlertBook()
+    for number in range(count):
+        alert_book.add(ticker(number % 10), "price", rng.choice(DIRECTIONS), rng.uniform(0, 1000), hysteresis=5)
+    return alert_book
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save(results, quick):
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "quick": quick,
+        "cases": results,
+        "skipped": SKIPPED,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    return path
+
+
+def compare(baseline_path, results, threshold):
+
+    """
+    Prints the change in p50 latency for every case in both runs and returns
+    True if any case got slower by more than threshold (a fraction)
+    """
+
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)
+
+    print(f"\nCompared with {baseline['commit']} ({baseline['time']}):")
+    regressed = False
+    for name, result in results.items():
+        before = baseline["cases"].get(name)
+        if before is None:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{name:<48} {before['p50_ms']:9.3f} -> {result['p50_ms']:9.3f} ms  {change:+7.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Folio hot paths against local stand-ins")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer runs")
+    parser.add_argument("--recorded", help="recorded listings/latest JSON response to serve instead of a generated one")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p50 slowdown counted as a regression (default 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if args.quick:
+        holdings_sizes, listing_sizes = [10, 1000], [200]
+    else:
+        holdings_sizes, listing_sizes = [10, 1000, 100000], [200, 5000]
+
+    results = run(holdings_sizes, listing_sizes, args.quick, args.recorded)
+    print(f"\nSaved {save(results, args.quick)}")
+
+    if args.compare and compare(args.compare, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Local stand-ins for the database and CoinMarketCap, so the benchmarks can run
+on any machine without credentials, network access or API credits. The
+database is the embedded SQLite backend from storage.py.
+"""
+
+import csv
+import json
+import random
+import string
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Exchange rates from GBP served by the price conversion tool, and the
+# fiat ids CoinMarketCap gives those currencies
+FX_RATES = {"GBP": 1.0, "USD": 1.27, "EUR": 1.17, "JPY": 190.5}
+FIAT_IDS = {"USD": 2781, "EUR": 2790, "GBP": 2791, "JPY": 2797}
+
+
+def ticker(number):
+
+    """
+    Turns a number into a unique alphabetic ticker, A, B, ..., Z, BA, BB, ...
+    """
+
+    letters = ""
+    while True:
+        number, remainder = divmod(number, 26)
+        letters = string.ascii_uppercase[remainder] + letters
+        if number == 0:
+            return letters
+
+
+def make_listings(count, seed=1):
+
+    """
+    Builds a CoinMarketCap listings/latest style payload with count coins in
+    market cap order and prices in GBP
+    """
+
+    rng = random.Random(seed)
+    data = []
+    for rank in range(count):
+        symbol = ticker(rank)
+        data.append({
+            "id": rank + 1,
+            "name": f"Coin{symbol.capitalize()}",
+            "symbol": symbol,
+            "cmc_rank": rank + 1,
+            "quote": {"GBP": {"price": rng.uniform(0.01, 50000), "percent_change_24h": rng.uniform(-20, 20)}},
+        })
+    return {"status": {"error_code": 0, "credit_count": 1}, "data": data}
+
+
+def load_or_make_listings(count, recorded_path=None):
+
+    """
+    Uses a recorded API response if one is given, trimmed or padded to count
+    listings, otherwise generates one
+    """
+
+    if recorded_path is None:
+        return make_listings(count)
+    with open(recorded_path, encoding="utf-8") as file:
+        payload = json.load(file)
+    data = payload["data"]
+    if len(data) < count:
+        extra = make_listings(count)["data"][len(data):]
+        data = data + extra
+    payload["data"] = data[:count]
+    return payload
+
+
+class FakeCoinMarketCap:
+
+    """
+    Serves a listings payload on 127.0.0.1 in a background thread. Point
+    CMC_API_URL at url to send the engine's API calls here instead.
+
+    listings/latest honours start and limit and reports total_count, and
+    quotes/latest answers symbol and id lookups from the same listings, in the
+    shapes CoinMarketCap uses, and tools/price-conversion converts GBP, by
+    its fiat id from fiat/map, at FX_RATES. Credits are counted as
+    CoinMarketCap bills them and reported by key/info.
+
+    failing can be set to a function of (path, query) that returns True for
+    the requests to answer with a 500, to test partial failures.
+    """
+
+    def __init__(self, payload):
+        self.requests = 0
+        self.credits_used = 0
+        self.failing = None
+        self.listings = payload["data"]
+        self._by_symbol = {}
+        for listing in self.listings:
+            self._by_symbol.setdefault(listing["symbol"], []).append(listing)
+        self._by_id = {str(listing["id"]): listing for listing in self.listings}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests += 1
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if fake.failing is not None and fake.failing(url.path, query):
+                    self.send_response(500)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if url.path.endswith("/quotes/latest"):
+                    response = fake.quotes(query)
+                elif url.path.endswith("/price-conversion"):
+                    response = fake.conversion(query)
+                elif url.path.endswith("/fiat/map"):
+                    response = fake.fiat_map()
+                elif url.path.endswith("/key/info"):
+                    response = fake.key_info()
+                else:
+                    response = fake.page(query)
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _status(self, credits, **extra):
+        self.credits_used += credits
+        return {"error_code": 0, "credit_count": credits, **extra}
+
+    def page(self, query):
+        start = int(query.get("start", 1))
+        limit = int(query.get("limit", 100))
+        data = self.listings[start - 1:start - 1 + limit]
+        return {"status": self._status(max(1, -(-len(data) // 200)), total_count=len(self.listings)), "data": data}
+
+    def quotes(self, query):
+        if "symbol" in query:
+            data = {symbol: self._by_symbol.get(symbol, []) for symbol in query["symbol"].split(",")}
+        else:
+            data = {crypto_id: self._by_id[crypto_id] for crypto_id in query.get("id", "").split(",") if crypto_id in self._by_id}
+        return {"status": self._status(max(1, -(-len(data) // 100))), "data": data}
+
+    def conversion(self, query):
+        currency = query.get("convert", "")
+        if query.get("id") != str(FIAT_IDS["GBP"]) or currency not in FX_RATES:
+            return {"status": self._status(1), "data": {}}
+        amount = float(query.get("amount", 1))
+        return {"status": self._status(1), "data": {
+            "id": FIAT_IDS["GBP"], "symbol": "GBP", "amount": amount, "quote": {currency: {"price": amount * FX_RATES[currency]}}}}
+
+    def fiat_map(self):
+        return {"status": self._status(1), "data": [{"id": fiat_id, "symbol": symbol} for symbol, fiat_id in FIAT_IDS.items()]}
+
+    def key_info(self):
+        return {"status": self._status(0), "data": {"usage": {"current_day": {"credits_used": self.credits_used}}}}
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def fill_holdings(storage, holdings, seed=1):
+
+    """
+    Fills an empty SQLiteStorage with holdings coins, each bought in one
+    trade, writing the ledger, lots and positions directly so large
+    portfolios don't take long to set up
+    """
+
+    rng = random.Random(seed)
+    coins = []
+    trades = []
+    lots = []
+    positions = []
+    for number in range(holdings):
+        crypto_id = number + 1
+        symbol = ticker(number)
+        quantity = rng.uniform(0.1, 100)
+        cost = quantity * rng.uniform(0.01, 50000)
+        coins.append((crypto_id, symbol, f"Coin{symbol.capitalize()}"))
+        trades.append((crypto_id, crypto_id, crypto_id, quantity, cost / quantity, cost))
+        lots.append((crypto_id, crypto_id, quantity, cost / quantity))
+        positions.append((crypto_id, quantity, cost, cost, crypto_id))
+
+    with storage.pool.connection() as connection:
+        connection.executemany("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", coins)
+        connection.executemany(
+            "INSERT INTO trades (trade_id, crypto_id, transaction_id, side, quantity, price, cost) VALUES (?, ?, ?, 'B', ?, ?, ?)", trades)
+        connection.executemany("INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost) VALUES (?, ?, ?, ?)", lots)
+        connection.executemany(
+            "INSERT INTO positions (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id) VALUES (?, ?, ?, ?, ?)",
+            positions)
+        connection.commit()
+
+
+def write_trade_file(path, rows, seed=1):
+
+    """
+    Writes a CSV trade file for import_trades with rows buys spread over a
+    few dozen coins
+    """
+
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["crypto_id", "transaction_id", "symbol", "name", "quantity", "price", "cost"])
+        for number in range(rows):
+            coin = rng.randrange(50)
+            quantity = rng.uniform(0.1, 10)
+            price = rng.uniform(0.01, 50000)
+            writer.writerow([100000 + coin, number + 1, "IMP" + ticker(coin), "Imported", quantity, price, quantity * price])
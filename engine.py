@@ -0,0 +1,1845 @@
+"""
+Headless core of Folio: database access, CoinMarketCap fetching, price
+caching and portfolio valuation, with no Tk code.
+
+Importing this module has no side effects. Nothing connects to the database
+or the API until a function is called, and the database driver and HTTP
+library are only imported when they are first needed. Environment variables
+are read when they are used, so callers should load the .env file first.
+"""
+
+import os
+import math
+import logging
+import threading
+import time
+import queue
+import json
+import csv
+import sqlite3
+import zlib
+import uuid
+import random
+import bisect
+import heapq
+from collections import Counter
+
+from instrumentation import registry, timed, SIZE_BUCKETS
+from storage import get_database_connection, ConnectionPool, SQLServerStorage, SQLiteStorage
+
+
+# Error reporting
+
+def _log_error(message):
+    logging.error(message)
+
+
+_error_handler = _log_error
+
+
+def set_error_handler(handler):
+
+    """
+    Sets the function that is called with a message when a database helper
+    hits an error it handles itself, e.g. the GUI shows it in a messagebox
+    """
+
+    global _error_handler
+    _error_handler = handler
+
+
+def report_error(message):
+    registry.increment("folio_reported_errors_total", "engine")
+    _error_handler(message)
+
+
+# Storage
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+
+    """
+    Returns the storage backend shared by all the database helpers, creating
+    it on first use. FOLIO_STORAGE picks it: sqlserver (the default) connects
+    with DATABASE_CONNECTION_STRING, sqlite keeps everything in the file at
+    FOLIO_SQLITE_PATH. Pool size and timeouts can be set in the .env file.
+    """
+
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if os.getenv('FOLIO_STORAGE', 'sqlserver').lower() == "sqlite":
+                _storage = SQLiteStorage(os.getenv('FOLIO_SQLITE_PATH', 'folio.db'),
+                                         pool_size=int(os.getenv('DATABASE_POOL_SIZE', '4')))
+            else:
+                import pyodbc
+
+                _storage = SQLServerStorage(ConnectionPool(
+                    get_database_connection,
+                    pyodbc.Error,
+                    size=int(os.getenv('DATABASE_POOL_SIZE', '5')),
+                    idle_timeout=float(os.getenv('DATABASE_POOL_IDLE_TIMEOUT', '300')),
+                    health_check_interval=float(os.getenv('DATABASE_POOL_HEALTH_CHECK_INTERVAL', '30')),
+                    acquire_timeout=float(os.getenv('DATABASE_POOL_ACQUIRE_TIMEOUT', '10')),
+                ), transient_errors=(pyodbc.OperationalError, pyodbc.InterfaceError))
+        return _storage
+
+
+def set_storage(storage):
+
+    """
+    Replaces the shared storage backend, e.g. with a SQLite file for
+    benchmarks. Returns the backend it replaced.
+    """
+
+    global _storage
+    with _storage_lock:
+        previous, _storage = _storage, storage
+    # The cached coin IDs belonged to the old backend
+    symbol_cache.clear()
+    return previous
+
+
+def get_connection_pool():
+    return get_storage().pool
+
+
+class SymbolCache:
+
+    """
+    Process wide map of ticker to crypto_id, so checking a ticker or finding
+    the coin a trade is for doesn't cost a database round trip.
+
+    It is warmed from fetch_coins, filled in on a miss, and updated when a
+    coin is added or sold out. Tickers with no coin are not cached, so a coin
+    added by another app is found on the next lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, coins):
+        with self._lock:
+            self._ids.update((coin.symbol, coin.crypto_id) for coin in coins)
+
+    def add(self, symbol, crypto_id):
+        with self._lock:
+            self._ids[symbol] = crypto_id
+
+    def discard(self, symbol):
+        with self._lock:
+            self._ids.pop(symbol, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def crypto_id(self, symbol):
+
+        """
+        Returns the coin's crypto_id, or None if there is no coin with that
+        ticker. Only a miss goes to the database.
+        """
+
+        with self._lock:
+            crypto_id = self._ids.get(symbol)
+            if crypto_id is not None:
+                self.hits += 1
+                return crypto_id
+            self.misses += 1
+        crypto_id = get_storage().find_coin(symbol)
+        if crypto_id is not None:
+            self.add(symbol, crypto_id)
+        return crypto_id
+
+
+symbol_cache = SymbolCache()
+
+
+# Trades are appended to the trades ledger, and the open FIFO lots and the
+# positions row for the coin are updated in the same transaction. The SQL
+# for each backend is in storage.py.
+
+@timed("add_coin")
+def add_coin(crypto_id, symbol, name):
+
+    try:
+        # Validate crypto_id (positive integer)
+        if not isinstance(crypto_id, int) or crypto_id <= 0:
+            raise ValueError("Crypto ID must be a positive integer")
+
+        # Validate symbol (alphabetic characters)
+        if not symbol.isalpha():
+            raise ValueError("Ticker symbol must be alphabetic")
+
+        # Validate name (alphabetic characters)
+        if not name.isalpha():
+            raise ValueError("Coin name must be alphabetic")
+
+        # If validations pass, insert into database
+        get_storage().add_coin(crypto_id, symbol, name)
+        symbol_cache.add(symbol, crypto_id)
+    
+    except Exception as e:
+        report_error(f'Error adding coin: {e}')
+        
+
+@timed("transaction_data")
+def transaction_data(crypto_id, transaction_id, quantity, price, cost):
+    try:
+        # Validate inputs
+        if not isinstance(crypto_id, int) or crypto_id <= 0:
+            raise ValueError("Crypto ID must be a positive integer")
+        
+        if not isinstance(transaction_id, int) or transaction_id <= 0:
+            raise ValueError("Transaction ID must be a positive integer")
+
+        if not isinstance(quantity, float) or quantity <= 0:
+            raise ValueError("Quantity must be a positive float")
+
+        if not isinstance(price, float) or price <= 0:
+            raise ValueError("Price must be a positive float")
+
+        if not isinstance(cost, float) or cost <= 0:
+            raise ValueError("Total cost must be a positive float")
+
+        # If all validations pass, record the buy in the ledger
+        get_storage().record_buy(crypto_id, transaction_id, quantity, price, cost)
+
+    except ValueError as ve:
+        report_error(f'Validation Error: {ve}')
+        logging.error(f"Validation Error: {ve}")
+    except Exception as e:
+        report_error(f'Error inserting transaction data: {e}')
+        logging.error(f"Error inserting transaction data: {e}")
+
+
+    
+
+@timed("symbol_exists")
+def symbol_exists(symbol):
+    try:
+        # Check the cache, then the cryptocurrencies table
+        return symbol_cache.crypto_id(symbol) is not None
+
+    except Exception as e:
+        report_error(f'Error checking symbol existence: {e}')
+        logging.error(f"Error checking symbol existence: {e}")
+        return False
+
+
+@timed("buy_transaction")
+def buy_transaction(symbol, new_quantity, new_cost):
+    try:
+        new_quantity = float(new_quantity)
+        crypto_id = symbol_cache.crypto_id(symbol)
+        if crypto_id is None:
+            raise ValueError(f"There is no coin with the ticker {symbol}")
+        get_storage().record_buy(crypto_id, None, new_quantity, new_cost / new_quantity, new_cost)
+
+    except Exception as e:
+        logging.error(f"Error updating quantity: {e}")
+
+@timed("sell_transaction")
+def sell_transaction(symbol, new_quantity, new_cost):
+
+    """
+    Sells new_quantity of a coin for new_cost in one transaction.
+
+    The position is checked for enough of the coin, then the sell is
+    appended to the ledger, the oldest open lots are used up (FIFO), and the
+    position's quantity, cost bases and realised P/L are updated. A position
+    that reaches zero is removed, the coin and its history stay in the
+    ledger.
+
+    Returns "updated", "deleted" or "not_enough".
+    """
+
+    try:
+        new_quantity = float(new_quantity)
+        crypto_id = symbol_cache.crypto_id(symbol)
+        if crypto_id is None:
+            return "not_enough"
+        status = get_storage().record_sell(crypto_id, None, new_quantity, new_cost)
+        if status == "deleted":
+            symbol_cache.discard(symbol)
+        return status
+
+    except Exception as e:
+        report_error(f'An error occurred: {e}')
+        logging.error(f"An error occurred: {e}")
+
+
+def cost_basis():
+    return "fifo" if os.getenv('COST_BASIS', 'average').lower() == "fifo" else "average"
+
+
+@timed("fetch_coins", size=len)
+def fetch_coins():
+
+    """
+    Reads the current holdings from the positions table, one row per coin
+    held, so the cost doesn't grow with the number of trades in the ledger.
+
+    Returns a list of Position records with crypto_id, symbol, name,
+    last_trade_id, quantity, unit_cost and cost_basis. The cost basis is the
+    running average cost, or FIFO if COST_BASIS=fifo is set in the .env file.
+    """
+
+    try:
+        coins = get_storage().fetch_positions(cost_basis())
+        symbol_cache.warm(coins)
+        return coins
+    
+    except Exception as e:
+        report_error(f'Error fetching coins: {e}')
+        logging.error(f"Error fetching coins: {e}")
+        return []
+
+
+def iter_coins(arraysize=None):
+
+    """
+    Streams the same Position records as fetch_coins, arraysize rows per
+    round trip (DATABASE_FETCH_ARRAYSIZE, default 500), for callers that
+    only need to pass over the holdings once, e.g. exports. Errors are
+    raised rather than reported.
+    """
+
+    return get_storage().iter_positions(cost_basis(), arraysize)
+
+
+def _convert_positive(value, convert, message):
+    # JSON numbers arrive as floats, and int() would silently truncate 1.9
+    if convert is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError(message)
+    try:
+        value = convert(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(message)
+    if not value > 0:
+        raise ValueError(message)
+    return value
+
+
+def validate_trade(transaction_id, quantity, price, cost, crypto_id, symbol, name, transaction_type):
+
+    """
+    Validates and converts the fields of a trade, as typed into the entry
+    widgets or read from an import file
+
+    Returns the converted values in the same order, or raises ValueError with
+    a message that can be shown to the user
+    """
+
+    transaction_id = _convert_positive(transaction_id, int, "Transaction ID must be a positive integer")
+    quantity = _convert_positive(quantity, float, "Amount must be a positive float")
+    price = _convert_positive(price, float, "Price must be a positive float")
+    cost = _convert_positive(cost, float, "Total cost must be a positive float")
+    crypto_id = _convert_positive(crypto_id, int, "Coin ID must be a positive integer")
+
+    symbol = symbol.upper()
+    if not symbol.isalpha() or len(symbol) > 5:
+        raise ValueError("Ticker symbol must be alphabetic and no longer than 5 characters")
+    if not name.isalpha():
+        raise ValueError("Coin name must be alphabetic")
+    if transaction_type not in (1, 2):
+        raise ValueError("Invalid transaction type")
+
+    return transaction_id, quantity, price, cost, crypto_id, symbol, name, transaction_type
+
+
+IMPORT_FIELDS = ["crypto_id", "transaction_id", "symbol", "name", "side", "quantity", "price", "cost"]
+
+# Values of an import file's side column, as transaction types. A row with no
+# side is a buy, like files exported before sells could be imported.
+IMPORT_SIDES = {"": 1, "b": 1, "buy": 1, "s": 2, "sell": 2}
+
+
+def import_side(row):
+    side = str(row.get("side") or row.get("type") or "").strip().lower()
+    if side not in IMPORT_SIDES:
+        raise ValueError("Side must be buy or sell")
+    return IMPORT_SIDES[side]
+
+def read_trade_file(path):
+
+    """
+    Yields one dict per trade from a CSV file with a header row, a JSON Lines
+    file (.jsonl) or a JSON file holding a list of objects. CSV and JSON Lines
+    files are streamed rather than read into memory.
+    """
+
+    if path.lower().endswith(".jsonl"):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as file:
+            yield from json.load(file)
+    else:
+        with open(path, newline="", encoding="utf-8") as file:
+            yield from csv.DictReader(file)
+
+
+@timed("import_trades")
+def import_trades(path, error_path=None, batch_size=1000):
+
+    """
+    Bulk loads trades from a CSV or JSON file into the trades ledger.
+
+    Each row is validated with the same rules as trades entered in the GUI.
+    Buys are loaded batch_size at a time, with one database transaction per
+    batch. New tickers and the trades themselves are inserted with
+    executemany, tagged with an id for the batch, and the open lots and
+    positions are then updated from the tagged trades with one set-based
+    statement each. Rows whose side column says sell are applied one at a
+    time with record_sell, after the buys before them, so the lots are used
+    up in the order the file lists the trades. Bad rows, sells of more than
+    is held, and every row of a batch the database rejects, are written to
+    error_path with the reason instead of stopping the import.
+
+    Returns a dict with the row counts, elapsed seconds and rows per second.
+    """
+
+    if error_path is None:
+        error_path = os.path.splitext(path)[0] + ".errors.csv"
+
+    start = time.perf_counter()
+    imported = 0
+    rejected = 0
+
+    storage = get_storage()
+    with open(error_path, "w", newline="", encoding="utf-8") as error_file:
+        errors = csv.DictWriter(error_file, fieldnames=IMPORT_FIELDS + ["error"], extrasaction="ignore")
+        errors.writeheader()
+
+        held = storage.import_coins()
+        used_ids = set(held.values())
+
+        def reject(row, reason):
+            nonlocal rejected
+            rejected += 1
+            errors.writerow({**row, "error": reason})
+
+        def sell(row, trade):
+            nonlocal imported
+            transaction_id, quantity, _, cost, _, symbol, _, _ = trade
+            if symbol not in held:
+                reject(row, f"There is no {symbol} to sell")
+                return
+            try:
+                status = storage.record_sell(held[symbol], transaction_id, quantity, cost)
+            except storage.errors as e:
+                reject(row, f"Database error: {e}")
+                return
+            if status == "not_enough":
+                reject(row, f"Not enough {symbol} held to sell {quantity}")
+                return
+            if status == "deleted":
+                symbol_cache.discard(symbol)
+            imported += 1
+
+        def load_batch(batch):
+            nonlocal imported
+            new_coins = []
+            trades = []
+            batch_held = {}
+
+            for row, (transaction_id, quantity, price, cost, crypto_id, symbol, name, _) in batch:
+                if symbol in held or symbol in batch_held:
+                    crypto_id = held.get(symbol, batch_held.get(symbol))
+                else:
+                    batch_held[symbol] = crypto_id
+                    new_coins.append((crypto_id, symbol, name))
+                trades.append((crypto_id, transaction_id, quantity, price, cost))
+
+            try:
+                storage.import_batch(new_coins, trades)
+            except storage.errors as e:
+                used_ids.difference_update(batch_held.values())
+                for row, _ in batch:
+                    reject(row, f"Database error: {e}")
+                return
+
+            held.update(batch_held)
+            for symbol, crypto_id in batch_held.items():
+                symbol_cache.add(symbol, crypto_id)
+            imported += len(batch)
+
+        batch = []
+        batch_ids = {}
+        for row in read_trade_file(path):
+            if not isinstance(row, dict):
+                reject({}, f"Not a trade record: {row!r}")
+                continue
+            try:
+                trade = validate_trade(
+                    row.get("transaction_id"), row.get("quantity"), row.get("price"), row.get("cost"),
+                    row.get("crypto_id"), str(row.get("symbol") or ""), str(row.get("name") or ""), import_side(row))
+            except ValueError as ve:
+                reject(row, str(ve))
+                continue
+
+            if trade[7] == 2:
+                # The buys before a sell have to be in the lots it uses up
+                if batch:
+                    load_batch(batch)
+                    batch = []
+                    batch_ids = {}
+                sell(row, trade)
+                continue
+
+            crypto_id, symbol = trade[4], trade[5]
+            # A new ticker can't reuse a coin ID that already belongs to another ticker
+            if symbol not in held and symbol not in batch_ids and crypto_id in used_ids:
+                reject(row, f"Coin ID {crypto_id} is already used by another coin")
+                continue
+            if symbol not in held and symbol not in batch_ids:
+                batch_ids[symbol] = crypto_id
+                used_ids.add(crypto_id)
+
+            batch.append((row, trade))
+            if len(batch) >= batch_size:
+                load_batch(batch)
+                batch = []
+                batch_ids = {}
+
+        if batch:
+            load_batch(batch)
+
+    elapsed = time.perf_counter() - start
+    result = {
+        "imported": imported,
+        "rejected": rejected,
+        "seconds": elapsed,
+        "rows_per_sec": (imported + rejected) / elapsed if elapsed > 0 else 0.0,
+        "error_path": error_path,
+    }
+    logging.info(f"Imported {imported} trades, rejected {rejected} in {elapsed:.2f}s ({result['rows_per_sec']:.0f} rows/sec)")
+    return result
+
+
+# Write-behind trades
+#
+# Trades entered in the GUI are written to a local journal straight away and
+# applied to the database by a background thread, so a slow or unreachable
+# database never blocks the Tk thread.
+
+@timed("apply_trades", size=len)
+def apply_trades(entries):
+
+    """
+    Applies (journal_id, trade) entries in one transaction, in order. A trade
+    is a dict with side ("B" or "S"), crypto_id, transaction_id, symbol, name,
+    quantity, price and cost, as validate_trade returns them.
+
+    Returns one status per trade: "added" (a buy of a new coin), "bought",
+    "updated" or "deleted" (a sell that left some or none of the coin),
+    "not_enough" or "not_held" (a sell of more than is held), or "duplicate"
+    if the trade was already applied, e.g. before a crash. Raises the
+    storage's errors if the batch couldn't be applied.
+    """
+
+    statuses = get_storage().apply_trades(entries)
+    for (_, trade), status in zip(entries, statuses):
+        if status == "added":
+            symbol_cache.add(trade["symbol"], trade["crypto_id"])
+        elif status == "deleted":
+            symbol_cache.discard(trade["symbol"])
+    return statuses
+
+
+class TradeJournal:
+
+    """
+    Durable queue of trades waiting to be applied to the database, in a
+    local SQLite file. A trade is only reported as queued once it is on disk,
+    so it survives the app closing or crashing before the database has it.
+
+    Entries are applied in the order they were submitted. Applied entries
+    are removed, and ones the database rejected are kept as failed with the
+    error, for inspection.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS journal (
+                        sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+                        entry_id TEXT NOT NULL UNIQUE,
+                        submitted_at REAL NOT NULL,
+                        trade TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'failed')),
+                        error TEXT NULL
+                    )
+                """)
+                connection.execute("CREATE INDEX IF NOT EXISTS ix_journal_status ON journal (status, sequence)")
+                connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        # Every commit reaches the disk before a trade is reported as queued
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def append(self, trade):
+
+        """
+        Writes a trade to the journal and returns its entry id
+        """
+
+        entry_id = uuid.uuid4().hex
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("INSERT INTO journal (entry_id, submitted_at, trade) VALUES (?, ?, ?)",
+                                   (entry_id, time.time(), json.dumps(trade)))
+                connection.commit()
+            finally:
+                connection.close()
+        return entry_id
+
+    def pending(self, limit=None):
+
+        """
+        Returns up to limit [(entry_id, trade)] waiting to be applied, oldest first
+        """
+
+        with self._lock:
+            connection = self._connect()
+            try:
+                rows = connection.execute(
+                    "SELECT entry_id, trade FROM journal WHERE status = 'pending' ORDER BY sequence LIMIT ?",
+                    (-1 if limit is None else limit,)).fetchall()
+            finally:
+                connection.close()
+        return [(entry_id, json.loads(trade)) for entry_id, trade in rows]
+
+    def pending_count(self):
+        with self._lock:
+            connection = self._connect()
+            try:
+                return connection.execute("SELECT COUNT(*) FROM journal WHERE status = 'pending'").fetchone()[0]
+            finally:
+                connection.close()
+
+    def remove(self, entry_ids):
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.executemany("DELETE FROM journal WHERE entry_id = ?", [(entry_id,) for entry_id in entry_ids])
+                connection.commit()
+            finally:
+                connection.close()
+
+    def mark_failed(self, entry_id, error):
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("UPDATE journal SET status = 'failed', error = ? WHERE entry_id = ?", (error, entry_id))
+                connection.commit()
+            finally:
+                connection.close()
+
+
+class TradeWriter:
+
+    """
+    Applies journaled trades to the database on a background thread.
+
+    Everything pending when the thread wakes up, up to max_batch trades, is
+    applied in one database transaction. If the database can't be reached,
+    the trades stay in the journal and the writer tries again with
+    exponential backoff, up to max_retry_interval seconds apart, so trades
+    entered while offline are replayed once it is back.
+
+    If the database rejects a batch, its trades are retried one at a time so
+    only the bad trade is marked failed. Any other error is a bug rather than
+    an outage, so it is logged and the batch is marked failed instead of
+    being retried forever.
+
+    Outcomes go on the results queue for the Tk thread to drain, like
+    PriceRefresher.updates:
+        ("applied", entry_id, trade, status) for each trade, see apply_trades
+        ("failed", entry_id, trade, error) for a trade the database rejected
+        ("offline", None, None, error) when the database can't be reached
+        ("positions", None, None, rows) with fetch_coins rows after each batch
+    """
+
+    def __init__(self, journal, max_batch=100, retry_interval=2, max_retry_interval=60):
+        self.journal = journal
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.results = queue.Queue()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trade-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def submit(self, trade):
+
+        """
+        Journals a trade and wakes the writer, returns the journal entry id
+        """
+
+        entry_id = self.journal.append(trade)
+        self._wake.set()
+        return entry_id
+
+    def _apply(self, entries):
+        storage = get_storage()
+        try:
+            statuses = apply_trades(entries)
+        except storage.errors as e:
+            if storage.is_transient(e):
+                raise
+            if len(entries) == 1:
+                entry_id, trade = entries[0]
+                self.journal.mark_failed(entry_id, str(e))
+                self.results.put(("failed", entry_id, trade, str(e)))
+                return
+            for entry in entries:
+                self._apply([entry])
+            return
+
+        self.journal.remove([entry_id for entry_id, _ in entries])
+        for (entry_id, trade), status in zip(entries, statuses):
+            self.results.put(("applied", entry_id, trade, status))
+
+    def _run(self):
+        delay = self.retry_interval
+        while not self._stop.is_set():
+            entries = self.journal.pending(self.max_batch)
+            if not entries:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            try:
+                self._apply(entries)
+            except Exception as e:
+                if not self._transient(e):
+                    logging.exception(f"Could not apply {len(entries)} journaled trades")
+                    for entry_id, trade in entries:
+                        self.journal.mark_failed(entry_id, str(e))
+                        self.results.put(("failed", entry_id, trade, str(e)))
+                    continue
+                # The database couldn't be reached, so keep the trades and
+                # try again later
+                logging.warning(f"Could not apply {len(entries)} journaled trades, retrying in {delay:.1f}s: {e}")
+                self.results.put(("offline", None, None, str(e)))
+                self._wake.wait(delay)
+                self._wake.clear()
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+
+            delay = self.retry_interval
+            try:
+                positions = get_storage().fetch_positions(cost_basis())
+            except Exception as e:
+                # The trades are saved, the holdings are just shown as of the last refresh
+                if self._transient(e):
+                    logging.warning(f"Could not refresh the positions after saving trades: {e}")
+                else:
+                    logging.exception("Could not refresh the positions after saving trades")
+                continue
+            symbol_cache.warm(positions)
+            self.results.put(("positions", None, None, positions))
+
+    def _transient(self, error):
+        # A pool with no free connection is as good as an unreachable database
+        if isinstance(error, TimeoutError):
+            return True
+        storage = _storage
+        return storage is not None and isinstance(error, storage.errors) and storage.is_transient(error)
+
+
+def log_pool_stats():
+
+    """
+    Logs the connection pool counters, showing how many connects were avoided
+    """
+
+    if _storage is None:
+        return
+    stats = _storage.pool.stats
+    logging.info(
+        f"Connection pool: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['waits']} waits ({stats['wait_time']:.3f}s), "
+        f"{stats['connect_time']:.3f}s connecting, {stats['reconnects']} reconnects, "
+        f"{stats['evicted']} evicted"
+    )
+
+
+def pool_stats():
+
+    """
+    Returns a copy of the connection pool counters, or None if no connection
+    has been made yet
+    """
+
+    if _storage is None:
+        return None
+    return dict(_storage.pool.stats)
+
+
+def close_connection_pool():
+
+    """
+    Logs the pool counters and closes the idle connections, called on shutdown
+    """
+
+    if _storage is None:
+        return
+    log_pool_stats()
+    _storage.pool.close_all()
+
+
+# CoinMarketCap API
+
+def get_api_key():
+    return os.getenv('API_KEY')
+
+
+def base_currency():
+
+    """
+    The currency quotes are fetched in, and that trade costs are entered and
+    stored in. Set with BASE_CURRENCY, GBP by default.
+    """
+
+    return os.getenv('BASE_CURRENCY', 'GBP').upper()
+
+
+CURRENCY_SIGNS = {"GBP": "£", "USD": "$", "EUR": "€", "JPY": "¥", "AUD": "A$", "CAD": "C$", "INR": "₹"}
+
+
+def currency_sign(currency):
+    return CURRENCY_SIGNS.get(currency, f"{currency} ")
+
+
+class CoinMarketCapClient:
+
+    """
+    Talks to the CoinMarketCap API over one keep-alive session, so repeated
+    refreshes reuse the TLS connection instead of handshaking every time.
+
+    Every request has a timeout. Connection errors, timeouts, 429s and 5xx
+    responses are retried with exponential backoff and full jitter, and a 429
+    waits at least as long as its Retry-After header asks.
+
+    CoinMarketCap bills each call in credits, reported in status.credit_count.
+    These are added up per UTC day, which is when CoinMarketCap resets its
+    daily count, and once daily_credit_budget is spent further requests are
+    refused until the next day. The count is synced from /v1/key/info, which
+    costs no credits, on first use so a restart doesn't forget what was spent.
+
+    The last reserve credits of the budget are kept for quotes. Once fewer
+    than that are left, the deferrable calls (market listings and exchange
+    rates) are refused first, so held prices stay fresh the longest.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    DEFERRABLE_OPERATIONS = {"fetch_all_listings", "fetch_fx_rate", "fiat_map"}
+
+    def __init__(self, api_key, base_url=None, timeout=10, retries=3, backoff=1.0, max_backoff=30,
+                 daily_credit_budget=None, pool_size=4, reserve=0):
+        self.api_key = api_key
+        self.base_url = base_url or os.getenv('CMC_API_URL', 'https://pro-api.coinmarketcap.com')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.daily_credit_budget = daily_credit_budget
+        self.pool_size = pool_size
+        self.reserve = reserve
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "throttled": 0, "credits_today": 0}
+        self._day = None
+        self._synced = False
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+
+                session = requests.Session()
+                # One pooled connection per fetch thread
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    'X-CMC_PRO_API_KEY': self.api_key,
+                    'Accept': 'application/json',
+                    'Accept-Encoding': 'gzip, deflate',
+                })
+                self._session = session
+            return self._session
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _roll_day(self):
+        # Called with the lock held
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        if today != self._day:
+            self._day = today
+            self.stats["credits_today"] = 0
+
+    def credits_left(self):
+
+        """
+        Returns how many credits are left in today's budget, or None if there
+        is no budget
+        """
+
+        if self.daily_credit_budget is None:
+            return None
+        with self._lock:
+            self._roll_day()
+            return max(0, self.daily_credit_budget - self.stats["credits_today"])
+
+    def _sync_usage(self):
+        self._synced = True
+        key_info = self._request("/v1/key/info", {}, "key_info")
+        try:
+            used = key_info["data"]["usage"]["current_day"]["credits_used"]
+        except (TypeError, KeyError):
+            return
+        with self._lock:
+            self._roll_day()
+            self.stats["credits_today"] = max(self.stats["credits_today"], used)
+
+    def _delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            delay = max(delay, float(response.headers["Retry-After"]))
+        return delay
+
+    def _request(self, path, parameters, operation):
+        import requests
+
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                self._count("requests")
+                response = session.get(f"{self.base_url}{path}", params=parameters, timeout=(3.05, self.timeout))
+                registry.observe("folio_api_response_bytes", operation, len(response.content), SIZE_BUCKETS)
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in self.RETRY_STATUSES:
+                    logging.error(f"CoinMarketCap {operation} failed with status code {response.status_code}")
+                    break
+                error = f"status code {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                error = e
+            except ValueError as e:
+                logging.error(f"Could not decode the CoinMarketCap {operation} response: {e}")
+                break
+
+            if attempt < self.retries:
+                delay = self._delay(attempt, response)
+                logging.warning(f"CoinMarketCap {operation} failed ({error}), retrying in {delay:.1f}s")
+                self._count("retries")
+                registry.increment("folio_api_retries_total", operation)
+                time.sleep(delay)
+            else:
+                logging.error(f"CoinMarketCap {operation} failed: {error}")
+
+        self._count("failures")
+        return None
+
+    def get(self, path, parameters, operation):
+
+        """
+        GETs an endpoint and returns the decoded JSON, or None if it failed
+        after retrying or today's credit budget has been spent
+        """
+
+        if self.daily_credit_budget is not None:
+            if not self._synced:
+                self._sync_usage()
+            left = self.credits_left()
+            if left <= 0 or (operation in self.DEFERRABLE_OPERATIONS and left <= self.reserve):
+                self._count("throttled")
+                registry.increment("folio_api_throttled_total", operation)
+                if left <= 0:
+                    logging.warning(f"Daily CoinMarketCap credit budget of {self.daily_credit_budget} spent, not fetching {operation}")
+                else:
+                    logging.warning(f"Only {left} CoinMarketCap credits left today, keeping them for quotes, not fetching {operation}")
+                return None
+
+        api_data = self._request(path, parameters, operation)
+        if api_data is not None:
+            credits = api_data.get("status", {}).get("credit_count", 0) or 0
+            with self._lock:
+                self._roll_day()
+                self.stats["credits_today"] += credits
+            registry.increment("folio_api_credits_total", operation, credits)
+        return api_data
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+def get_api_client(api_key):
+
+    """
+    Returns the API client shared by all the fetch helpers, creating it on
+    first use. Timeouts, retries and the daily credit budget can be set in
+    the .env file, CMC_DAILY_CREDIT_BUDGET=0 turns the budget off.
+    """
+
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None or _api_client.api_key != api_key:
+            # 333 a day is the free plan's 10,000 credits a month. The GUI's
+            # default refreshes spend about 278 of it, see the intervals in
+            # main.py, and the last CMC_QUOTE_RESERVE credits (about six
+            # hours of held-coin quotes) are kept for quotes only.
+            budget = int(os.getenv('CMC_DAILY_CREDIT_BUDGET', '333'))
+            _api_client = CoinMarketCapClient(
+                api_key,
+                timeout=float(os.getenv('CMC_TIMEOUT', '10')),
+                retries=int(os.getenv('CMC_RETRIES', '3')),
+                backoff=float(os.getenv('CMC_BACKOFF', '1')),
+                daily_credit_budget=budget or None,
+                reserve=int(os.getenv('CMC_QUOTE_RESERVE', '60')),
+            )
+        return _api_client
+
+
+def set_api_client(client):
+
+    """
+    Replaces the shared API client, e.g. with one pointed at a local stand-in
+    for benchmarks. Returns the client it replaced.
+    """
+
+    global _api_client
+    with _api_client_lock:
+        previous, _api_client = _api_client, client
+    return previous
+
+
+def api_client_stats():
+
+    """
+    Returns a copy of the API client counters, or None if no request has been
+    made yet
+    """
+
+    if _api_client is None:
+        return None
+    stats = dict(_api_client.stats)
+    if _api_client.daily_credit_budget is not None:
+        stats["credits_left"] = _api_client.credits_left()
+    return stats
+
+
+def close_api_client():
+    if _api_client is not None:
+        _api_client.close()
+
+
+# Per request limits of the CoinMarketCap endpoints used below
+QUOTES_BATCH_SIZE = 100
+LISTINGS_PAGE_SIZE = 5000
+
+
+def _cmc_get(path, api_key, parameters, operation):
+    return get_api_client(api_key).get(path, parameters, operation)
+
+
+@timed("fetch_api_data", size=lambda api_data: len(api_data["data"]))
+def fetch_api_data(api_key):
+    """
+    Fetches data from CoinMarketCap API.
+    """
+
+    parameters = {
+        'start': '1',
+        'limit': '200',
+        'convert': base_currency()
+    }
+    return _cmc_get("/v1/cryptocurrency/listings/latest", api_key, parameters, "fetch_api_data")
+
+
+def _fetch_concurrently(function, items, workers):
+
+    """
+    Calls function on every item using at most workers threads and returns
+    the results in the order of items
+    """
+
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix="cmc-fetch") as executor:
+        return list(executor.map(function, items))
+
+
+@timed("fetch_quotes", size=lambda api_data: len(api_data["data"]))
+def fetch_quotes(api_key, symbols=(), ids=(), currency=None, batch_size=QUOTES_BATCH_SIZE, workers=4):
+
+    """
+    Fetches quotes for just the given symbols and CoinMarketCap ids from the
+    quotes/latest endpoint, so coins held outside the top 200 are priced too
+    and we only pay for the coins we hold.
+
+    Requests are split into batches of batch_size and sent concurrently on at
+    most workers threads. The result has the same shape as a listings
+    response, {"data": [listing, ...]} in market cap order, so it can be given
+    straight to PriceBook. Prices are in currency, the base currency by
+    default. Returns None if any batch failed, so a partial response never
+    replaces a complete one.
+    """
+
+    currency = currency or base_currency()
+    symbols = sorted({symbol.upper() for symbol in symbols})
+    ids = sorted({str(crypto_id) for crypto_id in ids})
+    requests_to_send = [("symbol", symbols[start:start + batch_size]) for start in range(0, len(symbols), batch_size)]
+    requests_to_send += [("id", ids[start:start + batch_size]) for start in range(0, len(ids), batch_size)]
+    if not requests_to_send:
+        return {"status": {}, "data": []}
+
+    def fetch(request):
+        key, batch = request
+        return _cmc_get("/v2/cryptocurrency/quotes/latest", api_key, {key: ",".join(batch), 'convert': currency}, "fetch_quotes")
+
+    responses = _fetch_concurrently(fetch, requests_to_send, workers)
+    if any(response is None for response in responses):
+        return None
+
+    # quotes/latest returns a dict keyed by symbol or id. A symbol can map to
+    # a list of coins sharing it, an id maps to a single coin.
+    listings = {}
+    for response in responses:
+        for found in response.get("data", {}).values():
+            for listing in found if isinstance(found, list) else [found]:
+                if listing.get("quote", {}).get(currency, {}).get("price") is not None:
+                    listings[listing["id"]] = listing
+
+    ordered = sorted(listings.values(), key=lambda listing: (listing.get("cmc_rank") is None, listing.get("cmc_rank") or 0))
+    return {"status": responses[0].get("status", {}), "data": ordered}
+
+
+@timed("fetch_all_listings", size=lambda api_data: len(api_data["data"]))
+def fetch_all_listings(api_key, limit=None, currency=None, page_size=LISTINGS_PAGE_SIZE, workers=4):
+
+    """
+    Fetches the whole market, or its top limit coins, from listings/latest
+    one page at a time. The first page tells us how many coins there are, and
+    the remaining pages are then fetched concurrently. Used by the price
+    checker, which has to find coins that aren't held. Returns None if any
+    page failed.
+    """
+
+    currency = currency or base_currency()
+    def fetch(start):
+        count = page_size if limit is None else min(page_size, limit - start + 1)
+        parameters = {'start': str(start), 'limit': str(count), 'convert': currency}
+        return _cmc_get("/v1/cryptocurrency/listings/latest", api_key, parameters, "fetch_all_listings")
+
+    first = fetch(1)
+    if first is None:
+        return None
+    total = first.get("status", {}).get("total_count", len(first["data"]))
+    if limit is not None:
+        total = min(total, limit)
+
+    pages = _fetch_concurrently(fetch, list(range(1 + page_size, total + 1, page_size)), workers)
+    if any(page is None for page in pages):
+        return None
+
+    data = list(first["data"])
+    for page in pages:
+        data.extend(page["data"])
+    return {"status": first.get("status", {}), "data": data}
+
+
+class PriceBook:
+
+    """
+    Index over one CoinMarketCap listings response so listings can be looked
+    up by ticker without scanning the whole list.
+
+    Tickers are not unique on CoinMarketCap. The listings are in market cap
+    order, so get() returns the highest ranked listing for a ticker.
+    """
+
+    def __init__(self, api_data):
+        self.listings = api_data["data"] if api_data else []
+        self._by_symbol = {}
+        self._rank = {}
+
+        for rank, listing in enumerate(self.listings):
+            self._by_symbol.setdefault(listing["symbol"], listing)
+            self._rank[listing["id"]] = rank
+
+    def __len__(self):
+        return len(self.listings)
+
+    def __contains__(self, symbol):
+        return symbol in self._by_symbol
+
+    def get(self, symbol):
+        return self._by_symbol.get(symbol)
+
+    def rank(self, listing):
+        return self._rank[listing["id"]]
+
+
+# CoinMarketCap ids of fiat currencies. The common ones are known, the rest
+# are filled in from /v1/fiat/map the first time one is asked for.
+FIAT_IDS = {"USD": 2781, "EUR": 2790, "GBP": 2791}
+_fiat_map_loaded = False
+_fiat_ids_lock = threading.Lock()
+
+
+def fiat_id(api_key, currency):
+
+    """
+    Returns CoinMarketCap's id for a fiat currency, or None if it isn't one
+    """
+
+    global _fiat_map_loaded
+    with _fiat_ids_lock:
+        if currency in FIAT_IDS or _fiat_map_loaded:
+            return FIAT_IDS.get(currency)
+        response = _cmc_get("/v1/fiat/map", api_key, {'limit': '5000'}, "fiat_map")
+        if response is None:
+            return None
+        for fiat in response.get("data") or []:
+            FIAT_IDS.setdefault(fiat["symbol"], fiat["id"])
+        _fiat_map_loaded = True
+        return FIAT_IDS.get(currency)
+
+
+@timed("fetch_fx_rate")
+def fetch_fx_rate(api_key, currency, base=None):
+
+    """
+    Fetches how much one unit of the base currency is worth in currency,
+    from CoinMarketCap's price conversion tool. Returns None on failure.
+
+    The base is converted by its fiat id rather than its ticker, as a
+    ticker lookup can also match tokens that share a fiat currency's code.
+    """
+
+    base = base or base_currency()
+    base_id = fiat_id(api_key, base)
+    if base_id is None:
+        logging.warning(f"{base} is not a fiat currency CoinMarketCap knows, no exchange rates for it")
+        return None
+    response = _cmc_get("/v2/tools/price-conversion", api_key, {'amount': '1', 'id': str(base_id), 'convert': currency}, "fetch_fx_rate")
+    if response is None:
+        return None
+    data = response.get("data")
+    if isinstance(data, list):
+        data = next((match for match in data if match.get("id") == base_id), None)
+    try:
+        if data["id"] != base_id:
+            raise KeyError("id")
+        return float(data["quote"][currency]["price"])
+    except (TypeError, KeyError, ValueError):
+        logging.warning(f"No {base} to {currency} rate in the price conversion response")
+        return None
+
+
+class FXRates:
+
+    """
+    Exchange rates from the base currency to the display currencies, cached
+    separately from the quotes with their own TTL. Quotes only ever need
+    fetching in the base currency, and switching the display currency
+    costs at most one conversion call, not a refetch of the listings.
+
+    Every rate is from the base currency. An expired rate is still used if a
+    fresh one can't be fetched.
+    """
+
+    def __init__(self, api_key, base=None, ttl=21600, fetch=None):
+        self.base = base or base_currency()
+        self.ttl = ttl
+        self.fetch = fetch if fetch is not None else lambda currency: fetch_fx_rate(api_key, currency, self.base)
+        self.cache = TTLCache(ttl)
+
+    def _fetch(self, currency):
+        rate = self.fetch(currency)
+        if rate is not None:
+            self.cache.set(currency, rate)
+        return rate
+
+    def rate(self, currency):
+
+        """
+        Returns the rate from the base currency to currency, fetching it if
+        it has expired, or None if there has never been one
+        """
+
+        currency = currency.upper()
+        if currency == self.base:
+            return 1.0
+        rate = self.cache.get(currency)
+        if rate is None:
+            rate = self._fetch(currency)
+        if rate is None:
+            rate, _ = self.cache.get_with_time(currency)
+        return rate
+
+    def refresh(self, currencies):
+
+        """
+        Fetches every rate again, for a background refresher, and returns a
+        {currency: rate} table of the ones that are known
+        """
+
+        table = {self.base: 1.0}
+        for currency in currencies:
+            currency = currency.upper()
+            if currency == self.base:
+                continue
+            rate = self._fetch(currency)
+            if rate is None:
+                # Keep showing the last rate, without fetching it a second time
+                rate, _ = self.cache.get_with_time(currency)
+            if rate is not None:
+                table[currency] = rate
+        return table
+
+
+class SearchIndex:
+
+    """
+    Finds coins by ticker or name as the user types. It is built once per
+    price snapshot.
+
+    Prefix matches come from sorted lists of lower case tickers and name
+    words, searched with bisect. Typos are caught by a trigram index, where
+    each query trigram's posting list gives every listing that shares it and
+    listings are scored by how many trigrams they share. Ties go to the
+    higher market cap.
+    """
+
+    # Trigrams found in more than this share of listings (e.g. "coi" in every
+    # "... Coin") say little about a match and cost a lot to count
+    COMMON_TRIGRAM_SHARE = 0.1
+
+    # A prefix matching more than this many times the listings asked for is
+    # answered by walking the listings in rank order instead
+    SCAN_FACTOR = 20
+
+    def __init__(self, listings):
+        self.listings = []
+        seen = set()
+        for listing in sorted(listings, key=lambda listing: listing.get("cmc_rank") or float("inf")):
+            if listing["id"] not in seen:
+                seen.add(listing["id"])
+                self.listings.append(listing)
+
+        symbols = []
+        names = []
+        self._symbol_words = []
+        self._name_words = []
+        self._trigrams = {}
+        for position, listing in enumerate(self.listings):
+            symbol = listing["symbol"].lower()
+            name = listing["name"].lower()
+            words = [name] + name.split()[1:]
+            self._symbol_words.append((symbol,))
+            self._name_words.append(words)
+            symbols.append((symbol, position))
+            names.extend((word, position) for word in words)
+            for trigram in self._trigrams_of(symbol) | self._trigrams_of(name):
+                self._trigrams.setdefault(trigram, []).append(position)
+        symbols.sort()
+        names.sort()
+        self._symbol_keys = [key for key, _ in symbols]
+        self._symbol_positions = [position for _, position in symbols]
+        self._name_keys = [key for key, _ in names]
+        self._name_positions = [position for _, position in names]
+        self._common = max(50, int(len(self.listings) * self.COMMON_TRIGRAM_SHARE))
+
+    def __len__(self):
+        return len(self.listings)
+
+    @staticmethod
+    def _trigrams_of(text):
+        padded = f"  {text} "
+        return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+    def _prefixed(self, keys, positions, words, prefix, limit):
+        # Positions are ranks, so the smallest are the biggest coins
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + "\uffff", start)
+        if end - start <= self.SCAN_FACTOR * limit:
+            return heapq.nsmallest(limit, set(positions[start:end]))
+
+        # So many listings match that the first few in rank order are found
+        # sooner by walking them than by ranking every match
+        found = []
+        for position, listing_words in enumerate(words):
+            if any(word.startswith(prefix) for word in listing_words):
+                found.append(position)
+                if len(found) == limit:
+                    break
+        return found
+
+    def prefix(self, query, limit=10):
+
+        """
+        Returns up to limit listings whose ticker, name or a word of the name
+        starts with query. Ticker matches come first and an exact ticker
+        comes before everything else.
+        """
+
+        query = query.strip().lower()
+        if not query:
+            return []
+        found = self._prefixed(self._symbol_keys, self._symbol_positions, self._symbol_words, query, limit)
+        found.sort(key=lambda position: (self.listings[position]["symbol"].lower() != query, position))
+        if len(found) < limit:
+            chosen = set(found)
+            found += [position for position in self._prefixed(self._name_keys, self._name_positions, self._name_words, query, limit)
+                      if position not in chosen][:limit - len(found)]
+        return [self.listings[position] for position in found]
+
+    def fuzzy(self, query, limit=10, exclude=()):
+
+        """
+        Returns up to limit listings sharing the most trigrams with query,
+        leaving out the ids in exclude
+        """
+
+        grams = self._trigrams_of(query.strip().lower())
+        postings = [self._trigrams[gram] for gram in grams if gram in self._trigrams]
+        rare = [posting for posting in postings if len(posting) <= self._common]
+        scores = Counter()
+        for posting in rare or postings:
+            scores.update(posting)
+        # Need more than the padding trigrams in common to count as a match
+        minimum = max(2, len(grams) // 3)
+        best = heapq.nsmallest(limit + len(exclude), ((-score, position) for position, score in scores.items() if score >= minimum))
+        return [self.listings[position] for _, position in best if self.listings[position]["id"] not in exclude][:limit]
+
+    def search(self, query, limit=10):
+
+        """
+        Prefix matches first, topped up with fuzzy matches for queries of three
+        or more characters
+        """
+
+        found = self.prefix(query, limit)
+        if len(found) < limit and len(query.strip()) >= 3:
+            found += self.fuzzy(query, limit - len(found), exclude={listing["id"] for listing in found})
+        return found
+
+
+class TTLCache:
+
+    """
+    Small thread safe cache where every entry expires ttl seconds after it
+    was stored
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def set(self, key, value, stored_at=None):
+        with self._lock:
+            self._entries[key] = (value, time.time() if stored_at is None else stored_at)
+
+    def get_with_time(self, key):
+
+        """
+        Returns (value, time stored) even if the entry has expired, or
+        (None, None) if nothing was ever stored
+        """
+
+        with self._lock:
+            return self._entries.get(key, (None, None))
+
+    def get(self, key):
+        value, stored_at = self.get_with_time(key)
+        if stored_at is None or time.time() - stored_at > self.ttl:
+            return None
+        return value
+
+    def is_fresh(self, key):
+        return self.get(key) is not None
+
+    def prune(self):
+
+        """
+        Drops the expired entries, for caches keyed by something unbounded
+        """
+
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for key in [key for key, (_, stored_at) in self._entries.items() if stored_at < cutoff]:
+                del self._entries[key]
+
+
+class PriceRefresher:
+
+    """
+    Polls the CoinMarketCap API on a background thread so the Tk mainloop
+    never waits on the network.
+
+    Every good response is stored in the TTL cache and put on the updates
+    queue as (api_data, fetched_at). fetch is called with no arguments to get
+    a response, and defaults to fetch_api_data(api_key). Tk widgets must only be touched from the
+    Tk thread, so the GUI drains the queue from a win.after callback.
+    """
+
+    CACHE_KEY = "listings"
+
+    def __init__(self, api_key, interval=300, cache=None, store=None, fetch=None, name="price-refresher"):
+        self.api_key = api_key
+        self.fetch = fetch if fetch is not None else lambda: fetch_api_data(api_key)
+        self.interval = interval
+        self.cache = cache if cache is not None else TTLCache(ttl=interval * 2)
+        self.store = store
+        self.updates = queue.Queue()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def refresh_now(self):
+
+        """
+        Asks the background thread to fetch straight away instead of waiting
+        for the next interval
+        """
+
+        self._wake.set()
+
+    def _run(self):
+        # If the cache was seeded from disk with a recent snapshot, don't spend
+        # API credits on it until it is actually due for a refresh
+        _, fetched_at = self.cache.get_with_time(self.CACHE_KEY)
+        if fetched_at is not None:
+            self._wake.wait(max(0, self.interval - (time.time() - fetched_at)))
+            self._wake.clear()
+
+        while not self._stop.is_set():
+            api_data = self.fetch()
+            if api_data is not None:
+                fetched_at = time.time()
+                self.cache.set(self.CACHE_KEY, api_data, fetched_at)
+                self.updates.put((api_data, fetched_at))
+                if self.store is not None:
+                    self.store.save(api_data, fetched_at)
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+class SnapshotStore:
+
+    """
+    Keeps the last good API response in a local SQLite file so the app can
+    start, and keep working offline, without waiting for CoinMarketCap.
+
+    The response is stored as zlib compressed JSON together with the time it
+    was fetched. The schema version is kept in PRAGMA user_version, and a file
+    written by a different version is discarded rather than misread.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS snapshot")
+            connection.execute("""
+                CREATE TABLE snapshot (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    fetched_at REAL NOT NULL,
+                    payload BLOB NOT NULL
+                )
+            """)
+            connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            connection.commit()
+        return connection
+
+    def load(self):
+
+        """
+        Returns (api_data, fetched_at) for the saved snapshot, or (None, None)
+        if there isn't a usable one
+        """
+
+        try:
+            with self._lock:
+                connection = self._connect()
+                try:
+                    row = connection.execute("SELECT fetched_at, payload FROM snapshot WHERE id = 1").fetchone()
+                finally:
+                    connection.close()
+            if row is None:
+                return None, None
+            fetched_at, payload = row
+            return json.loads(zlib.decompress(payload)), fetched_at
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            logging.warning(f"Ignoring unreadable price cache {self.path}: {e}")
+            return None, None
+
+    def save(self, api_data, fetched_at):
+        payload = zlib.compress(json.dumps(api_data, separators=(",", ":")).encode("utf-8"))
+        try:
+            with self._lock:
+                connection = self._connect()
+                try:
+                    connection.execute("INSERT OR REPLACE INTO snapshot (id, fetched_at, payload) VALUES (1, ?, ?)", (fetched_at, payload))
+                    connection.commit()
+                finally:
+                    connection.close()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not save price cache {self.path}: {e}")
+
+
+# Valuation
+
+def portfolio_columns(coins, price_book, currency=None):
+
+    """
+    Lays the coins from fetch_coins out as column arrays for value_columns.
+
+    Returns (quantities, unit_costs, prices, ranks). prices is NaN for coins
+    the price book has no listing for, and ranks is the market cap position
+    of each coin's listing (len(price_book) if it isn't listed).
+    """
+
+    import numpy as np
+
+    currency = currency or base_currency()
+    count = len(coins)
+    quantities = np.empty(count)
+    unit_costs = np.empty(count)
+    prices = np.full(count, np.nan)
+    ranks = np.full(count, len(price_book), dtype=np.int64)
+
+    for index, coin in enumerate(coins):
+        quantities[index] = coin.quantity
+        unit_costs[index] = coin.unit_cost
+        listing = price_book.get(coin.symbol)
+        if listing is not None:
+            prices[index] = listing["quote"][currency]["price"]
+            ranks[index] = price_book.rank(listing)
+
+    return quantities, unit_costs, prices, ranks
+
+
+def value_columns(quantities, unit_costs, prices):
+
+    """
+    Values a whole portfolio in one vectorised pass over column arrays of
+    quantities, unit purchase prices and current prices.
+
+    A holding is only valued if it has a price, a quantity and a unit cost
+    (none of them NaN). Holdings that aren't valued get NaN in every derived
+    column and are left out of the totals. percentage_change is NaN where
+    the purchase cost is zero, and allocation is 0 if the portfolio has no
+    value, rather than dividing by zero.
+
+    Returns a dict of arrays (valued, current_value, purchase_cost,
+    profit_and_loss, percentage_change, allocation) and the totals
+    (total_value, total_cost, total_profit_and_loss).
+    """
+
+    import numpy as np
+
+    quantities = np.asarray(quantities, dtype=float)
+    unit_costs = np.asarray(unit_costs, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+
+    valued = ~(np.isnan(quantities) | np.isnan(unit_costs) | np.isnan(prices))
+
+    current_value = np.where(valued, prices * quantities, np.nan)
+    purchase_cost = np.where(valued, unit_costs * quantities, np.nan)
+    profit_and_loss = current_value - purchase_cost
+
+    percentage_change = np.full_like(profit_and_loss, np.nan)
+    np.divide(profit_and_loss, purchase_cost, out=percentage_change, where=valued & (purchase_cost != 0))
+    percentage_change *= 100
+
+    total_value = float(current_value[valued].sum())
+    total_cost = float(purchase_cost[valued].sum())
+
+    allocation = np.where(valued, 0.0, np.nan)
+    if total_value:
+        np.divide(current_value, total_value, out=allocation, where=valued)
+
+    return {
+        "valued": valued,
+        "current_value": current_value,
+        "purchase_cost": purchase_cost,
+        "profit_and_loss": profit_and_loss,
+        "percentage_change": percentage_change,
+        "allocation": allocation,
+        "total_value": total_value,
+        "total_cost": total_cost,
+        "total_profit_and_loss": total_value - total_cost,
+    }
+
+
+def value_portfolio(coins, price_book, currency=None, fx_rate=1.0):
+
+    """
+    Values each coin in "coins" (rows from fetch_coins) at the price in the
+    price book, using value_columns. Coins that can't be valued are left out.
+
+    Prices are read in currency, the base currency by default, which is also
+    the currency the costs are in. fx_rate converts both to the display
+    currency in one pass over the columns, from FXRates.rate.
+
+    Returns (holdings, total_portfolio_value, total_profit_and_loss), where
+    holdings is a list of dicts in market cap order with the coin row, its
+    listing, the current price and value, purchase cost, profit/loss,
+    percentage change and share of the total portfolio value.
+    """
+
+    import numpy as np
+
+    quantities, unit_costs, prices, ranks = portfolio_columns(coins, price_book, currency)
+    if fx_rate != 1.0:
+        unit_costs *= fx_rate
+        prices *= fx_rate
+    valuation = value_columns(quantities, unit_costs, prices)
+
+    valued = np.flatnonzero(valuation["valued"])
+    order = valued[np.argsort(ranks[valued], kind="stable")]
+
+    holdings = []
+    for index in order:
+        coin = coins[index]
+        holdings.append({
+            "coin": coin,
+            "listing": price_book.get(coin.symbol),
+            "current_price": float(prices[index]),
+            "current_value": float(valuation["current_value"][index]),
+            "purchase_cost": float(valuation["purchase_cost"][index]),
+            "profit_and_loss": float(valuation["profit_and_loss"][index]),
+            "percentage_change": float(valuation["percentage_change"][index]),
+            "allocation": float(valuation["allocation"][index]),
+        })
+
+    return holdings, valuation["total_value"], valuation["total_profit_and_loss"]
+
+
+def valuation_snapshot(coins, price_book, currency=None, valued_at=None, display_currency=None, fx_rate=1.0):
+
+    """
+    Values the portfolio with value_portfolio and returns it as a plain dict
+    that can be written out as JSON: the time it was valued (Unix seconds,
+    now by default), the currency, the totals, one dict per valued holding in
+    market cap order, and the tickers that had no price. Amounts are in
+    display_currency, converted from the quote currency at fx_rate.
+    """
+
+    currency = currency or base_currency()
+    holdings, total_value, total_profit_and_loss = value_portfolio(coins, price_book, currency, fx_rate)
+    rows = []
+    for holding in holdings:
+        coin = holding["coin"]
+        rows.append({
+            "crypto_id": coin.crypto_id,
+            "symbol": coin.symbol,
+            "name": coin.name,
+            "cmc_rank": holding["listing"].get("cmc_rank"),
+            "quantity": coin.quantity,
+            "unit_cost": coin.unit_cost * fx_rate,
+            "current_price": holding["current_price"],
+            "current_value": holding["current_value"],
+            "purchase_cost": holding["purchase_cost"],
+            "profit_and_loss": holding["profit_and_loss"],
+            # NaN (bought for nothing) isn't valid JSON
+            "percentage_change": None if math.isnan(holding["percentage_change"]) else holding["percentage_change"],
+            "allocation": holding["allocation"],
+        })
+
+    return {
+        "valued_at": time.time() if valued_at is None else valued_at,
+        "currency": display_currency or currency,
+        "base_currency": currency,
+        "fx_rate": fx_rate,
+        "cost_basis": cost_basis(),
+        "total_value": total_value,
+        "total_cost": total_value - total_profit_and_loss,
+        "total_profit_and_loss": total_profit_and_loss,
+        "holdings": rows,
+        "unpriced": [coin.symbol for coin in coins if coin.symbol not in price_book],
+    }
+
+
+def pie_slices(labels, sizes, max_slices=10, min_share=0.02, other="Other"):
+
+    """
+    Cuts a portfolio down to a pie chart that stays readable, and cheap to
+    draw, however many coins are held. Keeps the biggest slices, at most
+    max_slices including "Other", and folds every slice smaller than
+    min_share of the total into "Other". Returns (labels, sizes), biggest
+    first, with "Other" last.
+    """
+
+    slices = [(size, label) for label, size in zip(labels, sizes) if size > 0 and size == size]
+    total = sum(size for size, _ in slices)
+    if not total:
+        return [], []
+
+    keep = max_slices if len(slices) <= max_slices else max_slices - 1
+    kept = [(size, label) for size, label in heapq.nlargest(keep, slices) if size >= min_share * total]
+    if len(kept) < len(slices):
+        kept.append((total - sum(size for size, _ in kept), other))
+    return [label for _, label in kept], [size for size, _ in kept]
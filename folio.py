@@ -0,0 +1,295 @@
+"""
+Headless Folio: values the portfolio without the Tk window, for cron jobs,
+systemd services and servers with no display.
+
+    python -m folio value                       value once, print the snapshot as JSON
+    python -m folio value --json v.json --csv v.csv
+                                                value once, write the snapshot files
+    python -m folio daemon --interval 60 --json latest.json --csv latest.csv --history valuations.jsonl
+                                                value every 60 seconds until stopped
+    python -m folio serve --port 8765           serve the portfolio over HTTP, see http_api.py
+
+Holdings come from fetch_coins and prices from quotes/latest for the held
+tickers, and are valued with the same code as the GUI. Snapshot files are
+replaced atomically, so a reader never sees half of one, and --history
+appends one JSON line per valuation. The database pool and the
+CoinMarketCap session are opened once and reused for the life of the
+process. Settings are read from the .env file like the GUI.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import engine
+from alerts import AlertBook, AlertStore, log_sink
+from http_api import APIServer, PortfolioSnapshot, QuoteCache
+from instrumentation import export_prometheus
+
+
+CSV_FIELDS = ["valued_at", "currency", "crypto_id", "symbol", "name", "cmc_rank", "quantity", "unit_cost", "current_price",
+              "current_value", "purchase_cost", "profit_and_loss", "percentage_change", "allocation"]
+
+
+class ValuationError(Exception):
+    pass
+
+
+def read_holdings():
+
+    """
+    Returns the holdings from fetch_coins, or raises ValuationError if they
+    couldn't be read, rather than passing on an empty list
+    """
+
+    errors = []
+    engine.set_error_handler(errors.append)
+    coins = engine.fetch_coins()
+    if errors:
+        raise ValuationError(f"Could not read holdings: {errors[0]}")
+    return coins
+
+
+def fetch_prices(api_key, coins):
+    # One batch per 100 tickers, sent one after another over the shared session
+    api_data = engine.fetch_quotes(api_key, symbols=[coin.symbol for coin in coins], workers=1)
+    if api_data is None:
+        raise ValuationError("Could not fetch prices from CoinMarketCap")
+    return api_data
+
+
+def value_once(api_key, alert_book=None, fx_rates=None, currency=None):
+
+    """
+    Fetches the holdings and their prices and returns a valuation snapshot,
+    checking the alert rules against the prices if an alert book is given.
+    With a currency, amounts are converted from the base currency at the
+    rate from fx_rates. Raises ValuationError rather than returning a
+    snapshot built from an empty or partial read, so a failed run never
+    overwrites a good file.
+    """
+
+    fx_rate = 1.0
+    if currency is not None:
+        fx_rate = fx_rates.rate(currency)
+        if fx_rate is None:
+            raise ValuationError(f"Could not fetch an exchange rate for {currency}")
+
+    coins = read_holdings()
+    price_book = engine.PriceBook(fetch_prices(api_key, coins))
+    if alert_book is not None:
+        alert_book.check(coins, price_book)
+    return engine.valuation_snapshot(coins, price_book, display_currency=currency, fx_rate=fx_rate)
+
+
+def replace_file(path, write):
+
+    """
+    Calls write with a file open on a temporary path next to path, then
+    moves it into place
+    """
+
+    temporary = path + ".tmp"
+    with open(temporary, "w", newline="", encoding="utf-8") as file:
+        write(file)
+    os.replace(temporary, path)
+
+
+def write_json(path, snapshot):
+    replace_file(path, lambda file: json.dump(snapshot, file, indent=2))
+
+
+def write_csv(path, snapshot):
+    def write(file):
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for holding in snapshot["holdings"]:
+            writer.writerow({"valued_at": snapshot["valued_at"], "currency": snapshot["currency"], **holding})
+
+    replace_file(path, write)
+
+
+def append_history(path, snapshot):
+    totals = {key: value for key, value in snapshot.items() if key != "holdings"}
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(totals) + "\n")
+
+
+def export(snapshot, args):
+
+    """
+    Writes the snapshot wherever the command line asked. Returns False if no
+    file was asked for.
+    """
+
+    written = False
+    if args.json:
+        write_json(args.json, snapshot)
+        written = True
+    if args.csv:
+        write_csv(args.csv, snapshot)
+        written = True
+    if getattr(args, "history", None):
+        append_history(args.history, snapshot)
+        written = True
+    return written
+
+
+def currency_rates(api_key, args):
+    if args.currency is None:
+        return None
+    return engine.FXRates(api_key, ttl=float(os.getenv('FX_RATE_TTL', '21600')))
+
+
+def value_command(api_key, args):
+    try:
+        snapshot = value_once(api_key, fx_rates=currency_rates(api_key, args), currency=args.currency)
+    except ValuationError as e:
+        logging.error(e)
+        return 1
+
+    if not export(snapshot, args):
+        json.dump(snapshot, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return 0
+
+
+def stop_on_signals():
+    stop = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop.set())
+    return stop
+
+
+def daemon_command(api_key, args):
+
+    """
+    Values the portfolio every interval seconds, measured from the start of
+    each run, until SIGINT or SIGTERM. A failed run is logged and the next
+    one goes ahead as planned. With --alerts, the alert rules set up in the
+    GUI are checked on every run and fired alerts are logged.
+    """
+
+    alert_book = AlertBook(AlertStore(os.getenv('ALERTS_PATH', 'alerts.db')), sinks=[log_sink]) if args.alerts else None
+    # Rates are cached for FX_RATE_TTL, so most runs don't fetch one
+    fx_rates = currency_rates(api_key, args)
+    stop = stop_on_signals()
+    failures = 0
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            snapshot = value_once(api_key, alert_book, fx_rates, args.currency)
+            export(snapshot, args)
+            failures = 0
+            logging.info(f"Valued {len(snapshot['holdings'])} holdings at {snapshot['total_value']:.2f} {snapshot['currency']}")
+        except ValuationError as e:
+            failures += 1
+            logging.warning(f"Valuation failed ({failures} in a row): {e}")
+        except OSError as e:
+            failures += 1
+            logging.warning(f"Could not write the valuation ({failures} in a row): {e}")
+
+        stop.wait(max(0.0, args.interval - (time.monotonic() - started)))
+    return 0
+
+
+def serve_command(api_key, args):
+
+    """
+    Serves the HTTP API until SIGINT or SIGTERM. The positions are read every
+    --positions-interval seconds, which is one cheap query. Prices are
+    fetched every --interval seconds, or straight away when a coin that
+    wasn't asked for last time turns up, so however many clients there are, CoinMarketCap is
+    only asked that often.
+    """
+
+    snapshot = PortfolioSnapshot()
+    server = APIServer((args.host, args.port), snapshot, QuoteCache(api_key, ttl=args.interval))
+    threading.Thread(target=server.serve_forever, name="http-api", daemon=True).start()
+    logging.info(f"Serving the portfolio on http://{args.host}:{server.server_address[1]}")
+
+    stop = stop_on_signals()
+    api_data = fetched_at = None
+    priced = set()
+    while not stop.is_set():
+        try:
+            coins = read_holdings()
+            held = {coin.symbol for coin in coins}
+            if api_data is None or time.time() - fetched_at >= args.interval or not held <= priced:
+                api_data, fetched_at = fetch_prices(api_key, coins), time.time()
+                priced = held
+            if snapshot.update(coins, api_data, fetched_at):
+                logging.info(f"Snapshot rebuilt for {len(coins)} holdings")
+        except ValuationError as e:
+            logging.warning(f"Could not refresh the snapshot, serving the last one: {e}")
+        stop.wait(args.positions_interval)
+
+    server.shutdown()
+    server.server_close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="folio", description="Value the Folio portfolio without the GUI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    value_parser = commands.add_parser("value", help="value the portfolio once; prints JSON unless an output file is given")
+    daemon_parser = commands.add_parser("daemon", help="value the portfolio every --interval seconds until stopped")
+    daemon_parser.add_argument("--interval", type=float, default=float(os.getenv('FOLIO_DAEMON_INTERVAL', '300')),
+                               help="seconds between valuations (default FOLIO_DAEMON_INTERVAL or 300)")
+    daemon_parser.add_argument("--history", help="JSON lines file to append each valuation's totals to")
+    daemon_parser.add_argument("--alerts", action="store_true", help="check the alert rules in ALERTS_PATH and log the alerts that fire")
+    for command_parser in (value_parser, daemon_parser):
+        command_parser.add_argument("--json", help="write the snapshot to this JSON file")
+        command_parser.add_argument("--csv", help="write the holdings to this CSV file, one row per coin")
+        command_parser.add_argument("--currency", type=str.upper,
+                                    help="currency to report in, converted from BASE_CURRENCY at a cached exchange rate")
+
+    serve_parser = commands.add_parser("serve", help="serve /positions, /valuation and /prices/{symbol} over HTTP")
+    serve_parser.add_argument("--host", default=os.getenv('FOLIO_API_HOST', '127.0.0.1'),
+                              help="address to listen on (default FOLIO_API_HOST or 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=int(os.getenv('FOLIO_API_PORT', '8765')),
+                              help="port to listen on (default FOLIO_API_PORT or 8765)")
+    serve_parser.add_argument("--interval", type=float, default=float(os.getenv('PRICE_REFRESH_INTERVAL', '360')),
+                              help="seconds between price fetches (default PRICE_REFRESH_INTERVAL or 360)")
+    serve_parser.add_argument("--positions-interval", type=float, default=float(os.getenv('FOLIO_API_POSITIONS_INTERVAL', '15')),
+                              help="seconds between reads of the positions (default FOLIO_API_POSITIONS_INTERVAL or 15)")
+
+    args = parser.parse_args(argv)
+    if args.command in ("daemon", "serve") and args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.command == "serve" and args.positions_interval <= 0:
+        parser.error("--positions-interval must be positive")
+
+    api_key = engine.get_api_key()
+    if not api_key:
+        logging.error("API key is missing.")
+        return 1
+
+    try:
+        if args.command == "value":
+            return value_command(api_key, args)
+        if args.command == "serve":
+            return serve_command(api_key, args)
+        return daemon_command(api_key, args)
+    finally:
+        engine.close_api_client()
+        engine.close_connection_pool()
+        if os.getenv('FOLIO_METRICS_PATH'):
+            export_prometheus(os.getenv('FOLIO_METRICS_PATH'))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=os.getenv('FOLIO_LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(message)s")
+    # Database reads run one at a time, so one pooled connection is all they need
+    os.environ.setdefault('DATABASE_POOL_SIZE', '1')
+    sys.exit(main())
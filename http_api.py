@@ -0,0 +1,260 @@
+"""
+Read-only HTTP API over one shared view of the portfolio, so several people
+can watch it without each running the GUI against the database and
+CoinMarketCap.
+
+    GET /positions          the holdings from fetch_coins
+    GET /valuation          the valuation snapshot, as python -m folio value writes it
+    GET /prices/{symbol}    the latest quote for a ticker
+
+Every response is served from memory. The JSON bodies are rebuilt only when
+the positions or the prices actually change, and each body has an ETag, so a
+client that sends If-None-Match gets a bodiless 304 until there is something
+new. Prices for tickers that aren't held are fetched on demand and cached,
+and paths that can't be a ticker are turned away without asking
+CoinMarketCap.
+Started by python -m folio serve.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import engine
+
+
+def json_response(document):
+
+    """
+    Serialises document and returns (etag, body). The ETag is a hash of the
+    body, so the same content always gets the same tag.
+    """
+
+    body = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    return f'"{hashlib.sha1(body).hexdigest()[:20]}"', body
+
+
+def quote_document(listing, currency):
+    quote = listing["quote"][currency]
+    return {
+        "symbol": listing["symbol"],
+        "name": listing.get("name"),
+        "cmc_id": listing.get("id"),
+        "cmc_rank": listing.get("cmc_rank"),
+        "currency": currency,
+        "price": quote["price"],
+        "percent_change_24h": quote.get("percent_change_24h"),
+        "last_updated": quote.get("last_updated"),
+    }
+
+
+class PortfolioSnapshot:
+
+    """
+    The API's responses, keyed by path. update() is given the positions and
+    prices from each poll and only rebuilds the responses if either of them
+    differs from last time, so an unchanged portfolio keeps its ETags.
+    """
+
+    def __init__(self, currency=None):
+        self.currency = currency or engine.base_currency()
+        self._lock = threading.Lock()
+        self._coins = None
+        self._prices = None
+        self._responses = {}
+        self.builds = 0
+
+    def _price_key(self, api_data):
+        return tuple((listing["id"], listing["quote"][self.currency]["price"]) for listing in api_data["data"])
+
+    def update(self, coins, api_data, fetched_at):
+
+        """
+        Returns True if the responses were rebuilt
+        """
+
+        coins = tuple(coins)
+        prices = self._price_key(api_data)
+        with self._lock:
+            if coins == self._coins and prices == self._prices:
+                return False
+
+        price_book = engine.PriceBook(api_data)
+        responses = {
+            "/positions": json_response([coin._asdict() for coin in coins]),
+            # Valued as of the price fetch, so the body only changes with its inputs
+            "/valuation": json_response(engine.valuation_snapshot(list(coins), price_book, self.currency, valued_at=fetched_at)),
+        }
+        for listing in price_book.listings:
+            path = f"/prices/{listing['symbol']}"
+            if path not in responses:
+                responses[path] = json_response(quote_document(listing, self.currency))
+
+        with self._lock:
+            self._coins, self._prices, self._responses = coins, prices, responses
+            self.builds += 1
+        return True
+
+    @property
+    def ready(self):
+        return self._coins is not None
+
+    def get(self, path):
+        return self._responses.get(path)
+
+
+class QuoteCache:
+
+    """
+    Prices for tickers that aren't held, fetched the first time one is asked
+    for and then kept for ttl seconds. Concurrent requests for the same ticker
+    share one fetch, and tickers CoinMarketCap doesn't know are cached too.
+    A failed fetch is remembered for failure_ttl seconds, so a client retrying
+    a ticker doesn't spend a credit on every request.
+
+    Only short alphanumeric tickers are looked up, and expired entries are
+    dropped as new ones are stored, so random paths can't run up the credit
+    budget or the memory use.
+    """
+
+    MISSING = "missing"
+    TICKER = re.compile(r"[A-Z0-9]{1,12}")
+
+    def __init__(self, api_key, ttl, currency=None, failure_ttl=30):
+        self.api_key = api_key
+        self.currency = currency or engine.base_currency()
+        self.cache = engine.TTLCache(ttl)
+        self.failures = engine.TTLCache(failure_ttl)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock_for(self, symbol):
+        with self._locks_lock:
+            return self._locks.setdefault(symbol, threading.Lock())
+
+    def _release(self, symbol, lock):
+        # Requests already waiting on the lock find the cache filled
+        with self._locks_lock:
+            if self._locks.get(symbol) is lock:
+                del self._locks[symbol]
+
+    def get(self, symbol):
+
+        """
+        Returns (etag, body) for the ticker, None if there is no such coin,
+        or raises LookupError if CoinMarketCap couldn't be reached
+        """
+
+        if not self.TICKER.fullmatch(symbol):
+            return None
+        response = self._cached(symbol)
+        if response is None:
+            lock = self._lock_for(symbol)
+            with lock:
+                try:
+                    response = self._cached(symbol)
+                    if response is None:
+                        response = self._fetch(symbol)
+                finally:
+                    self._release(symbol, lock)
+        return None if response == self.MISSING else response
+
+    def _cached(self, symbol):
+        error = self.failures.get(symbol)
+        if error is not None:
+            raise LookupError(error)
+        return self.cache.get(symbol)
+
+    def _fetch(self, symbol):
+        api_data = engine.fetch_quotes(self.api_key, symbols=[symbol], currency=self.currency, workers=1)
+        if api_data is None:
+            error = f"Could not fetch a price for {symbol}"
+            self.failures.prune()
+            self.failures.set(symbol, error)
+            raise LookupError(error)
+        listing = engine.PriceBook(api_data).get(symbol)
+        response = self.MISSING if listing is None else json_response(quote_document(listing, self.currency))
+        self.cache.prune()
+        self.cache.set(symbol, response)
+        return response
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = "Folio"
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        path = unquote(urlsplit(self.path).path).rstrip("/") or "/"
+        snapshot = self.server.snapshot
+        if not snapshot.ready:
+            return self._error(503, "The portfolio hasn't been read yet", send_body)
+
+        response = snapshot.get(path)
+        if response is None and path.startswith("/prices/"):
+            symbol = path[len("/prices/"):].upper()
+            response = snapshot.get(f"/prices/{symbol}")
+            if response is None:
+                try:
+                    response = self.server.quotes.get(symbol)
+                except LookupError as e:
+                    return self._error(502, str(e), send_body)
+        if response is None:
+            return self._error(404, f"Nothing at {path}", send_body)
+
+        etag, body = response
+        if self._matches(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self._send(200, etag, body, send_body)
+
+    def _matches(self, etag):
+        tags = self.headers.get("If-None-Match")
+        if tags is None:
+            return False
+        tags = [tag.strip() for tag in tags.split(",")]
+        # Weak comparison, as RFC 9110 asks for If-None-Match
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    def _send(self, status, etag, body, send_body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            # Cache, but check back with the ETag every time
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _error(self, status, message, send_body):
+        self._send(status, None, json.dumps({"error": message}).encode("utf-8"), send_body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class APIServer(ThreadingHTTPServer):
+
+    """
+    Serves the snapshot and quote cache on host:port, one thread per request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, snapshot, quotes):
+        super().__init__(address, APIRequestHandler)
+        self.snapshot = snapshot
+        self.quotes = quotes
@@ -0,0 +1,200 @@
+"""
+In-process timings for the Folio hot paths: database connects and queries,
+the CoinMarketCap call and portfolio rendering.
+
+Functions are wrapped with @timed("name"), which records how long each call
+took, how many calls raised, and optionally the size of what they returned,
+into fixed-bucket histograms. Nothing leaves the process unless asked, and
+the registry can be exported as a Prometheus text file or as JSON lines.
+"""
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+
+# Bucket upper bounds, Prometheus style
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, math.inf)
+
+
+class Histogram:
+
+    """
+    Counts observations into fixed buckets and keeps their count and sum
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+
+        """
+        Estimates a quantile by interpolating inside the bucket it falls in
+        """
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if seen + count >= rank and count:
+                if math.isinf(upper):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return lower
+
+
+class Registry:
+
+    """
+    Thread safe set of histograms and counters, keyed by metric name and the
+    operation they measure
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, metric, operation, value, buckets=SECONDS_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get((metric, operation))
+            if histogram is None:
+                histogram = self._histograms[(metric, operation)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, metric, operation, amount=1):
+        with self._lock:
+            self._counters[(metric, operation)] = self._counters.get((metric, operation), 0) + amount
+
+    def snapshot(self):
+
+        """
+        Returns a list of dicts, one per series, safe to read without the lock
+        """
+
+        with self._lock:
+            series = []
+            for (metric, operation), histogram in sorted(self._histograms.items()):
+                series.append({
+                    "metric": metric,
+                    "operation": operation,
+                    "type": "histogram",
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "buckets": list(zip(histogram.buckets, histogram.counts)),
+                })
+            for (metric, operation), value in sorted(self._counters.items()):
+                series.append({"metric": metric, "operation": operation, "type": "counter", "value": value})
+            return series
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+registry = Registry()
+
+
+def timed(operation, size=None):
+
+    """
+    Decorator that records each call's duration in folio_operation_seconds,
+    failed calls in folio_operation_errors_total, and, if size is given,
+    size(result) in folio_payload_size
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                registry.increment("folio_operation_errors_total", operation)
+                raise
+            finally:
+                registry.observe("folio_operation_seconds", operation, time.perf_counter() - start)
+            if size is not None and result is not None:
+                registry.observe("folio_payload_size", operation, size(result), SIZE_BUCKETS)
+            return result
+        return wrapper
+    return decorator
+
+
+def _format_bound(upper):
+    return "+Inf" if math.isinf(upper) else repr(float(upper))
+
+
+def prometheus_text():
+
+    """
+    Renders the registry in the Prometheus text exposition format
+    """
+
+    lines = []
+    declared = set()
+    for series in registry.snapshot():
+        metric = series["metric"]
+        label = f'operation="{series["operation"]}"'
+        if metric not in declared:
+            lines.append(f"# TYPE {metric} {series['type']}")
+            declared.add(metric)
+        if series["type"] == "counter":
+            lines.append(f"{metric}{{{label}}} {series['value']}")
+            continue
+        cumulative = 0
+        for upper, count in series["buckets"]:
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{label},le="{_format_bound(upper)}"}} {cumulative}')
+        lines.append(f"{metric}_sum{{{label}}} {series['sum']}")
+        lines.append(f"{metric}_count{{{label}}} {series['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path):
+
+    """
+    Writes the registry to a .prom file, e.g. for node_exporter's textfile
+    collector. The file is replaced atomically so a scrape never sees half of it.
+    """
+
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        file.write(prometheus_text())
+    os.replace(temporary, path)
+
+
+def export_json_lines(path):
+
+    """
+    Appends one JSON object per series to path, stamped with the time
+    """
+
+    now = time.time()
+    with open(path, "a", encoding="utf-8") as file:
+        for series in registry.snapshot():
+            if "buckets" in series:
+                series["buckets"] = [[_format_bound(upper), count] for upper, count in series["buckets"]]
+            file.write(json.dumps({"time": now, **series}) + "\n")
@@ -1,236 +1,31 @@
 import os
+import math
+import logging
 from dotenv import load_dotenv
-import matplotlib.pyplot as plt
-import random
-from matplotlib import colors as mcolors
 from tkinter import *
 from tkinter import messagebox
-import requests
-import json
-import pyodbc
-import logging
-
+from tkinter import ttk
+from tkinter import filedialog
+import time
+import queue
+from engine import (
+    set_error_handler, fetch_coins, validate_trade, import_trades, close_connection_pool,
+    TradeJournal, TradeWriter,
+    get_api_key, fetch_quotes, fetch_all_listings, PriceBook, SearchIndex, PriceRefresher, SnapshotStore, value_portfolio, pie_slices, pool_stats,
+    api_client_stats, close_api_client, base_currency, currency_sign, FXRates,
+)
+from alerts import AlertBook, AlertStore, log_sink, METRICS, DIRECTIONS
+from instrumentation import registry, timed, export_prometheus, export_json_lines
 
-# Database connections
 
 load_dotenv()  # Load environment variables from .env file
 
-# Check if the variable is loaded correctly
-
-
-def get_database_connection():
-    connection_string = os.getenv('DATABASE_CONNECTION_STRING')
-    if not connection_string:
-        raise ValueError("DATABASE_CONNECTION_STRING is not set in the environment variables.")
-    try:
-        logging.debug(f"Attempting to connect with connection string: {connection_string}")
-        return pyodbc.connect(connection_string)
-    except pyodbc.Error as e:
-        logging.error(f"Database connection error: {e}")
-        raise
-
-
-def add_coin(crypto_id, symbol, name):
-
-    try:
-        # Validate crypto_id (positive integer)
-        if not isinstance(crypto_id, int) or crypto_id <= 0:
-            raise ValueError("Crypto ID must be a positive integer")
-
-        # Validate symbol (alphabetic characters)
-        if not symbol.isalpha():
-            raise ValueError("Ticker symbol must be alphabetic")
-
-        # Validate name (alphabetic characters)
-        if not name.isalpha():
-            raise ValueError("Coin name must be alphabetic")
-
-        # If validations pass, insert into database
-        connection = get_database_connection()
-        cursor = connection.cursor()
-        cursor.execute("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", (crypto_id, symbol, name))
-        connection.commit()
-        connection.close()
-    
-    except Exception as e:
-        messagebox.showerror(message=f'Error adding coin: {e}')
-        
-
-def transaction_data(crypto_id, transaction_id, quantity, price, cost):
-    try:
-        # Validate inputs
-        if not isinstance(crypto_id, int) or crypto_id <= 0:
-            raise ValueError("Crypto ID must be a positive integer")
-        
-        if not isinstance(transaction_id, int) or transaction_id <= 0:
-            raise ValueError("Transaction ID must be a positive integer")
-
-        if not isinstance(quantity, float) or quantity <= 0:
-            raise ValueError("Quantity must be a positive float")
-
-        if not isinstance(price, float) or price <= 0:
-            raise ValueError("Price must be a positive float")
-
-        if not isinstance(cost, float) or cost <= 0:
-            raise ValueError("Total cost must be a positive float")
-
-        # If all validations pass, insert into database
-        connection = get_database_connection()
-        cursor = connection.cursor()
-        cursor.execute("INSERT INTO transactions (crypto_id, transaction_id, quantity, price, cost) VALUES (?, ?, ?, ?, ?)", (crypto_id, transaction_id, quantity, price, cost))
-        connection.commit()
-        connection.close()
-
-    except ValueError as ve:
-        messagebox.showerror(message=f'Validation Error: {ve}')
-        print(f"Validation Error: {ve}")
-    except Exception as e:
-        messagebox.showerror(message=f'Error inserting transaction data: {e}')
-        print(f"Error inserting transaction data: {e}")
-
-
-    
-
-def symbol_exists(symbol):
-    try:
-        connection = get_database_connection()
-        cursor = connection.cursor()
-
-        # Check if the symbol exists in cryptocurrencies table
-        cursor.execute("SELECT TOP 1 1 FROM cryptocurrencies WHERE symbol = ?", (symbol,))
-        row = cursor.fetchone()
-
-        connection.close()
-
-        return row is not None
-
-    except Exception as e:
-        messagebox.showerror(message=f'Error checking symbol existence: {e}')
-        print(f"Error checking symbol existence: {e}")
-        return False
-
-
-def buy_transaction(symbol, new_quantity, new_cost):
-    try:
-        connection = get_database_connection()
-        cursor = connection.cursor()
-
-        # Update query to update quantity based on symbol
-        update_query = """
-        UPDATE t
-        SET t.quantity = t.quantity + ?,
-            t.cost = t.cost + ?
-        FROM transactions t
-        JOIN cryptocurrencies c ON t.crypto_id = c.crypto_id
-        WHERE c.symbol = ?
-        """
-
-        # Execute the update query
-        cursor.execute(update_query, (new_quantity, new_cost, symbol))
-        connection.commit()
-
-    
-
-    except Exception as e:
-        print(f"Error updating quantity: {e}")
-
-    finally:
-        connection.close()
-
-def sell_transaction(symbol, new_quantity, new_cost):
-    try:
-        connection = get_database_connection()
-        cursor = connection.cursor()
-
-        # Check if there are enough quantities to sell
-        select_query = """
-            SELECT t.quantity
-            FROM transactions t
-            JOIN cryptocurrencies c ON t.crypto_id = c.crypto_id
-            WHERE c.symbol = ?
-        """
-        cursor.execute(select_query, (symbol,))
-        current_quantity = cursor.fetchone()[0]
-
-        if float(new_quantity) <= current_quantity:
-            # Update query to update quantity and cost based on symbol for selling
-            update_query = """
-                UPDATE t
-                SET t.quantity = t.quantity - ?,
-                    t.cost = t.cost - ?
-                FROM transactions t
-                JOIN cryptocurrencies c ON t.crypto_id = c.crypto_id
-                WHERE c.symbol = ?
-            """
-
-            # Execute the update query
-            cursor.execute(update_query, (new_quantity, new_cost, symbol))
-            connection.commit()
-
-            cursor.execute(select_query, (symbol,))
-            updated_quantity = cursor.fetchone()[0]
-
-            if updated_quantity == 0:
-                delete_transactions_query = """
-                    DELETE FROM transactions
-                    WHERE crypto_id = (SELECT crypto_id FROM cryptocurrencies WHERE symbol = ?)
-                """
-                cursor.execute(delete_transactions_query, (symbol,))
-                connection.commit()
-
-                delete_cryptocurrencies_query = """
-                    DELETE FROM cryptocurrencies
-                    WHERE symbol = ?
-                """
-                cursor.execute(delete_cryptocurrencies_query, (symbol,))
-                connection.commit()
-
-
-                connection.close()
-                return "deleted"
-            else:
-                connection.close()
-                return "updated"
-            
-        else:
-            connection.close()
-            return "not_enough"
-        
-    except Exception as e:
-        messagebox.showerror(message=f'An error occurred: {e}')
-        print(f"An error occurred: {e}")
-   
-
-
-
-def fetch_coins():
-    try:
-        connection = get_database_connection()
-        cursor = connection.cursor()
-        
-        query = """
-        SELECT c.crypto_id, c.symbol, c.name,
-               t.transaction_id, t.quantity, t.price, t.cost
-        FROM cryptocurrencies c
-        LEFT JOIN transactions t ON c.crypto_id = t.crypto_id
-        ORDER BY c.crypto_id ASC  
-        """
-        
-        cursor.execute(query)
-        data = cursor.fetchall()
-        
-        # Close the connection
-        connection.close()
-        
-        return data
-    
-    except Exception as e:
-        messagebox.showerror(message=f'Error fetching coins: {e}')
-        print(f"Error fetching coins: {e}")
-        return []
-
+# The engine and the connection pool report through logging, e.g. the pool
+# counters logged on shutdown, so send it to the console like folio does
+logging.basicConfig(level=os.getenv('FOLIO_LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(message)s")
 
-# End of database connections
+# Database errors handled by the engine are shown to the user
+set_error_handler(lambda message: messagebox.showerror(message=message))
 
 coins = []
 
@@ -314,146 +109,360 @@ def profit_loss_indicator(number):
         return "blue"
     else:
         return "red"
-    
 
 
-load_dotenv()  # Load environment variables from .env file
+snapshot_store = SnapshotStore(os.getenv('PRICE_CACHE_PATH', 'price_cache.db'))
+
+# Render from the last saved prices straight away, the background refresher
+# revalidates them once the window is up
+api_data, prices_fetched_at = snapshot_store.load()
+BASE_CURRENCY = base_currency()
+if api_data is not None and api_data["data"] and BASE_CURRENCY not in api_data["data"][0]["quote"]:
+    # Saved before BASE_CURRENCY was changed, so it has no prices we can use
+    api_data, prices_fetched_at = None, None
+price_book = PriceBook(api_data)
+
+# Listings for the whole market, or its top MARKET_LISTINGS_LIMIT coins, so the
+# price checker and Fetch Info can find coins that aren't held. Filled in by
+# its own, slower, refresher.
+market_book = PriceBook(None)
+
+# Display currency
+#
+# Quotes and costs are in the base currency. The portfolio can be shown in
+# any of DISPLAY_CURRENCIES, converted with a rate from the FX refresher, so
+# switching never refetches the listings.
+DISPLAY_CURRENCIES = [BASE_CURRENCY] + [currency for currency in
+                                        (code.strip().upper() for code in os.getenv('DISPLAY_CURRENCIES', 'USD,EUR').split(','))
+                                        if currency and currency != BASE_CURRENCY]
+fx_rates_table = {BASE_CURRENCY: 1.0}
+display_currency = BASE_CURRENCY
+# Switched to once its rate has been fetched
+wanted_currency = os.getenv('DISPLAY_CURRENCY', BASE_CURRENCY).upper()
+if wanted_currency not in DISPLAY_CURRENCIES:
+    DISPLAY_CURRENCIES.append(wanted_currency)
+
+
+def money(amount):
+    return f"{currency_sign(display_currency)}{amount:.2f}"
+
+
+# Ticker and name search over both, rebuilt whenever either changes
+search_index = SearchIndex(price_book.listings)
+
 
-def get_api_key():
-    return os.getenv('API_KEY')
+def rebuild_search_index():
+    global search_index
+    search_index = SearchIndex(market_book.listings + price_book.listings)
+
+
+def find_listing(symbol):
 
-def fetch_api_data(api_key):
     """
-    Fetches data from CoinMarketCap API.
+    Looks a symbol up in the held quotes first, as they are refreshed more
+    often, and then in the market listings
     """
-    url = "https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest"
-    parameters = {
-        'start': '1',
-        'limit': '200',
-        'convert': 'GBP'
-    }
-    headers = {
-        'X-CMC_PRO_API_KEY': api_key
-    }
-
-    try:
-        api_request = requests.get(url, headers=headers, params=parameters)
-        if api_request.status_code == 200:
-            return api_request.json()
-        else:
-            print("Failed to fetch API data. Status code:", api_request.status_code)
-            return None
-    except requests.exceptions.RequestException as e:
-        print("Error fetching API data:", e)
-        return None
 
-# Code inside this block runs only when the script is executed directly
-if __name__ == "__main__":
-    api_key = get_api_key()
-    if api_key:
-        api_data = fetch_api_data(api_key)
-        
-    else:
-        print("API key is missing.")
+    listing = price_book.get(symbol)
+    if listing is None:
+        listing = market_book.get(symbol)
+    return listing
 
 
-def populate_portfolio():  
+class Autocomplete:
 
     """
-    Populate the portfolio frame with data fetched from an API and stored in the database.
+    Drop-down list of matching coins under an Entry, updated as the user types.
+    Up and Down move through the matches, and Return or a double click picks one.
+    """
 
-    for loop with auto incrementing i to loop through the list fetched by API
-    len is determined by the length of the list retrevied through the api call
+    def __init__(self, entry, on_select=None, rows=6):
+        self.entry = entry
+        self.on_select = on_select
+        self.matches = []
+        self.listbox = Listbox(entry.winfo_toplevel(), height=rows)
+        entry.bind("<KeyRelease>", self.suggest, add="+")
+        entry.bind("<Down>", self.focus_list, add="+")
+        entry.bind("<Escape>", self.hide, add="+")
+        entry.bind("<FocusOut>", lambda event: entry.after(150, self.hide_unless_focused), add="+")
+        self.listbox.bind("<Return>", self.choose)
+        self.listbox.bind("<Double-Button-1>", self.choose)
+        self.listbox.bind("<Escape>", self.hide)
+
+    def suggest(self, event=None):
+        if event is not None and event.keysym in ("Down", "Up", "Return", "Escape", "Tab"):
+            return
+        query = self.entry.get().strip()
+        self.matches = search_index.search(query, int(self.listbox["height"])) if query else []
+        if not self.matches:
+            self.hide()
+            return
+        self.listbox.delete(0, END)
+        for listing in self.matches:
+            self.listbox.insert(END, f"{listing['symbol']}  {listing['name']}")
+        self.listbox.place(in_=self.entry, x=0, rely=1, relwidth=1.5)
+        self.listbox.lift()
+
+    def focus_list(self, event=None):
+        if self.matches:
+            self.listbox.focus_set()
+            self.listbox.selection_clear(0, END)
+            self.listbox.selection_set(0)
+            self.listbox.activate(0)
+
+    def choose(self, event=None):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        listing = self.matches[selection[0]]
+        self.entry.delete(0, END)
+        self.entry.insert(0, listing["symbol"])
+        self.hide()
+        self.entry.focus_set()
+        if self.on_select is not None:
+            self.on_select(listing)
 
-    Iterates through the cryptocurrency symbol in data fetched from an API and
-    if it matches with symbol stored in "coins" list (fetched from the database) it 
-    is used to calculate current values, profit/loss and percentage change for each
-    cryptocurrency in the portfolio
+    def hide_unless_focused(self):
+        if self.listbox.focus_get() is not self.listbox:
+            self.hide()
 
-    It then updates the GUI with this information
+    def hide(self, event=None):
+        self.listbox.place_forget()
 
-    Returns:
-            - Total current value of the portfolio.
-            - Total profit or loss of the portfolio.
-            - Row number for inserting data in the GUI.
-            - pie (list): List of cryptocurrency symbols for use in pie chart.
-            - pie_size (list): List of sizes for each cryptocurrency slice in a pie chart.
-            - crypto_colors (list): List of random colors for each slice of pie chart.
+
+class PortfolioTable:
 
     """
+    Keeps one row of Label widgets per holding in the portfolio frame.
 
-    total_profit_and_loss = 0 
+    update() is given every row that should be on screen as (key, cells,
+    sort_keys), keyed so the same holding maps to the same widgets between
+    calls. Only cells whose text or colour changed are reconfigured, rows are
+    only created or destroyed when holdings appear or disappear, and rows are
+    only regridded when their position changes.
+    """
 
-    total_portfolio_value = 0
-    
-    insertion_row = 2
+    CELL_PADX = [(20, 5), 5, 5, 5, 5, 5, 5, 5]
 
-    pie = []
-    pie_size = []
+    def __init__(self, frame, first_row=2):
+        self.frame = frame
+        self.first_row = first_row
+        self._labels = {}    # row key -> list of Label widgets
+        self._cells = {}     # row key -> list of (text, bg) currently shown
+        self._grid_row = {}  # row key -> grid row the labels are placed in
 
+    def update(self, rows):
 
-    for i in range(len(api_data["data"])):
-        for coin in coins:
-            
-            if api_data["data"][i]["symbol"] == coin[1]:
-                current_price = api_data["data"][i]["quote"]["GBP"]["price"]
-                current_value = current_price * float(coin[4])
-                purchase_cost = coin[5] * coin[4]
-                profit_and_loss = (current_price * (coin[4])) - (purchase_cost)
-                percentage_change = (float(profit_and_loss)/float(purchase_cost))*100
-                total_profit_and_loss += profit_and_loss
-                total_portfolio_value += current_value
-                number_of_coins_value = coin[4]
-                insertion_row +=1
-                pie.append(coin[1])
-                pie_size.append((current_value))
-                
+        """
+        rows is a list of (key, cells, sort_keys) in display order, where cells
+        is a list of (text, bg) for each column. Returns the last grid row used.
+        """
 
+        keys = {key for key, _, _ in rows}
+        for key in list(self._labels):
+            if key not in keys:
+                for label in self._labels.pop(key):
+                    label.destroy()
+                del self._cells[key]
+                del self._grid_row[key]
+
+        for position, (key, cells, _) in enumerate(rows):
+            grid_row = self.first_row + 1 + position
+            labels = self._labels.get(key)
+
+            if labels is None:
+                labels = []
+                for column, (text, bg) in enumerate(cells):
+                    label = Label(self.frame, text=text, bg=bg, fg="white")
+                    label.grid(row=grid_row, column=column, padx=self.CELL_PADX[column], sticky=E+W)
+                    labels.append(label)
+                self._labels[key] = labels
+                self._cells[key] = list(cells)
+                self._grid_row[key] = grid_row
+                continue
+
+            shown = self._cells[key]
+            for column, cell in enumerate(cells):
+                if shown[column] != cell:
+                    text, bg = cell
+                    labels[column].config(text=text, bg=bg)
+                    shown[column] = cell
+
+            if self._grid_row[key] != grid_row:
+                for label in labels:
+                    label.grid_configure(row=grid_row)
+                self._grid_row[key] = grid_row
+
+        return self.first_row + len(rows)
+
+
+class PortfolioTreeView:
 
-                coin_id = Label(portfolio_frame, text = coin[0], bg = "Blue", fg= "white")
-                coin_id.grid(row= insertion_row, column=0, padx = (20,5), sticky=E+W)
+    """
+    Portfolio view backed by a single ttk.Treeview, used for portfolios too big
+    for a grid of Labels. The Treeview only draws the rows that are scrolled
+    into view, so it stays usable with thousands of holdings.
+
+    It takes the same rows as PortfolioTable. Clicking a heading sorts by that
+    column using the numeric sort keys worked out when the rows were built,
+    and clicking it again reverses the order. Rows whose sort key is None
+    have no value for the column and stay at the bottom either way.
+    """
 
-                number_of_coins = Label(portfolio_frame, text = f'{number_of_coins_value:.1f}', bg = "Blue", fg= "white")
-                number_of_coins.grid(row= insertion_row, column=1, padx = 5, sticky=E+W)
+    HEADINGS = ["Coin ID", "Number owned", "Coin Name", "Ticker", "Cost", "Current Value", "Profit/Loss", "%  Gain/Loss"]
+
+    def __init__(self, frame, first_row=2, height=20):
+        self.first_row = first_row
+        self.tree = ttk.Treeview(frame, columns=list(range(len(self.HEADINGS))), show="headings", height=height)
+        for column, heading in enumerate(self.HEADINGS):
+            self.tree.heading(column, text=heading, command=lambda column=column: self.sort_by(column))
+            self.tree.column(column, anchor=W if column in (2, 3) else E, width=120)
+        for colour in ("green", "blue", "red"):
+            self.tree.tag_configure(colour, foreground=colour)
+
+        scrollbar = ttk.Scrollbar(frame, orient=VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.grid(row=first_row, column=0, columnspan=8, padx=(20, 0), sticky=E+W)
+        scrollbar.grid(row=first_row, column=8, sticky=N+S)
+
+        self.sort_column = None
+        self.sort_descending = False
+        self._values = {}     # item id -> (values, tags) currently shown
+        self._sort_keys = {}  # item id -> sort key for each column
+        self._default_order = []
+        self._order = []
+
+    def update(self, rows):
+        item_ids = []
+        for key, cells, sort_keys in rows:
+            item_id = ":".join(str(part) for part in key)
+            values = tuple(text for text, _ in cells)
+            # Colour the whole row by its profit or loss
+            tags = (cells[6][1],)
+
+            shown = self._values.get(item_id)
+            if shown is None:
+                self.tree.insert("", END, iid=item_id, values=values, tags=tags)
+                self._order.append(item_id)
+            elif shown != (values, tags):
+                self.tree.item(item_id, values=values, tags=tags)
+            self._values[item_id] = (values, tags)
+            self._sort_keys[item_id] = sort_keys
+            item_ids.append(item_id)
+
+        current = set(item_ids)
+        removed = [item_id for item_id in self._values if item_id not in current]
+        if removed:
+            self.tree.delete(*removed)
+            for item_id in removed:
+                del self._values[item_id]
+                del self._sort_keys[item_id]
+            self._order = [item_id for item_id in self._order if item_id in current]
+
+        self._default_order = item_ids
+        self._apply_order()
+        return self.first_row
+
+    def sort_by(self, column):
+        if self.sort_column == column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column = column
+            self.sort_descending = False
+        self._apply_order()
 
-                coin_name = Label(portfolio_frame, text = api_data["data"][i]["name"], bg = "Blue", fg= "white")
-                coin_name.grid(row= insertion_row, column=2, padx = 5, sticky=E+W)
+    def _apply_order(self):
+        if self.sort_column is None:
+            order = self._default_order
+        else:
+            column = self.sort_column
+            keyed = [item_id for item_id in self._default_order if self._sort_keys[item_id][column] is not None]
+            order = sorted(keyed, key=lambda item_id: self._sort_keys[item_id][column], reverse=self.sort_descending)
+            order += [item_id for item_id in self._default_order if self._sort_keys[item_id][column] is None]
 
-                ticker = Label(portfolio_frame, text = api_data["data"][i]["symbol"], bg = "Blue", fg= "white")
-                ticker.grid(row= insertion_row, column=3, padx= 5, sticky=E+W)
+        # Only move items when the order actually changed
+        if order != self._order:
+            for index, item_id in enumerate(order):
+                self.tree.move(item_id, "", index)
+            self._order = list(order)
 
-                cost = Label(portfolio_frame, text = f'£{purchase_cost:.2f}', bg = "Blue", fg= "white")
-                cost.grid(row= insertion_row, column=4, padx= 5, sticky=E+W)
 
-                current_value = Label(portfolio_frame, text = f'£{current_value:.2f}', bg = "Blue", fg= "white")
-                current_value.grid(row= insertion_row, column=5, padx= 5, sticky=E+W)
+# Holdings above this count are shown in the Treeview instead of the Label grid
+PORTFOLIO_TREE_THRESHOLD = int(os.getenv('PORTFOLIO_TREE_THRESHOLD', '100'))
+PORTFOLIO_VIEW = os.getenv('PORTFOLIO_VIEW', 'auto')
 
-                profit_or_loss = Label(portfolio_frame, text = f'£{profit_and_loss:.2f}', bg = profit_loss_indicator(profit_and_loss), fg= "white")
-                profit_or_loss.grid(row= insertion_row, column=6, padx= 5, sticky=E+W)
+if PORTFOLIO_VIEW == "tree" or (PORTFOLIO_VIEW == "auto" and len(coins) > PORTFOLIO_TREE_THRESHOLD):
+    portfolio_table = PortfolioTreeView(portfolio_frame)
+else:
+    portfolio_table = PortfolioTable(portfolio_frame)
 
-                percentage = Label(portfolio_frame, text= f'{percentage_change:.2f}', bg= profit_loss_indicator(percentage_change), fg="white")
-                percentage.grid(row= insertion_row, column=7, padx=5, sticky=E+W)
-    
-    pies_size=[]
-    for pies in pie_size:
-        pies_size.append(pies/total_portfolio_value) 
-    
-    
 
-    num_crypto = len(pie)
-    crypto_colors = random.sample(list(mcolors.CSS4_COLORS.values()), num_crypto)     
+@timed("populate_portfolio", size=lambda result: len(result[3]))
+def populate_portfolio():  
 
+    """
+    Populate the portfolio frame with data fetched from an API and stored in the database.
 
-    return total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size, crypto_colors
+    Values each coin in the "coins" list (fetched from the database) against
+    the price book built from the API data, using value_portfolio from the
+    engine. Rows are shown in market cap order.
 
-    
-portfolio_headings()
-total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size, crypto_colors = populate_portfolio()
+    It then updates the GUI with this information, reusing the rows that are
+    already on screen
+
+    Returns:
+            - Total current value of the portfolio.
+            - Total profit or loss of the portfolio.
+            - Row number for inserting data in the GUI.
+            - pie (list): List of cryptocurrency symbols for use in pie chart.
+            - pies_size (list): Share of the portfolio value for each slice of the pie chart.
+
+    """
+
+    holdings, total_portfolio_value, total_profit_and_loss = value_portfolio(coins, price_book, fx_rate=fx_rates_table[display_currency])
+
+    pie = []
+    pies_size = []
+    rows = []
+
+    for holding in holdings:
+        coin = holding["coin"]
+        listing = holding["listing"]
+        current_value = holding["current_value"]
+        purchase_cost = holding["purchase_cost"]
+        profit_and_loss = holding["profit_and_loss"]
+        percentage_change = holding["percentage_change"]
+        number_of_coins_value = coin.quantity
+        pie.append(coin.symbol)
+        pies_size.append(holding["allocation"])
+
+        # The percentage is NaN when the coins cost nothing, a None sort key
+        # keeps those last whichever way the column is sorted
+        has_percentage = not math.isnan(percentage_change)
+        sort_keys = (coin.crypto_id, number_of_coins_value, listing["name"].lower(), listing["symbol"],
+                     purchase_cost, current_value, profit_and_loss, percentage_change if has_percentage else None)
+
+        # Keyed on crypto id, there is one position per coin, so each holding keeps its widgets
+        rows.append(((coin.crypto_id,), [
+            (coin.crypto_id, "Blue"),
+            (f'{number_of_coins_value:.1f}', "Blue"),
+            (listing["name"], "Blue"),
+            (listing["symbol"], "Blue"),
+            (money(purchase_cost), "Blue"),
+            (money(current_value), "Blue"),
+            (money(profit_and_loss), profit_loss_indicator(profit_and_loss)),
+            (f'{percentage_change:.2f}' if has_percentage else "n/a", profit_loss_indicator(percentage_change) if has_percentage else "blue"),
+        ], sort_keys))
+
+    insertion_row = portfolio_table.update(rows)
+
+    return total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size
 
     
-portfolio_headings()
-total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size, crypto_colors = populate_portfolio()
-print(insertion_row)
+if isinstance(portfolio_table, PortfolioTable):
+    portfolio_headings()
+total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size = populate_portfolio()
+
 # Total value and P/L
 
 total_value_frame = Frame(win)
@@ -464,12 +473,160 @@ total_value_frame.grid_columnconfigure(1, weight=1)
 total_value_frame.grid_columnconfigure(2, weight=1)
 total_value_frame.grid_columnconfigure(3, weight=1)
 
-total_value_label = Label(total_value_frame, text=f"Total portfolio value: £{total_portfolio_value:.2f}", font=("Helvetica", 14, "bold"), fg="#FF9800")
+total_value_label = Label(total_value_frame, text=f"Total portfolio value: {money(total_portfolio_value)}", font=("Helvetica", 14, "bold"), fg="#FF9800")
 total_value_label.grid(row=0, column=1, padx=10, sticky="e")
 
-profit_and_loss_label = Label(total_value_frame, text=f"Total P/L: £{total_profit_and_loss:.2f}", font=("Helvetica", 14, "bold"), fg=profit_loss_indicator(total_profit_and_loss))
+profit_and_loss_label = Label(total_value_frame, text=f"Total P/L: {money(total_profit_and_loss)}", font=("Helvetica", 14, "bold"), fg=profit_loss_indicator(total_profit_and_loss))
 profit_and_loss_label.grid(row=0, column=2, padx=10, sticky="w")
 
+prices_as_of_label = Label(total_value_frame, text="Fetching prices...", font=("Helvetica", 10), fg="grey")
+prices_as_of_label.grid(row=0, column=3, padx=10, sticky="e")
+
+trade_status_label = Label(total_value_frame, text="", font=("Helvetica", 10), fg="grey")
+trade_status_label.grid(row=0, column=0, padx=10, sticky="w")
+
+
+def refresh_portfolio():
+
+    """
+    Redraws the portfolio rows and the totals from the current coins and
+    price book
+    """
+
+    global total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size
+    total_portfolio_value, total_profit_and_loss, insertion_row, pie, pies_size = populate_portfolio()
+
+    total_value_label.config(text=f"Total portfolio value: {money(total_portfolio_value)}")
+    profit_and_loss_label.config(text=f"Total P/L: {money(total_profit_and_loss)}", fg=profit_loss_indicator(total_profit_and_loss))
+    if portfolio_chart is not None:
+        portfolio_chart.update(pie, pies_size)
+    check_alerts()
+
+
+def update_prices_as_of():
+
+    """
+    Shows when the prices on screen were fetched, and flags them as stale if
+    the refresher hasn't managed to fetch newer ones within the cache TTL
+    """
+
+    if prices_fetched_at is None:
+        return
+    fetched = time.strftime("%d %b %H:%M:%S", time.localtime(prices_fetched_at))
+    if price_refresher is None:
+        prices_as_of_label.config(text=f"Prices as of {fetched} (offline)", fg="red")
+    elif not price_refresher.cache.is_fresh(PriceRefresher.CACHE_KEY):
+        prices_as_of_label.config(text=f"Prices as of {fetched} (stale)", fg="red")
+    else:
+        prices_as_of_label.config(text=f"Prices as of {fetched}", fg="grey")
+
+
+def apply_price_snapshot(new_api_data, fetched_at):
+
+    """
+    Swaps in a new API response and redraws the portfolio with it
+    """
+
+    global api_data, price_book, prices_fetched_at
+    api_data = new_api_data
+    price_book = PriceBook(api_data)
+    prices_fetched_at = fetched_at
+    rebuild_search_index()
+    refresh_portfolio()
+    update_prices_as_of()
+
+
+def reload_coins():
+
+    """
+    Refetches the holdings after a trade or import. A newly held coin has no
+    quote yet, so the refresher is asked to fetch straight away.
+    """
+
+    set_coins(fetch_coins())
+
+
+def set_coins(new_coins):
+    global coins
+    coins = new_coins
+    if price_refresher is not None and any(coin.symbol not in price_book for coin in coins):
+        price_refresher.refresh_now()
+
+
+def latest_update(updates):
+    latest = None
+    try:
+        while True:
+            latest = updates.get_nowait()
+    except queue.Empty:
+        return latest
+
+
+def poll_price_updates():
+
+    """
+    Runs on the Tk thread every PRICE_POLL_MS and applies the newest snapshot
+    put on the queue by the background refreshers
+    """
+
+    global market_book
+    market_latest = latest_update(market_refresher.updates)
+    if market_latest is not None:
+        market_book = PriceBook(market_latest[0])
+        rebuild_search_index()
+        check_alerts()
+
+    fx_latest = latest_update(fx_refresher.updates)
+    if fx_latest is not None:
+        apply_fx_rates(fx_latest[0])
+
+    latest = latest_update(price_refresher.updates)
+    if latest is not None:
+        apply_price_snapshot(*latest)
+    else:
+        update_prices_as_of()
+
+    win.after(PRICE_POLL_MS, poll_price_updates)
+
+
+PRICE_POLL_MS = 500
+price_refresher = None
+market_refresher = None
+fx_refresher = None
+
+
+def apply_fx_rates(table):
+
+    """
+    Takes a new table of rates from the FX refresher, switching to the
+    wanted display currency if its rate has just arrived
+    """
+
+    global wanted_currency
+    fx_rates_table.update(table)
+    if wanted_currency in fx_rates_table:
+        currency, wanted_currency = wanted_currency, None
+        display_currency_var.set(currency)
+        set_display_currency(currency)
+    elif display_currency != BASE_CURRENCY:
+        refresh_portfolio()
+
+
+def set_display_currency(currency):
+
+    """
+    Shows the portfolio in currency, converting the valuation in bulk at
+    the cached rate
+    """
+
+    global display_currency
+    if currency not in fx_rates_table:
+        messagebox.showerror(message=f"There is no exchange rate for {currency} yet")
+        display_currency_var.set(display_currency)
+        return
+    display_currency = currency
+    refresh_portfolio()
+
 
 
 def fetch_price():
@@ -479,14 +636,14 @@ def fetch_price():
     based on the ticker(symbol) entered in to an entry widget
     """
     entered_symbol = coin_symbol_entry.get().upper()
-    for coin in api_data["data"]:
-        if coin["symbol"] == entered_symbol:
-            coin_price = coin["quote"]["GBP"]["price"]
-            price_entry.insert(0, f'{coin_price:.2f}')
-            crypto_name = coin["name"]
-            coin_name_entry.insert(0, crypto_name)
-            cost = (coin["quote"]["GBP"]["price"])*float(amount_entry.get())
-            total_cost_entry.insert(0, f'{cost:.2f}')   
+    coin = find_listing(entered_symbol)
+    if coin is not None:
+        coin_price = coin["quote"][BASE_CURRENCY]["price"]
+        price_entry.insert(0, f'{coin_price:.2f}')
+        crypto_name = coin["name"]
+        coin_name_entry.insert(0, crypto_name)
+        cost = (coin["quote"][BASE_CURRENCY]["price"])*float(amount_entry.get())
+        total_cost_entry.insert(0, f'{cost:.2f}')   
 
    
 # Entry widgets frame
@@ -510,6 +667,7 @@ ticker_label = Label(entry_widget_frame, text="Ticker", bg="#FF9800", fg="black"
 ticker_label.grid(row=0, column=2, pady=5)
 coin_symbol_entry = Entry(entry_widget_frame)
 coin_symbol_entry.grid(row=1, column=2, padx=5, pady=5)
+coin_symbol_autocomplete = Autocomplete(coin_symbol_entry)
 
 amount_label = Label(entry_widget_frame, text="Amount", bg="#FF9800", fg="black")
 amount_label.grid(row=0, column=3, pady=5)
@@ -548,8 +706,8 @@ def add_data():
 
     """
     Validates data entered in to entry widgets to create transactions
-    Calls different functions to add, update or delete info from 
-    database depending on transaction type
+    and hands them to the trade writer, which adds, updates or deletes
+    info in the database depending on transaction type
     """
 
 
@@ -564,87 +722,28 @@ def add_data():
         name_value = coin_name_entry.get()
         transaction_type = transaction_var.get()
 
-        # Validate and convert transaction ID
         try:
-            transaction_id_value = int(transaction_id_value)
-            if transaction_id_value <= 0:
-                raise ValueError("Transaction ID must be a positive integer")
-        except ValueError:
-            messagebox.showerror(message= "Transaction ID must be a positive integer")
+            (transaction_id_value, quantity_value, price_value, cost_value,
+             crypto_id_value, symbol_value, name_value, transaction_type) = validate_trade(
+                transaction_id_value, quantity_value, price_value, cost_value,
+                crypto_id_value, symbol_value, name_value, transaction_type)
+        except ValueError as ve:
+            messagebox.showerror(message=str(ve))
             return
 
-        # Validate and convert quantity
-        try:
-            quantity_value = float(quantity_value)
-            if quantity_value <= 0:
-                raise ValueError("Amount must be a positive float")
-        except ValueError:
-            messagebox.showerror(message= "Amount must be a positive float")
-            return
-
-        # Validate and convert price
-        try:
-            price_value = float(price_value)
-            if price_value <= 0:
-                raise ValueError("Price must be a positive float")
-        except ValueError:
-            messagebox.showerror(message = "Price must be a positive float")
-            return
-
-        # Validate and convert cost
-        try:
-            cost_value = float(cost_value)
-            if cost_value <= 0:
-                raise ValueError("Total cost must be a positive float")
-        except ValueError:
-            messagebox.showerror(message = "Total cost must be a positive float")
-            return
-
-        # Validate and convert coin ID
-        try:
-            crypto_id_value = int(crypto_id_value)
-            if crypto_id_value <= 0:
-                raise ValueError("Coin ID must be a positive integer")
-        except ValueError:
-            messagebox.showerror(message= "Coin ID must be a positive integer")
-            return
-
-        # Validate symbol and name
-        if not symbol_value.isalpha() or len(symbol_value) > 5:
-            messagebox.showerror(message = "Ticker symbol must be alphabetic and no longer than 5 characters")
-            return
-        if not name_value.isalpha():
-            messagebox.showerror(message = "Coin name must be alphabetic")
-            return
-        if transaction_type not in (1, 2):
-            messagebox.showerror(message= "Invalid transaction type")
-            return
-
-        # Check if the symbol exists in cryptocurrencies table
-        if symbol_exists(symbol_value):
-            if transaction_type == 1:
-                buy_transaction(symbol_value, quantity_value, cost_value)
-                messagebox.showinfo(message=f'You have bought £{cost_value:.2f} of {symbol_value}')
-            elif transaction_type == 2:
-                sell_status = sell_transaction(symbol_value, quantity_value, cost_value)
-                if sell_status == "deleted":
-                    messagebox.showinfo(message=f"You have sold all of your {symbol_value}, it has been deleted from your portfolio")
-                elif sell_status == "updated":
-                    messagebox.showinfo(message=f'You have sold £{cost_value:.2f} of {symbol_value}')
-                elif sell_status == "not_enough":
-                    messagebox.showerror(message=f'You dont have enough {symbol_value} available to sell')
-                else:
-                    messagebox.showerror(message=f'An error occurred while selling {symbol_value}')
-            else:
-                messagebox.showerror(message=f'Invalid transaction type: {transaction_type}')
-
-        else:
-            if transaction_type == 1:  # Only attempt to add if it's a buy transaction
-                add_coin(crypto_id_value, symbol_value, name_value)
-                transaction_data(crypto_id_value, transaction_id_value, quantity_value, price_value, cost_value)
-                messagebox.showinfo(message=f'You have added £{cost_value:.2f} of {symbol_value}')
-            else:
-                messagebox.showerror(message=f'You do not own any {symbol_value} to sell')
+        # The trade is saved to the local journal here and applied to the
+        # database by the trade writer, which reports back in poll_trade_results
+        trade_writer.submit({
+            "side": "B" if transaction_type == 1 else "S",
+            "crypto_id": crypto_id_value,
+            "transaction_id": transaction_id_value,
+            "symbol": symbol_value,
+            "name": name_value,
+            "quantity": quantity_value,
+            "price": price_value,
+            "cost": cost_value,
+        })
+        update_trade_status()
         
         # Clear input fields
         transaction_id_entry.delete(0, END)
@@ -655,32 +754,396 @@ def add_data():
         coin_symbol_entry.delete(0, END)
         coin_name_entry.delete(0, END)
 
-        global coins
-        coins = fetch_coins()
-
-        # Update the portfolio display with the refreshed data
-        populate_portfolio()
-
     except Exception as e:
         messagebox.showerror(message= f"An unexpected error occurred: {e}")
         
 
 
-def graph(pie, pies_size, crypto_colors):
+# What to tell the user once the trade writer has applied a trade
+TRADE_MESSAGES = {
+    "added": (messagebox.showinfo, 'You have added {sign}{cost:.2f} of {symbol}'),
+    "bought": (messagebox.showinfo, 'You have bought {sign}{cost:.2f} of {symbol}'),
+    "updated": (messagebox.showinfo, 'You have sold {sign}{cost:.2f} of {symbol}'),
+    "deleted": (messagebox.showinfo, 'You have sold all of your {symbol}, it has been deleted from your portfolio'),
+    "not_enough": (messagebox.showerror, 'You dont have enough {symbol} available to sell'),
+    "not_held": (messagebox.showerror, 'You do not own any {symbol} to sell'),
+}
+
+TRADE_POLL_MS = 200
+trade_journal = TradeJournal(os.getenv('TRADE_JOURNAL_PATH', 'trade_journal.db'))
+trade_writer = TradeWriter(trade_journal)
+
+
+def update_trade_status(error=None):
+
+    """
+    Shows how many trades are waiting to be saved to the database, and why
+    if it can't be reached
+    """
+
+    waiting = trade_journal.pending_count()
+    if not waiting:
+        trade_status_label.config(text="")
+    elif error is not None:
+        trade_status_label.config(text=f"{waiting} trades waiting for the database ({error})", fg="red")
+    else:
+        trade_status_label.config(text=f"Saving {waiting} trades...", fg="grey")
+
+
+def poll_trade_results():
+
+    """
+    Runs on the Tk thread every TRADE_POLL_MS and reports what the trade
+    writer has done since the last poll
+    """
+
+    refresh = False
+    error = None
+    try:
+        while True:
+            kind, _, trade, detail = trade_writer.results.get_nowait()
+            if kind == "applied" and detail in TRADE_MESSAGES:
+                show, message = TRADE_MESSAGES[detail]
+                # Trades are entered in the base currency
+                show(message=message.format(sign=currency_sign(BASE_CURRENCY), **trade))
+            elif kind == "failed":
+                messagebox.showerror(message=f"Could not save your {trade['symbol']} trade: {detail}")
+            elif kind == "offline":
+                error = detail
+            elif kind == "positions":
+                set_coins(detail)
+                refresh = True
+    except queue.Empty:
+        pass
+
+    if refresh:
+        refresh_portfolio()
+    if error is not None or refresh:
+        update_trade_status(error)
+
+    win.after(TRADE_POLL_MS, poll_trade_results)
+
+
+def import_data():
+
+    """
+    Asks for a CSV or JSON file of trades, bulk loads it into the database and
+    reports how many rows were imported or rejected
+    """
+
+    path = filedialog.askopenfilename(title="Import trades", filetypes=[("Trade files", "*.csv *.json *.jsonl"), ("All files", "*.*")])
+    if not path:
+        return
+
+    try:
+        result = import_trades(path)
+    except Exception as e:
+        messagebox.showerror(message=f"Error importing trades: {e}")
+        return
+
+    message = f"Imported {result['imported']} trades ({result['rows_per_sec']:.0f} rows/sec)"
+    if result["rejected"]:
+        message += f"\n{result['rejected']} rows were rejected, see {result['error_path']}"
+    messagebox.showinfo(message=message)
+
+    reload_coins()
+    refresh_portfolio()
+
+
+class SymbolColors:
+
+    """
+    Gives every symbol the same colour for the whole session, so a coin keeps
+    its colour as the chart is redrawn
+    """
+
+    OTHER_COLOR = "#BDBDBD"
+
+    def __init__(self):
+        from matplotlib import colormaps
+
+        # Qualitative palettes first, they are easiest to tell apart
+        self.palette = [colormaps[name](index) for name in ("tab20", "tab20b", "tab20c") for index in range(20)]
+        self.colors = {}
+
+    def __getitem__(self, symbol):
+        if symbol == "Other":
+            return self.OTHER_COLOR
+        color = self.colors.get(symbol)
+        if color is None:
+            color = self.colors[symbol] = self.palette[len(self.colors) % len(self.palette)]
+        return color
+
+
+class PortfolioChart:
+
+    """
+    Pie chart of the portfolio embedded in a Tk window with FigureCanvasTkAgg.
+
+    update() moves the existing wedges to the new shares in place when the
+    coins on the chart are the same as last time, and only redraws the pie
+    when a slice is added or removed.
+    """
+
+    def __init__(self, master):
+        # matplotlib is slow to import, so it is only loaded once a chart is asked for
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        self.figure = Figure(figsize=(5, 4))
+        self.axes = self.figure.add_subplot()
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.canvas.get_tk_widget().pack(fill=BOTH, expand=True)
+        self.colors = SymbolColors()
+        self.wedges = {}
+
+    def update(self, labels, sizes):
+        labels, sizes = pie_slices(labels, sizes, max_slices=PIE_MAX_SLICES, min_share=PIE_MIN_SHARE)
+        if set(labels) == set(self.wedges) and labels:
+            self._move_wedges(dict(zip(labels, sizes)))
+        else:
+            self._draw(labels, sizes)
+        self.canvas.draw_idle()
+
+    def _move_wedges(self, shares):
+        # Keep the wedges in the order they were drawn so nothing jumps about
+        total = sum(shares.values())
+        angle = 90.0
+        for label, wedge in self.wedges.items():
+            span = 360.0 * shares[label] / total
+            wedge.set_theta1(angle)
+            wedge.set_theta2(angle + span)
+            angle += span
+
+    def _draw(self, labels, sizes):
+        self.axes.clear()
+        self.axes.axis('equal')
+        if not labels:
+            self.wedges = {}
+            self.axes.text(0.5, 0.5, "No holdings to chart", ha="center", va="center", transform=self.axes.transAxes)
+            self.axes.set_axis_off()
+            return
+        patches, _ = self.axes.pie(sizes, colors=[self.colors[label] for label in labels], startangle=90)
+        self.axes.legend(patches, labels, loc="best")
+        self.wedges = dict(zip(labels, patches))
+
+
+PIE_MAX_SLICES = int(os.getenv('PIE_MAX_SLICES', '10'))
+PIE_MIN_SHARE = float(os.getenv('PIE_MIN_SHARE', '0.02'))
+portfolio_chart = None
+
+
+def graph(pie, pies_size):
         
         """
-        Generates a pie chart to show proprtions of cryptocurrency holdings
-        in the portfolio
+        Shows a pie chart of the proportions of cryptocurrency holdings in
+        the portfolio, in its own window that is kept up to date as prices
+        and trades change
         """
 
-        labels = pie
-        sizes = pies_size
-        colors = crypto_colors
-        patches, texts = plt.pie(sizes, colors=colors, shadow=True, startangle=90)
-        plt.legend(patches, labels, loc="best")
-        plt.axis('equal')
-        plt.tight_layout()
-        plt.show()
+        global portfolio_chart
+        if portfolio_chart is not None:
+            portfolio_chart.canvas.get_tk_widget().winfo_toplevel().lift()
+            return
+
+        def close():
+            global portfolio_chart
+            portfolio_chart = None
+            chart_window.destroy()
+
+        chart_window = Toplevel(win)
+        chart_window.title("Portfolio")
+        chart_window.protocol("WM_DELETE_WINDOW", close)
+        portfolio_chart = PortfolioChart(chart_window)
+        portfolio_chart.update(pie, pies_size)
+
+
+# Diagnostics popup
+
+METRICS_PATH = os.getenv('FOLIO_METRICS_PATH', 'folio_metrics.prom')
+METRICS_JSONL_PATH = os.getenv('FOLIO_METRICS_JSONL_PATH', 'folio_metrics.jsonl')
+
+
+def diagnostics_text():
+
+    """
+    Formats the recorded timings, payload sizes and connection pool counters
+    as a plain text table
+    """
+
+    lines = [f"{'Operation':<22}{'Metric':<16}{'Count':>8}{'p50':>12}{'p95':>12}{'Total':>12}"]
+    for series in registry.snapshot():
+        metric = series["metric"].replace("folio_", "")
+        if series["type"] == "counter":
+            lines.append(f"{series['operation']:<22}{metric:<16.16}{series['value']:>8}")
+        elif series["metric"].endswith("_seconds"):
+            lines.append(f"{series['operation']:<22}{metric:<16.16}{series['count']:>8}"
+                         f"{series['p50'] * 1000:>10.1f}ms{series['p95'] * 1000:>10.1f}ms{series['sum']:>11.2f}s")
+        else:
+            lines.append(f"{series['operation']:<22}{metric:<16.16}{series['count']:>8}"
+                         f"{series['p50']:>12.0f}{series['p95']:>12.0f}{series['sum']:>12.0f}")
+
+    stats = pool_stats()
+    if stats is not None:
+        lines.append("")
+        lines.append("Connection pool: " + ", ".join(f"{name} {value:.3f}" if isinstance(value, float) else f"{name} {value}" for name, value in stats.items()))
+
+    stats = api_client_stats()
+    if stats is not None:
+        lines.append("CoinMarketCap: " + ", ".join(f"{name} {value}" for name, value in stats.items()))
+    return "\n".join(lines)
+
+
+def diagnostics():
+
+    """
+    Creates diagnostics popup window showing where time is being spent,
+    refreshed every couple of seconds while it is open
+    """
+
+    win3 = Toplevel(win)
+    win3.title("Diagnostics")
+
+    diagnostics_body = Text(win3, width=84, height=24, font=("Courier", 10))
+    diagnostics_body.grid(row=0, column=0, columnspan=2, padx=20, pady=20)
+
+    def refresh():
+        if not win3.winfo_exists():
+            return
+        diagnostics_body.delete("1.0", END)
+        diagnostics_body.insert("1.0", diagnostics_text())
+        win3.after(2000, refresh)
+
+    def export():
+        try:
+            export_prometheus(METRICS_PATH)
+            export_json_lines(METRICS_JSONL_PATH)
+        except OSError as e:
+            messagebox.showerror(message=f"Error exporting metrics: {e}", parent=win3)
+            return
+        messagebox.showinfo(message=f"Metrics written to {METRICS_PATH} and {METRICS_JSONL_PATH}", parent=win3)
+
+    export_button = Button(win3, text="Export", bg="#FF9800", fg="black", command=export)
+    export_button.grid(row=1, column=1, pady=(0, 20))
+
+    refresh()
+
+
+# Price alerts
+
+alert_window = None
+
+
+def show_alert(alert):
+
+    """
+    Adds a fired alert to the alerts popup, opening it if it isn't open.
+    The popup isn't modal, so alerts never hold up the price polling.
+    """
+
+    global alert_window, alert_list
+    if alert_window is None or not alert_window.winfo_exists():
+        alert_window = Toplevel(win)
+        alert_window.title("Price Alerts")
+        alert_list = Listbox(alert_window, width=70, height=10)
+        alert_list.grid(row=0, column=0, padx=20, pady=20)
+        dismiss_button = Button(alert_window, text="Dismiss", bg="#FF9800", fg="black", command=alert_window.destroy)
+        dismiss_button.grid(row=1, column=0, pady=(0, 20))
+    fired = time.strftime("%H:%M:%S", time.localtime(alert.fired_at))
+    # Alert thresholds are in the base currency
+    sign = currency_sign(BASE_CURRENCY)
+    alert_list.insert(0, f"{fired}  {alert.rule.describe(sign)}, now {alert.rule.format(alert.value, sign)}")
+    alert_window.lift()
+    alert_window.bell()
+
+
+alert_book = AlertBook(AlertStore(os.getenv('ALERTS_PATH', 'alerts.db')), sinks=[log_sink, show_alert], currency=BASE_CURRENCY)
+
+
+def check_alerts():
+
+    """
+    Evaluates the alert rules against the held coins' quotes and the market
+    listings, called whenever either of them changes
+    """
+
+    alert_book.check(coins, price_book, market_book)
+
+
+def alerts():
+
+    """
+    Creates the alerts popup window, listing the rules and letting them be
+    added and deleted
+    """
+
+    win4 = Toplevel(win)
+    win4.title("Alerts")
+
+    rule_list = Listbox(win4, width=60, height=10)
+    rule_list.grid(row=0, column=0, columnspan=6, padx=20, pady=20)
+    shown_rules = []
+
+    def show_rules():
+        rule_list.delete(0, END)
+        shown_rules[:] = sorted(alert_book.rules(), key=lambda rule: (rule.symbol, rule.metric, rule.threshold))
+        for rule in shown_rules:
+            state = "" if rule.armed else "  (fired, waiting to re-arm)"
+            rule_list.insert(END, rule.describe(currency_sign(BASE_CURRENCY)) + state)
+
+    symbol_label = Label(win4, text="Ticker", bg="#FF9800", fg="black")
+    symbol_label.grid(row=1, column=0, padx=(20, 5))
+    symbol_entry = Entry(win4, width=10)
+    symbol_entry.grid(row=2, column=0, padx=(20, 5))
+    Autocomplete(symbol_entry)
+
+    metric_var = StringVar(value="price")
+    metric_menu = OptionMenu(win4, metric_var, *METRICS)
+    metric_menu.grid(row=2, column=1)
+
+    direction_var = StringVar(value="below")
+    direction_menu = OptionMenu(win4, direction_var, *DIRECTIONS)
+    direction_menu.grid(row=2, column=2)
+
+    threshold_label = Label(win4, text="Threshold", bg="#FF9800", fg="black")
+    threshold_label.grid(row=1, column=3, padx=5)
+    threshold_entry = Entry(win4, width=10)
+    threshold_entry.grid(row=2, column=3, padx=5)
+
+    hysteresis_label = Label(win4, text="Hysteresis", bg="#FF9800", fg="black")
+    hysteresis_label.grid(row=1, column=4, padx=5)
+    hysteresis_entry = Entry(win4, width=10)
+    hysteresis_entry.grid(row=2, column=4, padx=5)
+
+    cooldown_label = Label(win4, text="Cooldown (s)", bg="#FF9800", fg="black")
+    cooldown_label.grid(row=1, column=5, padx=(5, 20))
+    cooldown_entry = Entry(win4, width=10)
+    cooldown_entry.grid(row=2, column=5, padx=(5, 20))
+
+    def add_rule():
+        try:
+            alert_book.add(symbol_entry.get(), metric_var.get(), direction_var.get(), threshold_entry.get(),
+                           hysteresis_entry.get(), cooldown_entry.get())
+        except ValueError as e:
+            messagebox.showerror("Invalid Input", str(e), parent=win4)
+            return
+        for entry in (symbol_entry, threshold_entry, hysteresis_entry, cooldown_entry):
+            entry.delete(0, END)
+        show_rules()
+        # A rule that is already past its threshold fires straight away
+        check_alerts()
+
+    def delete_rule():
+        for index in rule_list.curselection():
+            alert_book.remove(shown_rules[index].rule_id)
+        show_rules()
+
+    add_rule_button = Button(win4, text="Add", bg="#FF9800", fg="black", command=add_rule)
+    add_rule_button.grid(row=3, column=0, columnspan=3, pady=20)
+    delete_rule_button = Button(win4, text="Delete", bg="#FF9800", fg="black", command=delete_rule)
+    delete_rule_button.grid(row=3, column=3, columnspan=3, pady=20)
+
+    show_rules()
 
 
 # Instructions popup
@@ -750,7 +1213,7 @@ def price_checker():
     win2 = Tk()
     win2.title("Price Checker")
     
-    coin_ticker_label = Label(win2, text="Enter the coin ticker")
+    coin_ticker_label = Label(win2, text="Enter a coin ticker or name")
     coin_ticker_label.grid(row=0, pady=20, padx=20)
     
     coin_ticker_entry = Entry(win2)
@@ -763,29 +1226,29 @@ def price_checker():
     def check_price():
 
         """
-        Gets symbol from entry box and matches it to a symbol from api
-        data that has been interated over, if match found will show price
+        Gets a ticker or name from the entry box and looks it up, an exact
+        ticker first and then the best search match, if match found will
+        show price
 
         if no match will show error message
         """
-        entered_symbol = coin_ticker_entry.get().upper()
+        entered_text = coin_ticker_entry.get().strip()
         
         try:
-            # Check if the input is alphabetic
-            if not entered_symbol.isalpha() or len(entered_symbol) > 6:
-                raise ValueError("The coin ticker must be alphabetical and max lenth of 6")
-            
-
-            
+            if not entered_text:
+                raise ValueError("Enter a coin ticker or name")
 
             # Check if the coin is in the API data
-            for coin in api_data["data"]:
-                if coin["symbol"] == entered_symbol:
-                    crypto_price = coin["quote"]["GBP"]["price"]
-                    crypto_price_label.config(text=f'The price of {entered_symbol} is £{crypto_price:.2f}')
-                    crypto_price_label.grid(row=3, pady=20, padx=20)
-                    coin_ticker_entry.delete(0, 'end')
-                    break  # Exit the loop after finding the coin
+            listing = find_listing(entered_text.upper())
+            if listing is None:
+                matches = search_index.search(entered_text, 1)
+                listing = matches[0] if matches else None
+            if listing is not None:
+                entered_symbol = listing["symbol"]
+                crypto_price = listing["quote"][BASE_CURRENCY]["price"] * fx_rates_table[display_currency]
+                crypto_price_label.config(text=f'The price of {entered_symbol} is {money(crypto_price)}')
+                crypto_price_label.grid(row=3, pady=20, padx=20)
+                coin_ticker_entry.delete(0, 'end')
             else:
                 # If no match is found
                 crypto_price_label.config(text=f"Coin not found")
@@ -796,6 +1259,9 @@ def price_checker():
 
         coin_ticker_entry.delete(0, 'end')
 
+    ticker_autocomplete = Autocomplete(coin_ticker_entry, on_select=lambda listing: check_price())
+    coin_ticker_entry.bind("<Return>", lambda event: (ticker_autocomplete.hide(), check_price()))
+
     checker_button = Button(win2, text="Check Price", bg="#FF9800", fg="black", command=check_price)
     checker_button.grid(row=2, pady=20)
     
@@ -825,11 +1291,82 @@ add_button = Button(entry_widget_frame, text="Add", bg="#FF9800", fg="black", co
 add_button.grid(row=3, column=3, pady=5)
 
 # Button to generate pie chart
-graph_button = Button(entry_widget_frame, text="Pie Chart", bg="#FF9800", fg="black", command= lambda: graph(pie, pies_size, crypto_colors))
+graph_button = Button(entry_widget_frame, text="Pie Chart", bg="#FF9800", fg="black", command= lambda: graph(pie, pies_size))
 graph_button.grid(row=3, column=4, pady=5)
 
+# Bulk import button
+import_button = Button(entry_widget_frame, text="Import", bg="#FF9800", fg="black", command=import_data)
+import_button.grid(row=3, column=5, pady=5)
+
 # Price checker button
 price_checker_button= Button(entry_widget_frame, text="Price Checker", bg="#FF9800", fg="black", command= price_checker)
 price_checker_button.grid(row=3, column=6, pady=5)
 
-win.mainloop()
\ No newline at end of file
+# Diagnostics button
+diagnostics_button = Button(entry_widget_frame, text="Diagnostics", bg="#FF9800", fg="black", command=diagnostics)
+diagnostics_button.grid(row=4, column=6, pady=5)
+
+# Price alerts button
+alerts_button = Button(entry_widget_frame, text="Alerts", bg="#FF9800", fg="black", command=alerts)
+alerts_button.grid(row=4, column=5, pady=5)
+
+# Display currency menu
+display_currency_var = StringVar(value=display_currency)
+currency_menu = OptionMenu(entry_widget_frame, display_currency_var, *DISPLAY_CURRENCIES, command=set_display_currency)
+currency_menu.config(bg="#FF9800", fg="black")
+currency_menu.grid(row=4, column=4, pady=5)
+
+# Code inside this block runs only when the script is executed directly
+if __name__ == "__main__":
+    api_key = get_api_key()
+    if api_key:
+        # The default intervals fit the default daily credit budget of 333:
+        #   held-coin quotes, 1 credit per 100 coins every 360s   240 a day
+        #   top 1000 listings, 5 credits every 14400s              30 a day
+        #   2 exchange rates, 1 credit each every 21600s            8 a day
+        # which leaves about 55 for price checker lookups. Anything that
+        # pushes past the budget loses the listings and rates first.
+        # Held coins are quoted by symbol, so we only pay for what we hold
+        price_refresher = PriceRefresher(api_key, interval=float(os.getenv('PRICE_REFRESH_INTERVAL', '360')), store=snapshot_store,
+                                         fetch=lambda: fetch_quotes(api_key, symbols=[coin.symbol for coin in coins]))
+        if api_data is not None:
+            price_refresher.cache.set(PriceRefresher.CACHE_KEY, api_data, prices_fetched_at)
+        price_refresher.start()
+
+        # MARKET_LISTINGS_LIMIT=0 fetches the whole market
+        market_limit = int(os.getenv('MARKET_LISTINGS_LIMIT', '1000')) or None
+        market_refresher = PriceRefresher(api_key, interval=float(os.getenv('MARKET_REFRESH_INTERVAL', '14400')), name="market-refresher",
+                                          fetch=lambda: fetch_all_listings(api_key, limit=market_limit))
+        market_refresher.start()
+
+        # Exchange rates for the display currencies, cached apart from the quotes
+        fx_rates = FXRates(api_key, base=BASE_CURRENCY, ttl=float(os.getenv('FX_RATE_TTL', '21600')))
+        fx_refresher = PriceRefresher(api_key, interval=fx_rates.ttl, name="fx-refresher",
+                                      fetch=lambda: fx_rates.refresh(DISPLAY_CURRENCIES[1:]))
+        fx_refresher.start()
+        win.after(PRICE_POLL_MS, poll_price_updates)
+    else:
+        print("API key is missing.")
+
+    update_prices_as_of()
+
+    # Replays any trades left in the journal by an earlier session
+    trade_writer.start()
+    update_trade_status()
+    win.after(TRADE_POLL_MS, poll_trade_results)
+
+win.mainloop()
+
+trade_writer.stop()
+
+if price_refresher is not None:
+    price_refresher.stop()
+    market_refresher.stop()
+    fx_refresher.stop()
+    close_api_client()
+
+close_connection_pool()
+
+# Keep the session's timings if a metrics file has been asked for
+if os.getenv('FOLIO_METRICS_PATH'):
+    export_prometheus(METRICS_PATH)
\ No newline at end of file
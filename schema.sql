@@ -0,0 +1,109 @@
+-- Folio database schema (SQL Server)
+--
+-- Every statement is guarded so the script can be run again safely against
+-- an existing database.
+
+-- Coins the portfolio has ever held
+IF OBJECT_ID('dbo.cryptocurrencies', 'U') IS NULL
+    CREATE TABLE cryptocurrencies (
+        crypto_id INT NOT NULL PRIMARY KEY,
+        symbol NVARCHAR(10) NOT NULL,
+        name NVARCHAR(100) NOT NULL
+    );
+GO
+
+-- One coin per ticker, so trades can be resolved from the ticker to the
+-- primary key once and then target crypto_id. Tickers that are already
+-- duplicated have to be merged before this can be created.
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ux_cryptocurrencies_symbol')
+    CREATE UNIQUE INDEX ux_cryptocurrencies_symbol ON cryptocurrencies (symbol);
+GO
+
+-- Append-only ledger with one row per buy ('B') or sell ('S'). Rows are
+-- never updated or deleted.
+IF OBJECT_ID('dbo.trades', 'U') IS NULL
+    CREATE TABLE trades (
+        trade_id INT IDENTITY(1, 1) NOT NULL PRIMARY KEY,
+        crypto_id INT NOT NULL REFERENCES cryptocurrencies (crypto_id),
+        transaction_id INT NULL,           -- the Trans ID entered in the app
+        side CHAR(1) NOT NULL CHECK (side IN ('B', 'S')),
+        quantity FLOAT NOT NULL CHECK (quantity > 0),
+        price FLOAT NOT NULL,
+        cost FLOAT NOT NULL,               -- total paid for a buy, total received for a sell
+        traded_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+        import_batch CHAR(32) NULL,        -- set for trades loaded by a bulk import
+        journal_id CHAR(32) NULL           -- set for trades replayed from the app's local trade journal
+    );
+GO
+
+IF COL_LENGTH('dbo.trades', 'journal_id') IS NULL
+    ALTER TABLE trades ADD journal_id CHAR(32) NULL;
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_trades_crypto_id')
+    CREATE INDEX ix_trades_crypto_id ON trades (crypto_id, trade_id);
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_trades_import_batch')
+    CREATE INDEX ix_trades_import_batch ON trades (import_batch) WHERE import_batch IS NOT NULL;
+GO
+
+-- A journaled trade is applied at most once, even if the app replays it
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ux_trades_journal_id')
+    CREATE UNIQUE INDEX ux_trades_journal_id ON trades (journal_id) WHERE journal_id IS NOT NULL;
+GO
+
+-- Open FIFO lots. There is one row per buy that still has coins left, and
+-- sells use up the oldest lots first. Lots that are used up are deleted, so
+-- this table only grows with the number of open lots.
+IF OBJECT_ID('dbo.lots', 'U') IS NULL
+    CREATE TABLE lots (
+        trade_id INT NOT NULL PRIMARY KEY REFERENCES trades (trade_id),
+        crypto_id INT NOT NULL REFERENCES cryptocurrencies (crypto_id),
+        remaining_quantity FLOAT NOT NULL,
+        unit_cost FLOAT NOT NULL
+    );
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_lots_crypto_id')
+    CREATE INDEX ix_lots_crypto_id ON lots (crypto_id, trade_id);
+GO
+
+-- Current holdings with one row per coin held. The row is updated in the
+-- same transaction as every trade and deleted when the coin is sold out.
+-- Both the average cost and FIFO cost bases are kept as running totals.
+IF OBJECT_ID('dbo.positions', 'U') IS NULL
+    CREATE TABLE positions (
+        crypto_id INT NOT NULL PRIMARY KEY REFERENCES cryptocurrencies (crypto_id),
+        quantity FLOAT NOT NULL,
+        average_cost_basis FLOAT NOT NULL,
+        fifo_cost_basis FLOAT NOT NULL,
+        realized_pnl_average FLOAT NOT NULL DEFAULT 0,
+        realized_pnl_fifo FLOAT NOT NULL DEFAULT 0,
+        last_trade_id INT NOT NULL
+    );
+GO
+
+-- One-off migration from the old aggregated transactions table. Each old row
+-- becomes a single buy in the ledger, an open lot and a position.
+IF OBJECT_ID('dbo.transactions', 'U') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM trades)
+BEGIN
+    BEGIN TRANSACTION;
+
+    INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost)
+    SELECT crypto_id, transaction_id, 'B', quantity, price, price * quantity
+    FROM transactions
+    WHERE quantity > 0;
+
+    INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost)
+    SELECT trade_id, crypto_id, quantity, price
+    FROM trades;
+
+    INSERT INTO positions (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id)
+    SELECT crypto_id, SUM(quantity), SUM(cost), SUM(cost), MAX(trade_id)
+    FROM trades
+    GROUP BY crypto_id;
+
+    COMMIT;
+END
+GO
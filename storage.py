@@ -0,0 +1,826 @@
+"""
+Storage backends for Folio.
+
+The database helpers in the engine validate their input and report errors,
+and leave the SQL to a storage backend. Every backend has the same methods:
+
+    add_coin(crypto_id, symbol, name)
+    record_buy(crypto_id, transaction_id, quantity, price, cost)
+    find_coin(symbol) -> crypto_id, or None if there is no coin with that ticker
+    record_sell(crypto_id, transaction_id, quantity, proceeds) -> "updated", "deleted" or "not_enough"
+    apply_trades(entries) -> one status per trade, see apply_trades below
+    iter_positions(basis, arraysize) -> Position records, streamed
+    fetch_positions(basis) -> list of Position records
+    import_coins() -> {symbol: crypto_id}
+    import_batch(new_coins, trades)
+
+and a pool attribute holding its ConnectionPool, errors, the exception type
+its driver raises, and transient_errors, the subset that mean the database
+couldn't be reached rather than that it rejected a statement.
+is_transient(error) says whether one of its errors is worth retrying.
+
+SQLServerStorage runs T-SQL against SQL Server over ODBC. SQLiteStorage keeps
+the same tables in a local SQLite file, for a single user desk, or to run the
+benchmarks, without a SQL Server instance.
+"""
+
+import os
+import logging
+import threading
+import time
+import sqlite3
+import uuid
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+from instrumentation import registry, timed
+
+
+# Connections
+
+@timed("db_connect")
+def get_database_connection():
+    import pyodbc
+
+    connection_string = os.getenv('DATABASE_CONNECTION_STRING')
+    if not connection_string:
+        raise ValueError("DATABASE_CONNECTION_STRING is not set in the environment variables.")
+    try:
+        logging.debug(f"Attempting to connect with connection string: {connection_string}")
+        return pyodbc.connect(connection_string)
+    except pyodbc.Error as e:
+        logging.error(f"Database connection error: {e}")
+        raise
+
+
+class ConnectionPool:
+
+    """
+    Keeps a set of open database connections that the query helpers borrow
+    and hand back, so a click in the GUI doesn't pay for a new ODBC handshake
+    on every query.
+
+    Idle connections are closed once they have been unused for longer than
+    idle_timeout seconds, and a connection that has been idle for longer than
+    health_check_interval is checked with a cheap query before it is handed
+    out. Connections that fail are thrown away and replaced by a new one.
+
+    errors is the exception type (or tuple of types) the database driver
+    raises, so the pool can tell a broken connection from a bug in the caller.
+    """
+
+    def __init__(self, connect, errors, size=5, idle_timeout=300, health_check_interval=30, acquire_timeout=10):
+        self._connect = connect
+        self.errors = errors
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = deque()  # (connection, time it was returned)
+        self._open = 0
+        self._condition = threading.Condition()
+
+        self.stats = {
+            "hits": 0,          # connection reused from the pool
+            "misses": 0,        # new connection had to be opened
+            "waits": 0,         # times a caller had to wait for a free connection
+            "wait_time": 0.0,   # total seconds spent waiting for a free connection
+            "connect_time": 0.0,  # total seconds spent opening connections
+            "reconnects": 0,    # broken connections that were replaced
+            "evicted": 0,       # idle connections closed by the pool
+        }
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except self.errors:
+            pass
+
+    def _evict_idle(self):
+        # Oldest connections are at the left of the deque
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.popleft()
+            self._open -= 1
+            self.stats["evicted"] += 1
+            self._close_quietly(connection)
+
+    def _open_connection(self):
+        start = time.perf_counter()
+        try:
+            return self._connect()
+        finally:
+            self.stats["connect_time"] += time.perf_counter() - start
+
+    def _is_healthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except self.errors as e:
+            logging.warning(f"Discarding broken pooled connection: {e}")
+            return False
+
+    def acquire(self):
+
+        """
+        Returns an open connection, reusing an idle one when possible
+        """
+
+        connection = None
+        last_used = None
+        waited = False
+        start = time.perf_counter()
+
+        with self._condition:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    self.stats["hits"] += 1
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    self.stats["misses"] += 1
+                    break
+
+                remaining = self.acquire_timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a free database connection")
+                waited = True
+                self._condition.wait(remaining)
+
+            if waited:
+                self.stats["waits"] += 1
+                self.stats["wait_time"] += time.perf_counter() - start
+                registry.observe("folio_pool_wait_seconds", "acquire", time.perf_counter() - start)
+
+        try:
+            if connection is not None and time.monotonic() - last_used > self.health_check_interval:
+                if not self._is_healthy(connection):
+                    self._close_quietly(connection)
+                    connection = None
+                    self.stats["reconnects"] += 1
+            if connection is None:
+                connection = self._open_connection()
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+        return connection
+
+    def release(self, connection, discard=False):
+
+        """
+        Hands a connection back to the pool, or closes it if discard is True
+        """
+
+        with self._condition:
+            if discard:
+                self._open -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+        if discard:
+            self._close_quietly(connection)
+
+    @contextmanager
+    def connection(self):
+
+        """
+        Borrows a connection for the duration of a with block. Uncommitted work
+        is rolled back if the block raises, and a connection that hit a
+        database error is replaced rather than reused.
+        """
+
+        connection = self.acquire()
+        try:
+            yield connection
+        except self.errors:
+            self.release(connection, discard=True)
+            raise
+        except BaseException:
+            # Includes GeneratorExit, from a streaming generator closed early
+            try:
+                connection.rollback()
+            except self.errors:
+                self.release(connection, discard=True)
+                raise
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def close_all(self):
+
+        """
+        Closes every idle connection, used when the app shuts down
+        """
+
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._open -= 1
+                self._close_quietly(connection)
+
+
+# Current holdings, one row per coin held. {basis} is the cost basis column,
+# average_cost_basis or fifo_cost_basis.
+FETCH_POSITIONS_QUERY = """
+    SELECT c.crypto_id, c.symbol, c.name,
+           p.last_trade_id, p.quantity, p.{basis} / p.quantity, p.{basis}
+    FROM positions p
+    JOIN cryptocurrencies c ON c.crypto_id = p.crypto_id
+    ORDER BY c.crypto_id ASC
+"""
+
+BASIS_COLUMNS = {"average": "average_cost_basis", "fifo": "fifo_cost_basis"}
+
+# One held coin. A named tuple has no per-row __dict__, so it is as compact
+# as the plain row, and it still unpacks and indexes like one.
+Position = namedtuple("Position", ["crypto_id", "symbol", "name", "last_trade_id", "quantity", "unit_cost", "cost_basis"])
+
+def fetch_arraysize():
+
+    """
+    Rows fetched per round trip when streaming positions, from
+    DATABASE_FETCH_ARRAYSIZE. Read on each call, so a value from the .env
+    file loaded after import is still used.
+    """
+
+    value = os.getenv('DATABASE_FETCH_ARRAYSIZE', '500')
+    try:
+        arraysize = int(value)
+    except ValueError:
+        arraysize = 0
+    if arraysize < 1:
+        logging.warning(f"DATABASE_FETCH_ARRAYSIZE must be a positive integer, not {value!r}, using 500")
+        return 500
+    return arraysize
+
+
+def stream_positions(cursor, arraysize):
+
+    """
+    Yields a Position for each row of an executed positions query, fetching
+    arraysize rows at a time so only one batch is held in memory
+    """
+
+    cursor.arraysize = arraysize
+    try:
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                return
+            for row in rows:
+                yield Position._make(row)
+    finally:
+        # Drops any unread rows, so the connection can go back to the pool
+        cursor.close()
+
+
+# SQL Server
+#
+# Trades are appended to the trades ledger, and the open FIFO lots and the
+# positions row for the coin are updated in the same transaction. See
+# schema.sql for the tables.
+
+BUY_QUERY = """
+    SET NOCOUNT ON;
+
+    DECLARE @crypto_id INT = ?, @transaction_id INT = ?, @quantity FLOAT = ?, @price FLOAT = ?,
+            @cost FLOAT = ?, @journal_id CHAR(32) = ?;
+    DECLARE @trade_id INT;
+
+    INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost, journal_id)
+    VALUES (@crypto_id, @transaction_id, 'B', @quantity, @price, @cost, @journal_id);
+    SET @trade_id = SCOPE_IDENTITY();
+
+    INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost)
+    VALUES (@trade_id, @crypto_id, @quantity, @cost / @quantity);
+
+    UPDATE positions WITH (UPDLOCK, HOLDLOCK)
+    SET quantity = quantity + @quantity,
+        average_cost_basis = average_cost_basis + @cost,
+        fifo_cost_basis = fifo_cost_basis + @cost,
+        last_trade_id = @trade_id
+    WHERE crypto_id = @crypto_id;
+
+    IF @@ROWCOUNT = 0
+        INSERT INTO positions (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id)
+        VALUES (@crypto_id, @quantity, @cost, @cost, @trade_id);
+"""
+
+SELL_QUERY = """
+    SET NOCOUNT ON;
+
+    DECLARE @crypto_id INT = ?, @transaction_id INT = ?, @quantity FLOAT = ?, @proceeds FLOAT = ?,
+            @journal_id CHAR(32) = ?;
+    DECLARE @held FLOAT, @average_cost_basis FLOAT, @trade_id INT;
+
+    SELECT @held = quantity, @average_cost_basis = average_cost_basis
+    FROM positions WITH (UPDLOCK, HOLDLOCK)
+    WHERE crypto_id = @crypto_id;
+
+    IF @held IS NULL OR @held < @quantity
+        SELECT 'not_enough';
+    ELSE
+    BEGIN
+        -- Work out how much comes out of each open lot, oldest first
+        DECLARE @used TABLE (trade_id INT PRIMARY KEY, quantity FLOAT, unit_cost FLOAT);
+
+        INSERT INTO @used (trade_id, quantity, unit_cost)
+        SELECT trade_id,
+               CASE WHEN running_total <= @quantity THEN remaining_quantity
+                    ELSE @quantity - (running_total - remaining_quantity) END,
+               unit_cost
+        FROM (
+            SELECT trade_id, remaining_quantity, unit_cost,
+                   SUM(remaining_quantity) OVER (ORDER BY trade_id ROWS UNBOUNDED PRECEDING) AS running_total
+            FROM lots
+            WHERE crypto_id = @crypto_id
+        ) open_lots
+        WHERE running_total - remaining_quantity < @quantity;
+
+        UPDATE l
+        SET l.remaining_quantity = l.remaining_quantity - u.quantity
+        FROM lots l
+        JOIN @used u ON l.trade_id = u.trade_id;
+
+        DELETE FROM lots WHERE crypto_id = @crypto_id AND remaining_quantity <= 0;
+
+        DECLARE @fifo_cost FLOAT = (SELECT COALESCE(SUM(quantity * unit_cost), 0) FROM @used);
+        DECLARE @average_cost FLOAT = @average_cost_basis * @quantity / @held;
+
+        INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost, journal_id)
+        VALUES (@crypto_id, @transaction_id, 'S', @quantity, @proceeds / @quantity, @proceeds, @journal_id);
+        SET @trade_id = SCOPE_IDENTITY();
+
+        IF @held = @quantity
+        BEGIN
+            DELETE FROM lots WHERE crypto_id = @crypto_id;
+            DELETE FROM positions WHERE crypto_id = @crypto_id;
+            SELECT 'deleted';
+        END
+        ELSE
+        BEGIN
+            UPDATE positions
+            SET quantity = quantity - @quantity,
+                average_cost_basis = average_cost_basis - @average_cost,
+                fifo_cost_basis = fifo_cost_basis - @fifo_cost,
+                realized_pnl_average = realized_pnl_average + @proceeds - @average_cost,
+                realized_pnl_fifo = realized_pnl_fifo + @proceeds - @fifo_cost,
+                last_trade_id = @trade_id
+            WHERE crypto_id = @crypto_id;
+            SELECT 'updated';
+        END
+    END
+"""
+
+IMPORT_LOTS_QUERY = """
+    INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost)
+    SELECT trade_id, crypto_id, quantity, cost / quantity
+    FROM trades
+    WHERE import_batch = ?
+"""
+
+IMPORT_POSITIONS_QUERY = """
+    MERGE positions WITH (HOLDLOCK) AS p
+    USING (
+        SELECT crypto_id, SUM(quantity) AS quantity, SUM(cost) AS cost, MAX(trade_id) AS last_trade_id
+        FROM trades
+        WHERE import_batch = ?
+        GROUP BY crypto_id
+    ) AS b
+    ON p.crypto_id = b.crypto_id
+    WHEN MATCHED THEN UPDATE SET
+        quantity = p.quantity + b.quantity,
+        average_cost_basis = p.average_cost_basis + b.cost,
+        fifo_cost_basis = p.fifo_cost_basis + b.cost,
+        last_trade_id = b.last_trade_id
+    WHEN NOT MATCHED THEN
+        INSERT (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id)
+        VALUES (b.crypto_id, b.quantity, b.cost, b.cost, b.last_trade_id);
+"""
+
+
+class SQLServerStorage:
+
+    """
+    Folio tables on SQL Server, reached over ODBC through a connection pool.
+
+    Buys and sells are each sent as one T-SQL batch, so the ledger, the lots
+    and the position are updated in one round trip and one transaction.
+    """
+
+    # Connection failures, login and query timeouts, and deadlock victims.
+    # Constraint and data errors are the database rejecting the statement.
+    TRANSIENT_SQLSTATES = ("08", "HYT00", "HYT01", "40001")
+
+    def __init__(self, pool, transient_errors=()):
+        self.pool = pool
+        self.errors = pool.errors
+        self.transient_errors = transient_errors
+
+    def is_transient(self, error):
+        if isinstance(error, self.transient_errors):
+            return True
+        # pyodbc puts the SQLSTATE first in the exception's args
+        sqlstate = error.args[0] if error.args and isinstance(error.args[0], str) else ""
+        return sqlstate.startswith(self.TRANSIENT_SQLSTATES)
+
+    def add_coin(self, crypto_id, symbol, name):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", (crypto_id, symbol, name))
+            connection.commit()
+
+    def record_buy(self, crypto_id, transaction_id, quantity, price, cost):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(BUY_QUERY, (crypto_id, transaction_id, quantity, price, cost, None))
+            connection.commit()
+
+    def find_coin(self, symbol):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT crypto_id FROM cryptocurrencies WHERE symbol = ?", (symbol,))
+            row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def record_sell(self, crypto_id, transaction_id, quantity, proceeds):
+
+        """
+        The positions row is locked and checked for enough of the coin, then
+        the sell is appended to the ledger, the oldest open lots are used up
+        (FIFO), and the position's quantity, cost bases and realised P/L are
+        updated. A position that reaches zero is removed, the coin and its
+        history stay in the ledger. It all runs in one transaction, so two
+        sells of the same coin can't both pass the quantity check, and the
+        outcome comes back in the same round trip.
+        """
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(SELL_QUERY, (crypto_id, transaction_id, quantity, proceeds, None))
+            status = cursor.fetchone()[0]
+            connection.commit()
+        return status
+
+    def _apply(self, cursor, journal_id, trade):
+        cursor.execute("SELECT 1 FROM trades WHERE journal_id = ?", (journal_id,))
+        if cursor.fetchone() is not None:
+            return "duplicate"
+        cursor.execute("SELECT crypto_id FROM cryptocurrencies WHERE symbol = ?", (trade["symbol"],))
+        row = cursor.fetchone()
+
+        if trade["side"] == "S":
+            if row is None:
+                return "not_held"
+            cursor.execute(SELL_QUERY, (row[0], None, trade["quantity"], trade["cost"], journal_id))
+            return cursor.fetchone()[0]
+
+        if row is None:
+            cursor.execute("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)",
+                           (trade["crypto_id"], trade["symbol"], trade["name"]))
+            cursor.execute(BUY_QUERY, (trade["crypto_id"], trade["transaction_id"], trade["quantity"], trade["price"], trade["cost"], journal_id))
+            return "added"
+        cursor.execute(BUY_QUERY, (row[0], None, trade["quantity"], trade["cost"] / trade["quantity"], trade["cost"], journal_id))
+        return "bought"
+
+    def apply_trades(self, entries):
+
+        """
+        Applies (journal_id, trade) entries from the trade journal in one
+        transaction, in order, and returns a status for each one. See
+        apply_trades in the engine for the statuses.
+        """
+
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                statuses = [self._apply(cursor, journal_id, trade) for journal_id, trade in entries]
+                connection.commit()
+            except self.errors:
+                connection.rollback()
+                raise
+        return statuses
+
+    def iter_positions(self, basis="average", arraysize=None):
+
+        """
+        The pooled connection is held until the generator is used up or closed
+        """
+
+        arraysize = arraysize or fetch_arraysize()
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(FETCH_POSITIONS_QUERY.format(basis=BASIS_COLUMNS[basis]))
+            yield from stream_positions(cursor, arraysize)
+
+    def fetch_positions(self, basis="average"):
+        return list(self.iter_positions(basis))
+
+    def import_coins(self):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT crypto_id, symbol FROM cryptocurrencies")
+            return {symbol: crypto_id for crypto_id, symbol in cursor.fetchall()}
+
+    def import_batch(self, new_coins, trades):
+
+        """
+        Loads new coins and buy trades, (crypto_id, transaction_id, quantity,
+        price, cost), in one transaction. Rows go in with fast_executemany,
+        tagged with an id for the batch, and the lots and positions are then
+        updated from the tagged trades with one set-based statement each.
+        """
+
+        import_batch = uuid.uuid4().hex
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
+            try:
+                if new_coins:
+                    cursor.executemany("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", new_coins)
+                cursor.executemany(
+                    "INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost, import_batch) VALUES (?, ?, 'B', ?, ?, ?, ?)",
+                    [trade + (import_batch,) for trade in trades])
+                cursor.execute(IMPORT_LOTS_QUERY, (import_batch,))
+                cursor.execute(IMPORT_POSITIONS_QUERY, (import_batch,))
+                connection.commit()
+            except self.errors:
+                connection.rollback()
+                raise
+
+
+
+# SQLite
+
+class SQLiteStorage:
+
+    """
+    Folio tables in a local SQLite file, for a single user desk or for
+    running the benchmarks on any machine.
+
+    The file is opened in WAL mode, so reads don't wait for a write. It has
+    the same tables and indexes as schema.sql, and every statement is a
+    fixed string with ? parameters, so each pooled connection prepares it
+    once and reuses it from its statement cache. The schema version is kept
+    in PRAGMA user_version.
+    """
+
+    SCHEMA_VERSION = 3
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cryptocurrencies (
+            crypto_id INTEGER PRIMARY KEY,
+            symbol TEXT NOT NULL,
+            name TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_cryptocurrencies_symbol ON cryptocurrencies (symbol);
+
+        CREATE TABLE IF NOT EXISTS trades (
+            trade_id INTEGER PRIMARY KEY,
+            crypto_id INTEGER NOT NULL REFERENCES cryptocurrencies (crypto_id),
+            transaction_id INTEGER NULL,
+            side TEXT NOT NULL CHECK (side IN ('B', 'S')),
+            quantity REAL NOT NULL CHECK (quantity > 0),
+            price REAL NOT NULL,
+            cost REAL NOT NULL,
+            traded_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+            import_batch TEXT NULL,
+            journal_id TEXT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_trades_crypto_id ON trades (crypto_id, trade_id);
+        CREATE INDEX IF NOT EXISTS ix_trades_import_batch ON trades (import_batch) WHERE import_batch IS NOT NULL;
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_trades_journal_id ON trades (journal_id) WHERE journal_id IS NOT NULL;
+
+        CREATE TABLE IF NOT EXISTS lots (
+            trade_id INTEGER PRIMARY KEY REFERENCES trades (trade_id),
+            crypto_id INTEGER NOT NULL REFERENCES cryptocurrencies (crypto_id),
+            remaining_quantity REAL NOT NULL,
+            unit_cost REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_lots_crypto_id ON lots (crypto_id, trade_id);
+
+        CREATE TABLE IF NOT EXISTS positions (
+            crypto_id INTEGER PRIMARY KEY REFERENCES cryptocurrencies (crypto_id),
+            quantity REAL NOT NULL,
+            average_cost_basis REAL NOT NULL,
+            fifo_cost_basis REAL NOT NULL,
+            realized_pnl_average REAL NOT NULL DEFAULT 0,
+            realized_pnl_fifo REAL NOT NULL DEFAULT 0,
+            last_trade_id INTEGER NOT NULL
+        );
+    """
+
+    # Upgrades from each older schema version to the next
+    MIGRATIONS = {
+        1: "ALTER TABLE trades ADD COLUMN journal_id TEXT NULL",
+        # The unique index replacing it is created with the rest of the schema
+        2: "DROP INDEX IF EXISTS ix_cryptocurrencies_symbol",
+    }
+
+    INSERT_TRADE = "INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost, journal_id) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    ADD_TO_POSITION = """
+        INSERT INTO positions (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (crypto_id) DO UPDATE SET
+            quantity = quantity + excluded.quantity,
+            average_cost_basis = average_cost_basis + excluded.average_cost_basis,
+            fifo_cost_basis = fifo_cost_basis + excluded.fifo_cost_basis,
+            last_trade_id = excluded.last_trade_id
+    """
+
+    IMPORT_POSITIONS = """
+        INSERT INTO positions (crypto_id, quantity, average_cost_basis, fifo_cost_basis, last_trade_id)
+        SELECT crypto_id, SUM(quantity), SUM(cost), SUM(cost), MAX(trade_id)
+        FROM trades
+        WHERE import_batch = ?
+        GROUP BY crypto_id
+        ON CONFLICT (crypto_id) DO UPDATE SET
+            quantity = quantity + excluded.quantity,
+            average_cost_basis = average_cost_basis + excluded.average_cost_basis,
+            fifo_cost_basis = fifo_cost_basis + excluded.fifo_cost_basis,
+            last_trade_id = excluded.last_trade_id
+    """
+
+    def __init__(self, path, pool_size=4, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.errors = sqlite3.Error
+        # Locked or unreachable files, as opposed to constraint failures
+        self.transient_errors = (sqlite3.OperationalError,)
+
+        connection = self._connect()
+        try:
+            # WAL is a property of the file, so it only needs setting once
+            connection.execute("PRAGMA journal_mode=WAL")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version > self.SCHEMA_VERSION:
+                raise RuntimeError(f"{path} was written by a newer version of Folio (schema {version})")
+            if version:
+                for step in range(version, self.SCHEMA_VERSION):
+                    connection.execute(self.MIGRATIONS[step])
+            connection.executescript(self.SCHEMA)
+            connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            connection.commit()
+        finally:
+            connection.close()
+
+        # Connections are cheap to open, so there is no need to health check them
+        self.pool = ConnectionPool(self._connect, sqlite3.Error, size=pool_size, health_check_interval=float("inf"))
+
+    def is_transient(self, error):
+        return isinstance(error, self.transient_errors)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False, cached_statements=256)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def add_coin(self, crypto_id, symbol, name):
+        with self.pool.connection() as connection:
+            connection.execute("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", (crypto_id, symbol, name))
+            connection.commit()
+
+    def _buy(self, connection, crypto_id, transaction_id, quantity, price, cost, journal_id=None):
+        trade_id = connection.execute(self.INSERT_TRADE, (crypto_id, transaction_id, 'B', quantity, price, cost, journal_id)).lastrowid
+        connection.execute("INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost) VALUES (?, ?, ?, ?)",
+                           (trade_id, crypto_id, quantity, cost / quantity))
+        connection.execute(self.ADD_TO_POSITION, (crypto_id, quantity, cost, cost, trade_id))
+
+    def record_buy(self, crypto_id, transaction_id, quantity, price, cost):
+        with self.pool.connection() as connection:
+            self._buy(connection, crypto_id, transaction_id, quantity, price, cost)
+            connection.commit()
+
+    def find_coin(self, symbol):
+        with self.pool.connection() as connection:
+            row = connection.execute("SELECT crypto_id FROM cryptocurrencies WHERE symbol = ?", (symbol,)).fetchone()
+        return None if row is None else row[0]
+
+    def record_sell(self, crypto_id, transaction_id, quantity, proceeds):
+
+        """
+        Same steps as the SQL Server batch, run in Python inside one
+        transaction. BEGIN IMMEDIATE takes the write lock before the position
+        is read, so two sells can't both pass the quantity check.
+        """
+
+        with self.pool.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            status = self._sell(connection, crypto_id, transaction_id, quantity, proceeds)
+            connection.commit()
+        return status
+
+    def _sell(self, connection, crypto_id, transaction_id, quantity, proceeds, journal_id=None):
+        position = connection.execute(
+            "SELECT quantity, average_cost_basis FROM positions WHERE crypto_id = ?", (crypto_id,)).fetchone()
+        if position is None or position[0] < quantity:
+            return "not_enough"
+        held, average_cost_basis = position
+
+        # Use up the open lots, oldest first
+        fifo_cost = 0.0
+        left = quantity
+        used = []
+        for trade_id, remaining, unit_cost in connection.execute(
+                "SELECT trade_id, remaining_quantity, unit_cost FROM lots WHERE crypto_id = ? ORDER BY trade_id", (crypto_id,)):
+            taken = min(remaining, left)
+            used.append((remaining - taken, trade_id))
+            fifo_cost += taken * unit_cost
+            left -= taken
+            if left <= 0:
+                break
+        connection.executemany("UPDATE lots SET remaining_quantity = ? WHERE trade_id = ?", used)
+        connection.execute("DELETE FROM lots WHERE crypto_id = ? AND remaining_quantity <= 0", (crypto_id,))
+
+        average_cost = average_cost_basis * quantity / held
+        trade_id = connection.execute(
+            self.INSERT_TRADE, (crypto_id, transaction_id, 'S', quantity, proceeds / quantity, proceeds, journal_id)).lastrowid
+
+        if held == quantity:
+            connection.execute("DELETE FROM lots WHERE crypto_id = ?", (crypto_id,))
+            connection.execute("DELETE FROM positions WHERE crypto_id = ?", (crypto_id,))
+            return "deleted"
+
+        connection.execute(
+            """
+            UPDATE positions
+            SET quantity = quantity - ?,
+                average_cost_basis = average_cost_basis - ?,
+                fifo_cost_basis = fifo_cost_basis - ?,
+                realized_pnl_average = realized_pnl_average + ? - ?,
+                realized_pnl_fifo = realized_pnl_fifo + ? - ?,
+                last_trade_id = ?
+            WHERE crypto_id = ?
+            """, (quantity, average_cost, fifo_cost, proceeds, average_cost, proceeds, fifo_cost, trade_id, crypto_id))
+        return "updated"
+
+    def _apply(self, connection, journal_id, trade):
+        if connection.execute("SELECT 1 FROM trades WHERE journal_id = ?", (journal_id,)).fetchone() is not None:
+            return "duplicate"
+        row = connection.execute("SELECT crypto_id FROM cryptocurrencies WHERE symbol = ?", (trade["symbol"],)).fetchone()
+
+        if trade["side"] == "S":
+            if row is None:
+                return "not_held"
+            return self._sell(connection, row[0], None, trade["quantity"], trade["cost"], journal_id)
+
+        if row is None:
+            connection.execute("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)",
+                               (trade["crypto_id"], trade["symbol"], trade["name"]))
+            self._buy(connection, trade["crypto_id"], trade["transaction_id"], trade["quantity"], trade["price"], trade["cost"], journal_id)
+            return "added"
+        self._buy(connection, row[0], None, trade["quantity"], trade["cost"] / trade["quantity"], trade["cost"], journal_id)
+        return "bought"
+
+    def apply_trades(self, entries):
+        with self.pool.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                statuses = [self._apply(connection, journal_id, trade) for journal_id, trade in entries]
+                connection.commit()
+            except self.errors:
+                connection.rollback()
+                raise
+        return statuses
+
+    def iter_positions(self, basis="average", arraysize=None):
+        arraysize = arraysize or fetch_arraysize()
+        with self.pool.connection() as connection:
+            yield from stream_positions(connection.execute(FETCH_POSITIONS_QUERY.format(basis=BASIS_COLUMNS[basis])), arraysize)
+
+    def fetch_positions(self, basis="average"):
+        return list(self.iter_positions(basis))
+
+    def import_coins(self):
+        with self.pool.connection() as connection:
+            return {symbol: crypto_id for crypto_id, symbol in connection.execute("SELECT crypto_id, symbol FROM cryptocurrencies")}
+
+    def import_batch(self, new_coins, trades):
+        import_batch = uuid.uuid4().hex
+        with self.pool.connection() as connection:
+            try:
+                connection.executemany("INSERT INTO cryptocurrencies (crypto_id, symbol, name) VALUES (?, ?, ?)", new_coins)
+                connection.executemany(
+                    "INSERT INTO trades (crypto_id, transaction_id, side, quantity, price, cost, import_batch) VALUES (?, ?, 'B', ?, ?, ?, ?)",
+                    [trade + (import_batch,) for trade in trades])
+                connection.execute(
+                    "INSERT INTO lots (trade_id, crypto_id, remaining_quantity, unit_cost) "
+                    "SELECT trade_id, crypto_id, quantity, cost / quantity FROM trades WHERE import_batch = ?", (import_batch,))
+                connection.execute(self.IMPORT_POSITIONS, (import_batch,))
+                connection.commit()
+            except self.errors:
+                connection.rollback()
+                raise
@@ -0,0 +1,124 @@
+"""
+AlertBook's firing, hysteresis and cooldown, tick by tick
+"""
+
+import pytest
+
+from alerts import AlertBook, AlertStore
+from engine import PriceBook
+from storage import Position
+
+
+PRICE = ("BTC", "price")
+
+
+def tick(book, value, now=0.0):
+    return [alert.rule.rule_id for alert in book.evaluate({PRICE: value}, now=now)]
+
+
+def test_above_rule_fires_once_until_rearmed():
+    book = AlertBook(currency="GBP")
+    rule = book.add("BTC", "price", "above", 100, hysteresis=5)
+
+    assert tick(book, 90) == []
+    assert tick(book, 101) == [rule.rule_id]
+    assert tick(book, 104) == []
+    # Back under the threshold but not under the re-arm level of 95
+    assert tick(book, 99) == []
+    assert tick(book, 101) == []
+    assert tick(book, 94) == []
+    assert rule.armed
+    assert tick(book, 101) == [rule.rule_id]
+
+
+def test_below_rule_rearms_above_threshold_plus_hysteresis():
+    book = AlertBook(currency="GBP")
+    rule = book.add("BTC", "price", "below", 100, hysteresis=10)
+
+    assert tick(book, 120) == []
+    assert tick(book, 100) == [rule.rule_id]
+    assert tick(book, 105) == []
+    assert tick(book, 99) == []
+    assert tick(book, 111) == []
+    assert tick(book, 99) == [rule.rule_id]
+
+
+def test_cooldown_disarms_without_notifying():
+    book = AlertBook(currency="GBP")
+    rule = book.add("BTC", "price", "above", 100, cooldown=60)
+
+    assert tick(book, 90, now=0) == []
+    assert tick(book, 101, now=1) == [rule.rule_id]
+    assert tick(book, 99, now=2) == []
+    assert tick(book, 101, now=3) == []
+    assert not rule.armed
+    # The crossing inside the cooldown doesn't push the cooldown back
+    assert tick(book, 99, now=4) == []
+    assert tick(book, 101, now=61) == [rule.rule_id]
+
+
+def test_only_crossed_thresholds_fire():
+    book = AlertBook(currency="GBP")
+    rules = [book.add("BTC", "price", "above", threshold) for threshold in (100, 110, 120)]
+
+    assert tick(book, 90) == []
+    assert sorted(tick(book, 115)) == [rules[0].rule_id, rules[1].rule_id]
+    assert tick(book, 125) == [rules[2].rule_id]
+
+
+def test_first_value_fires_rules_already_past():
+    book = AlertBook(currency="GBP")
+    above = book.add("BTC", "price", "above", 100)
+    book.add("BTC", "price", "below", 50)
+
+    assert tick(book, 150) == [above.rule_id]
+
+
+def test_rule_added_past_its_threshold_fires_on_the_next_tick():
+    book = AlertBook(currency="GBP")
+    book.add("BTC", "price", "above", 100)
+    tick(book, 150)
+
+    rule = book.add("BTC", "price", "above", 120)
+    assert tick(book, 150) == [rule.rule_id]
+    assert tick(book, 150) == []
+
+
+def test_removed_rule_never_fires():
+    book = AlertBook(currency="GBP")
+    rule = book.add("BTC", "price", "above", 100)
+    tick(book, 90)
+    book.remove(rule.rule_id)
+
+    assert tick(book, 101) == []
+    assert len(book) == 0
+
+
+def test_disarmed_state_survives_a_restart(tmp_path):
+    store = AlertStore(str(tmp_path / "alerts.db"))
+    book = AlertBook(store, currency="GBP")
+    rule = book.add("BTC", "price", "above", 100, hysteresis=5)
+    assert tick(book, 101) == [rule.rule_id]
+
+    restarted = AlertBook(store, currency="GBP")
+    [loaded] = restarted.rules()
+    assert not loaded.armed
+    assert tick(restarted, 101) == []
+    assert tick(restarted, 90) == []
+    assert tick(restarted, 101) == [rule.rule_id]
+
+
+def test_check_values_pnl_and_calls_sinks():
+    fired = []
+    book = AlertBook(sinks=[fired.append], currency="GBP")
+    book.add("BTC", "pnl_percent", "above", 25)
+    coins = [Position(1, "BTC", "Bitcoin", 1, 2.0, 100.0, 200.0)]
+
+    def prices(price):
+        return PriceBook({"data": [{"id": 1, "symbol": "BTC", "name": "Bitcoin", "quote": {"GBP": {"price": price}}}]})
+
+    assert book.check(coins, prices(110.0)) == []
+    alerts = book.check(coins, prices(130.0))
+
+    assert fired == alerts
+    assert alerts[0].value == pytest.approx(30.0)
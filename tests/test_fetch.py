@@ -0,0 +1,125 @@
+"""
+fetch_quotes and fetch_all_listings against the local CoinMarketCap stand-in
+"""
+
+import pytest
+
+import engine
+from benchmarks.standins import FakeCoinMarketCap, make_listings
+
+
+@pytest.fixture
+def serve(monkeypatch):
+
+    """
+    Starts a FakeCoinMarketCap for a payload and points the engine's API
+    client at it, with no retries so a failed request fails straight away
+    """
+
+    monkeypatch.setenv("BASE_CURRENCY", "GBP")
+    servers = []
+    previous = engine.set_api_client(None)
+
+    def start(payload):
+        fake = FakeCoinMarketCap(payload).__enter__()
+        servers.append(fake)
+        engine.set_api_client(engine.CoinMarketCapClient("test", base_url=fake.url, retries=0))
+        return fake
+
+    yield start
+    client = engine.set_api_client(previous)
+    if client is not None:
+        client.close()
+    for fake in servers:
+        fake.__exit__(None, None, None)
+
+
+def symbols(payload):
+    return [listing["symbol"] for listing in payload["data"]]
+
+
+def test_quotes_are_batched(serve):
+    payload = make_listings(250)
+    fake = serve(payload)
+
+    api_data = engine.fetch_quotes("test", symbols=symbols(payload), batch_size=100)
+
+    assert fake.requests == 3
+    assert [listing["id"] for listing in api_data["data"]] == list(range(1, 251))
+
+
+def test_quotes_by_symbol_and_id(serve):
+    payload = make_listings(10)
+    serve(payload)
+
+    api_data = engine.fetch_quotes("test", symbols=[payload["data"][0]["symbol"].lower()], ids=[5, 9])
+
+    assert [listing["id"] for listing in api_data["data"]] == [1, 5, 9]
+
+
+def test_failed_batch_returns_none(serve):
+    payload = make_listings(250)
+    fake = serve(payload)
+    last = payload["data"][-1]["symbol"]
+    fake.failing = lambda path, query: last in query.get("symbol", "").split(",")
+
+    assert engine.fetch_quotes("test", symbols=symbols(payload), batch_size=100) is None
+
+
+def test_shared_symbol_ordered_by_rank(serve):
+    payload = make_listings(10)
+    third, eighth = payload["data"][2], payload["data"][7]
+    # The coin listed later is ranked higher, so the order has to come from cmc_rank
+    eighth["symbol"] = third["symbol"]
+    third["cmc_rank"], eighth["cmc_rank"] = 8, 3
+    serve(payload)
+
+    api_data = engine.fetch_quotes("test", symbols=[third["symbol"]])
+
+    assert [listing["id"] for listing in api_data["data"]] == [8, 3]
+    assert engine.PriceBook(api_data).get(third["symbol"])["id"] == 8
+
+
+def test_no_symbols_makes_no_requests(serve):
+    fake = serve(make_listings(10))
+
+    assert engine.fetch_quotes("test") == {"status": {}, "data": []}
+    assert fake.requests == 0
+
+
+def test_all_listings_are_paged(serve):
+    fake = serve(make_listings(250))
+
+    api_data = engine.fetch_all_listings("test", page_size=100)
+
+    assert fake.requests == 3
+    assert [listing["cmc_rank"] for listing in api_data["data"]] == list(range(1, 251))
+
+
+def test_all_listings_limit(serve):
+    fake = serve(make_listings(250))
+
+    api_data = engine.fetch_all_listings("test", limit=150, page_size=100)
+
+    assert fake.requests == 2
+    assert len(api_data["data"]) == 150
+
+
+def test_failed_page_returns_none(serve):
+    fake = serve(make_listings(250))
+    fake.failing = lambda path, query: query.get("start") == "101"
+
+    assert engine.fetch_all_listings("test", page_size=100) is None
+
+
+def test_reserve_is_kept_for_quotes(serve):
+    payload = make_listings(10)
+    fake = serve(payload)
+    # Synced from key/info on the first call
+    fake.credits_used = 5
+    client = engine.CoinMarketCapClient("test", base_url=fake.url, retries=0, daily_credit_budget=10, reserve=5)
+    engine.set_api_client(client)
+
+    assert engine.fetch_all_listings("test") is None
+    assert engine.fetch_quotes("test", symbols=symbols(payload)) is not None
+    assert client.stats["throttled"] == 1
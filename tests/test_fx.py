@@ -0,0 +1,40 @@
+"""
+FXRates caching, with a stub in place of the price conversion call
+"""
+
+import engine
+
+
+def rates(table, ttl=60):
+    calls = []
+
+    def fetch(currency):
+        calls.append(currency)
+        return table.get(currency)
+
+    return engine.FXRates("test", base="GBP", ttl=ttl, fetch=fetch), calls
+
+
+def test_rates_are_cached():
+    fx, calls = rates({"USD": 1.27})
+
+    assert fx.rate("usd") == 1.27
+    assert fx.rate("USD") == 1.27
+    assert fx.rate("GBP") == 1.0
+    assert calls == ["USD"]
+
+
+def test_refresh_fetches_each_currency_once():
+    fx, calls = rates({"USD": 1.27})
+
+    assert fx.refresh(["USD", "EUR", "GBP"]) == {"GBP": 1.0, "USD": 1.27}
+    assert calls == ["USD", "EUR"]
+
+
+def test_failed_refresh_keeps_the_expired_rate():
+    fx, calls = rates({}, ttl=0)
+    fx.cache.set("USD", 1.25, stored_at=0)
+
+    assert fx.refresh(["USD"]) == {"GBP": 1.0, "USD": 1.25}
+    assert fx.rate("USD") == 1.25
+    assert calls == ["USD", "USD"]
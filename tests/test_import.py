@@ -0,0 +1,74 @@
+"""
+import_trades with buys and sells in one file
+"""
+
+import csv
+
+import pytest
+
+import engine
+from storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "folio.db"))
+    previous = engine.set_storage(storage)
+    yield storage
+    engine.set_storage(previous)
+    storage.pool.close_all()
+
+
+def write_trades(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=["crypto_id", "transaction_id", "symbol", "name", "side", "quantity", "price", "cost"])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def trade(side, quantity, price, transaction_id=1):
+    return {"crypto_id": 1, "transaction_id": transaction_id, "symbol": "BTC", "name": "Bitcoin",
+            "side": side, "quantity": quantity, "price": price, "cost": quantity * price}
+
+
+def test_sells_are_booked_as_sells(storage, tmp_path):
+    path = write_trades(tmp_path / "trades.csv", [trade("buy", 2, 100), trade("sell", 1, 150, 2)])
+
+    result = engine.import_trades(path, batch_size=10)
+
+    assert (result["imported"], result["rejected"]) == (2, 0)
+    [position] = storage.fetch_positions("average")
+    assert (position.quantity, position.cost_basis) == (1.0, 100.0)
+
+
+def test_sells_use_up_the_buys_listed_before_them(storage, tmp_path):
+    path = write_trades(tmp_path / "trades.csv", [
+        trade("B", 1, 100), trade("S", 1, 150, 2), trade("B", 1, 300, 3),
+    ])
+
+    engine.import_trades(path, batch_size=10)
+
+    [position] = storage.fetch_positions("fifo")
+    assert (position.quantity, position.cost_basis) == (1.0, 300.0)
+
+
+def test_rows_without_a_side_are_buys(storage, tmp_path):
+    path = write_trades(tmp_path / "trades.csv", [trade("", 2, 100)])
+
+    assert engine.import_trades(path)["imported"] == 1
+    assert storage.fetch_positions()[0].quantity == 2.0
+
+
+def test_bad_sides_and_oversells_are_rejected(storage, tmp_path):
+    path = write_trades(tmp_path / "trades.csv", [
+        trade("buy", 1, 100), trade("transfer", 1, 100, 2), trade("sell", 5, 100, 3),
+    ])
+
+    result = engine.import_trades(path, batch_size=10)
+
+    assert (result["imported"], result["rejected"]) == (1, 2)
+    with open(result["error_path"], newline="", encoding="utf-8") as file:
+        errors = [row["error"] for row in csv.DictReader(file)]
+    assert errors == ["Side must be buy or sell", "Not enough BTC held to sell 5.0"]
+    assert storage.fetch_positions()[0].quantity == 1.0
@@ -0,0 +1,112 @@
+"""
+The ledger, lots and positions kept by SQLiteStorage: average cost and FIFO
+cost bases and the realised P/L under each
+"""
+
+import pytest
+
+from storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "folio.db"))
+    storage.add_coin(1, "BTC", "Bitcoin")
+    yield storage
+    storage.pool.close_all()
+
+
+def position_row(storage, crypto_id=1):
+    with storage.pool.connection() as connection:
+        return connection.execute(
+            "SELECT quantity, average_cost_basis, fifo_cost_basis, realized_pnl_average, realized_pnl_fifo "
+            "FROM positions WHERE crypto_id = ?", (crypto_id,)).fetchone()
+
+
+def open_lots(storage, crypto_id=1):
+    with storage.pool.connection() as connection:
+        return connection.execute(
+            "SELECT remaining_quantity, unit_cost FROM lots WHERE crypto_id = ? ORDER BY trade_id", (crypto_id,)).fetchall()
+
+
+def buy_two_lots(storage):
+    storage.record_buy(1, 1, 2.0, 100.0, 200.0)
+    storage.record_buy(1, 2, 2.0, 300.0, 600.0)
+
+
+def test_buys_add_to_both_bases(storage):
+    buy_two_lots(storage)
+
+    assert position_row(storage) == (4.0, 800.0, 800.0, 0.0, 0.0)
+    assert open_lots(storage) == [(2.0, 100.0), (2.0, 300.0)]
+    [position] = storage.fetch_positions("average")
+    assert (position.symbol, position.quantity, position.unit_cost) == ("BTC", 4.0, 200.0)
+
+
+def test_partial_sell_realises_fifo_and_average_pnl(storage):
+    buy_two_lots(storage)
+
+    assert storage.record_sell(1, 3, 3.0, 900.0) == "updated"
+
+    # Average: 3 of 4 coins at 200 each. FIFO: all of the 100 lot and one coin of the 300 lot.
+    assert position_row(storage) == (1.0, 200.0, 300.0, 300.0, 400.0)
+    assert open_lots(storage) == [(1.0, 300.0)]
+    assert storage.fetch_positions("average")[0].unit_cost == 200.0
+    assert storage.fetch_positions("fifo")[0].unit_cost == 300.0
+
+
+def test_selling_more_than_held_changes_nothing(storage):
+    buy_two_lots(storage)
+
+    assert storage.record_sell(1, 3, 5.0, 1000.0) == "not_enough"
+    assert position_row(storage) == (4.0, 800.0, 800.0, 0.0, 0.0)
+    assert open_lots(storage) == [(2.0, 100.0), (2.0, 300.0)]
+
+
+def test_selling_out_removes_the_position(storage):
+    buy_two_lots(storage)
+
+    assert storage.record_sell(1, 3, 4.0, 1000.0) == "deleted"
+    assert storage.fetch_positions("average") == []
+    assert open_lots(storage) == []
+    # The coin and its trades stay in the ledger
+    assert storage.find_coin("BTC") == 1
+    with storage.pool.connection() as connection:
+        assert connection.execute("SELECT side FROM trades ORDER BY trade_id").fetchall() == [("B",), ("B",), ("S",)]
+
+
+def test_sell_with_no_position(storage):
+    assert storage.record_sell(1, 1, 1.0, 100.0) == "not_enough"
+
+
+def test_apply_trades_statuses(storage):
+    buy_two_lots(storage)
+    new_coin = {"side": "B", "symbol": "ETH", "crypto_id": 2, "name": "Ethereum", "transaction_id": 7,
+                "quantity": 1.0, "price": 50.0, "cost": 50.0}
+    sell = {"side": "S", "symbol": "BTC", "quantity": 1.0, "cost": 400.0}
+
+    statuses = storage.apply_trades([
+        ("a", new_coin),
+        ("b", sell),
+        ("c", {"side": "S", "symbol": "DOGE", "quantity": 1.0, "cost": 1.0}),
+    ])
+
+    assert statuses == ["added", "updated", "not_held"]
+    # Replaying a journal entry is a no-op
+    assert storage.apply_trades([("b", sell)]) == ["duplicate"]
+    # One of four coins sold: the average realises 400 - 200, FIFO 400 - 100
+    assert position_row(storage) == (3.0, 600.0, 700.0, 200.0, 300.0)
+    assert position_row(storage, 2) == (1.0, 50.0, 50.0, 0.0, 0.0)
+
+
+def test_import_batch_merges_into_positions(storage):
+    buy_two_lots(storage)
+
+    storage.import_batch([(2, "ETH", "Ethereum")], [(1, 10, 1.0, 400.0, 400.0), (2, 11, 2.0, 50.0, 100.0)])
+
+    assert position_row(storage) == (5.0, 1200.0, 1200.0, 0.0, 0.0)
+    assert position_row(storage, 2) == (2.0, 100.0, 100.0, 0.0, 0.0)
+    assert open_lots(storage) == [(2.0, 100.0), (2.0, 300.0), (1.0, 400.0)]
+    # Imported lots are used up after the older ones
+    storage.record_sell(1, 12, 3.0, 900.0)
+    assert open_lots(storage) == [(1.0, 300.0), (1.0, 400.0)]
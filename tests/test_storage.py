@@ -0,0 +1,53 @@
+"""
+Streaming positions through the connection pool
+"""
+
+import pytest
+
+from storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "folio.db"), pool_size=1)
+    storage.pool.acquire_timeout = 0.5
+    for crypto_id, symbol in enumerate(["BTC", "ETH", "SOL"], start=1):
+        storage.add_coin(crypto_id, symbol, symbol.title())
+        storage.record_buy(crypto_id, crypto_id, 1.0, 10.0, 10.0)
+    yield storage
+    storage.pool.close_all()
+
+
+def test_closing_a_stream_early_releases_the_connection(storage):
+    positions = storage.iter_positions("average", arraysize=1)
+    assert next(positions).symbol == "BTC"
+    positions.close()
+
+    # With one pooled connection, a leaked one would time out here
+    assert [position.symbol for position in storage.fetch_positions()] == ["BTC", "ETH", "SOL"]
+
+
+def test_breaking_out_of_a_stream_releases_the_connection(storage):
+    for position in storage.iter_positions("average", arraysize=1):
+        break
+    del position
+
+    assert len(storage.fetch_positions()) == 3
+
+
+def test_arraysize_is_read_when_streaming(storage, monkeypatch):
+    arraysizes = []
+
+    def stream_positions(cursor, arraysize):
+        arraysizes.append(arraysize)
+        return iter(())
+
+    monkeypatch.setattr("storage.stream_positions", stream_positions)
+
+    monkeypatch.setenv("DATABASE_FETCH_ARRAYSIZE", "7")
+    list(storage.iter_positions())
+    monkeypatch.setenv("DATABASE_FETCH_ARRAYSIZE", "")
+    list(storage.iter_positions())
+    list(storage.iter_positions(arraysize=3))
+
+    assert arraysizes == [7, 500, 3]
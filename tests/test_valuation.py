@@ -0,0 +1,117 @@
+"""
+value_portfolio and value_columns against the per-row maths they replaced
+"""
+
+import math
+import random
+
+import pytest
+
+from engine import PriceBook, value_columns, value_portfolio
+from storage import Position
+
+
+def price_book(prices):
+
+    """
+    A PriceBook with one GBP listing per (symbol, price), in rank order
+    """
+
+    return PriceBook({"data": [
+        {"id": rank, "symbol": symbol, "name": symbol.title(), "cmc_rank": rank, "quote": {"GBP": {"price": price}}}
+        for rank, (symbol, price) in enumerate(prices, start=1)
+    ]})
+
+
+def position(crypto_id, symbol, quantity, unit_cost):
+    return Position(crypto_id, symbol, symbol.title(), crypto_id, quantity, unit_cost, quantity * unit_cost)
+
+
+def value_rows(coins, book):
+
+    """
+    The loop value_portfolio used before it was vectorised, one coin at a time
+    """
+
+    held = sorted((book.rank(book.get(coin.symbol)), coin) for coin in coins if book.get(coin.symbol) is not None)
+    holdings = []
+    for _, coin in held:
+        current_price = book.get(coin.symbol)["quote"]["GBP"]["price"]
+        current_value = current_price * coin.quantity
+        purchase_cost = coin.unit_cost * coin.quantity
+        profit_and_loss = current_value - purchase_cost
+        percentage_change = profit_and_loss / purchase_cost * 100 if purchase_cost else math.nan
+        holdings.append((coin.symbol, current_value, purchase_cost, profit_and_loss, percentage_change))
+    total = sum(holding[1] for holding in holdings)
+    return [holding + (holding[1] / total if total else 0.0,) for holding in holdings], total
+
+
+def test_matches_the_per_row_maths():
+    rng = random.Random(7)
+    symbols = [f"C{number}" for number in range(200)]
+    book = price_book([(symbol, rng.uniform(0.01, 50000)) for symbol in symbols])
+    coins = [position(number, symbol, rng.uniform(0, 100), rng.uniform(0.01, 50000))
+             for number, symbol in enumerate(rng.sample(symbols, 150), start=1)]
+
+    holdings, total_value, total_profit_and_loss = value_portfolio(coins, book, "GBP")
+    expected, expected_total = value_rows(coins, book)
+
+    assert [holding["coin"].symbol for holding in holdings] == [row[0] for row in expected]
+    for holding, row in zip(holdings, expected):
+        fields = (holding["current_value"], holding["purchase_cost"], holding["profit_and_loss"],
+                  holding["percentage_change"], holding["allocation"])
+        assert fields == pytest.approx(row[1:])
+    assert total_value == pytest.approx(expected_total)
+    assert total_profit_and_loss == pytest.approx(sum(row[3] for row in expected))
+
+
+def test_coins_without_a_price_are_left_out():
+    book = price_book([("BTC", 200.0)])
+    coins = [position(1, "BTC", 2.0, 100.0), position(2, "GONE", 5.0, 10.0)]
+
+    holdings, total_value, total_profit_and_loss = value_portfolio(coins, book, "GBP")
+
+    assert [holding["coin"].symbol for holding in holdings] == ["BTC"]
+    assert (total_value, total_profit_and_loss) == (400.0, 200.0)
+
+
+def test_zero_cost_has_no_percentage():
+    book = price_book([("BTC", 200.0), ("AIR", 5.0)])
+    coins = [position(1, "BTC", 1.0, 100.0), position(2, "AIR", 10.0, 0.0)]
+
+    holdings, total_value, _ = value_portfolio(coins, book, "GBP")
+
+    airdrop = holdings[1]
+    assert (airdrop["current_value"], airdrop["purchase_cost"], airdrop["profit_and_loss"]) == (50.0, 0.0, 50.0)
+    assert math.isnan(airdrop["percentage_change"])
+    assert holdings[0]["percentage_change"] == 100.0
+    assert total_value == 250.0
+
+
+def test_zero_quantity_and_zero_value_portfolio():
+    valuation = value_columns([0.0, 0.0], [100.0, 50.0], [200.0, 0.0])
+
+    assert valuation["valued"].tolist() == [True, True]
+    assert valuation["total_value"] == 0.0
+    assert valuation["allocation"].tolist() == [0.0, 0.0]
+    assert all(math.isnan(value) for value in valuation["percentage_change"])
+
+
+def test_nan_columns_are_not_valued():
+    valuation = value_columns([1.0, math.nan], [10.0, 10.0], [20.0, 20.0])
+
+    assert valuation["valued"].tolist() == [True, False]
+    assert math.isnan(valuation["current_value"][1])
+    assert (valuation["total_value"], valuation["total_cost"]) == (20.0, 10.0)
+    assert valuation["allocation"][0] == 1.0
+
+
+def test_fx_rate_converts_prices_and_costs():
+    book = price_book([("BTC", 200.0)])
+    coins = [position(1, "BTC", 2.0, 100.0)]
+
+    [holding], total_value, total_profit_and_loss = value_portfolio(coins, book, "GBP", fx_rate=1.5)
+
+    assert (holding["current_price"], holding["purchase_cost"]) == (300.0, 300.0)
+    assert (total_value, total_profit_and_loss) == (600.0, 300.0)
+    assert holding["percentage_change"] == 100.0